@@ -6,67 +6,70 @@
 # full text of which is available in the accompanying LICENSE file at the
 # root directory of this project.
 #
-from ctypes import windll, wintypes
 import cProfile
 import codecs
-from collections import defaultdict, namedtuple
-import errno
-import hashlib
-import json
+import concurrent.futures
+from collections import defaultdict
 import os
-from shutil import copyfile, rmtree
-import subprocess
-from subprocess import Popen, PIPE
 import sys
 import multiprocessing
+from multiprocessing.connection import Client, Listener
 import re
-
-VERSION = "3.2.0-dev"
-
-HashAlgorithm = hashlib.md5
-
-# try to use os.scandir or scandir.scandir
-# fall back to os.listdir if not found
-# same for scandir.walk
-try:
-    import scandir # pylint: disable=wrong-import-position
-    WALK = scandir.walk
-    LIST = scandir.scandir
-except ImportError:
-    WALK = os.walk
-    try:
-        LIST = os.scandir # pylint: disable=no-name-in-module
-    except AttributeError:
-        LIST = os.listdir
-
-# The codec that is used by clcache to store compiler STDOUR and STDERR in
-# output.txt and stderr.txt.
-# This codec is up to us and only used for clcache internal storage.
-# For possible values see https://docs.python.org/2/library/codecs.html
-CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
-
-# The cl default codec
-CL_DEFAULT_CODEC = 'mbcs'
-
-# Manifest file will have at most this number of hash lists in it. Need to avoi
-# manifests grow too large.
-MAX_MANIFEST_HASHES = 100
-
-# String, by which BASE_DIR will be replaced in paths, stored in manifests.
-# ? is invalid character for file name, so it seems ok
-# to use it as mark for relative path.
-BASEDIR_REPLACEMENT = '?'
-
-# `includeFiles`: list of paths to include files, which this source file uses
-# `includesContentToObjectMap`: dictionary
-#   key: cumulative hash of all include files' content in includeFiles
-#   value: key in the cache, under which the object file is stored
-Manifest = namedtuple('Manifest', ['includeFiles', 'includesContentToObjectMap'])
-
-CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr'])
-
-def printBinary(stream, rawData):
-    stream.buffer.write(rawData)
+import tempfile
+import threading
+import time
+
+from clcacheutil import (
+    CacheFileLock,
+    CacheLockException,
+    CL_DEFAULT_CODEC,
+    collapseBasedirToPlaceholder,
+    ensureDirectoryExists,
+    expandBasedirPlaceholder,
+    getFileHash,
+    getStringHash,
+    IncludeChangedException,
+    IncludeNotFoundException,
+    invokeRealCompiler,
+    LogicException,
+    normalizeBaseDir,
+    printBinary,
+    printTraceStatement,
+    VERSION,
+    writeFileAtomically,
+)
+
+from clcachestorage import (
+    CompilerArtifacts,
+    CompilerArtifactsRepository,
+    CorruptCacheEntryException,
+    Manifest,
+    ManifestEntry,
+    ManifestRepository,
+    OBJECT_COMPRESSIONS,
+)
+
+from clcachedirectory import (
+    Cache,
+    cleanupRequestPath,
+    defaultCacheDirectory,
+    scheduleCleanup,
+    ServerWorker,
+    Statistics,
+)
+
+
+# Invocations with multiple source files look up the cache entries of the
+# source files using up to this number of threads.
+MULTIPLE_SOURCES_LOOKUP_THREADS = 8
+
+# A clcache server checks whether the cache needs to be cleaned in this
+# interval (in seconds).
+SERVER_CLEANUP_INTERVAL = 5
+
+# A long-lived process keeps the arguments of at most this number of response
+# files in memory.
+MAX_RESPONSE_FILES_IN_MEMORY = 1000
 
 
 def basenameWithoutExtension(path):
@@ -74,598 +77,6 @@ def basenameWithoutExtension(path):
     return os.path.splitext(basename)[0]
 
 
-def filesBeneath(path):
-    for path, _, filenames in WALK(path):
-        for filename in filenames:
-            yield os.path.join(path, filename)
-
-
-def childDirectories(path, absolute=True):
-    supportsScandir = (LIST != os.listdir)
-    for entry in LIST(path):
-        if supportsScandir:
-            if entry.is_dir():
-                yield entry.path if absolute else entry.name
-        else:
-            absPath = os.path.join(path, entry)
-            if os.path.isdir(absPath):
-                yield absPath if absolute else entry
-
-
-def normalizeBaseDir(baseDir):
-    if baseDir:
-        baseDir = os.path.normcase(baseDir)
-        if not baseDir.endswith(os.path.sep):
-            baseDir += os.path.sep
-        return baseDir
-    else:
-        # Converts empty string to None
-        return None
-
-
-class IncludeNotFoundException(Exception):
-    pass
-
-
-class IncludeChangedException(Exception):
-    pass
-
-
-class CacheLockException(Exception):
-    pass
-
-
-class LogicException(Exception):
-    def __init__(self, message):
-        super(LogicException, self).__init__(message)
-        self.message = message
-
-    def __str__(self):
-        return repr(self.message)
-
-
-class ManifestSection(object):
-    def __init__(self, manifestSectionDir):
-        self.manifestSectionDir = manifestSectionDir
-
-    def manifestPath(self, manifestHash):
-        return os.path.join(self.manifestSectionDir, manifestHash + ".json")
-
-    def manifestFiles(self):
-        return filesBeneath(self.manifestSectionDir)
-
-    def setManifest(self, manifestHash, manifest):
-        ensureDirectoryExists(self.manifestSectionDir)
-        with open(self.manifestPath(manifestHash), 'w') as outFile:
-            # Converting namedtuple to JSON via OrderedDict preserves key names and keys order
-            json.dump(manifest._asdict(), outFile, sort_keys=True, indent=2)
-
-    def getManifest(self, manifestHash):
-        fileName = self.manifestPath(manifestHash)
-        if not os.path.exists(fileName):
-            return None
-        try:
-            with open(fileName, 'r') as inFile:
-                doc = json.load(inFile)
-                return Manifest(doc['includeFiles'], doc['includesContentToObjectMap'])
-        except IOError:
-            return None
-
-
-class ManifestRepository(object):
-    # Bump this counter whenever the current manifest file format changes.
-    # E.g. changing the file format from {'oldkey': ...} to {'newkey': ...} requires
-    # invalidation, such that a manifest that was stored using the old format is not
-    # interpreted using the new format. Instead the old file will not be touched
-    # again due to a new manifest hash and is cleaned away after some time.
-    MANIFEST_FILE_FORMAT_VERSION = 4
-
-    def __init__(self, manifestsRootDir):
-        self._manifestsRootDir = manifestsRootDir
-
-    def section(self, manifestHash):
-        return ManifestSection(os.path.join(self._manifestsRootDir, manifestHash[:2]))
-
-    def sections(self):
-        return (ManifestSection(path) for path in childDirectories(self._manifestsRootDir))
-
-    def clean(self, maxManifestsSize):
-        manifestFileInfos = []
-        for section in self.sections():
-            for filePath in section.manifestFiles():
-                try:
-                    manifestFileInfos.append((os.stat(filePath), filePath))
-                except OSError:
-                    pass
-
-        manifestFileInfos.sort(key=lambda t: t[0].st_atime, reverse=True)
-
-        remainingObjectsSize = 0
-        for stat, filepath in manifestFileInfos:
-            if remainingObjectsSize + stat.st_size <= maxManifestsSize:
-                remainingObjectsSize += stat.st_size
-            else:
-                os.remove(filepath)
-        return remainingObjectsSize
-
-    @staticmethod
-    def getManifestHash(compilerBinary, commandLine, sourceFile):
-        compilerHash = getCompilerHash(compilerBinary)
-
-        # NOTE: We intentionally do not normalize command line to include
-        # preprocessor options. In direct mode we do not perform
-        # preprocessing before cache lookup, so all parameters are important.
-        # One of the few exceptions to this rule is the /MP switch, which only
-        # defines how many compiler processes are running simultaneusly.
-        commandLine = [arg for arg in commandLine if not arg.startswith("/MP")]
-
-        additionalData = "{}|{}|{}".format(
-            compilerHash, commandLine, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION)
-        return getFileHash(sourceFile, additionalData)
-
-    @staticmethod
-    def getIncludesContentHashForFiles(includes):
-        listOfIncludesHashes = []
-        includeMissing = False
-
-        for path in sorted(includes.keys()):
-            try:
-                fileHash = getFileHash(path)
-                if fileHash != includes[path]:
-                    raise IncludeChangedException()
-                listOfIncludesHashes.append(fileHash)
-            except FileNotFoundError:
-                includeMissing = True
-
-        if includeMissing:
-            raise IncludeNotFoundException()
-
-        return ManifestRepository.getIncludesContentHashForHashes(listOfIncludesHashes)
-
-    @staticmethod
-    def getIncludesContentHashForHashes(listOfIncludesHashes):
-        return HashAlgorithm(','.join(listOfIncludesHashes).encode()).hexdigest()
-
-
-class CacheLock(object):
-    """ Implements a lock for the object cache which
-    can be used in 'with' statements. """
-    INFINITE = 0xFFFFFFFF
-    WAIT_ABANDONED_CODE = 0x00000080
-    WAIT_TIMEOUT_CODE = 0x00000102
-
-    def __init__(self, mutexName, timeoutMs):
-        self._mutexName = 'Local\\' + mutexName
-        self._mutex = windll.kernel32.CreateMutexW(
-            wintypes.INT(0),
-            wintypes.INT(0),
-            self._mutexName)
-        self._timeoutMs = timeoutMs
-        assert self._mutex
-
-    def __enter__(self):
-        self.acquire()
-
-    def __exit__(self, typ, value, traceback):
-        self.release()
-
-    def __del__(self):
-        windll.kernel32.CloseHandle(self._mutex)
-
-    def acquire(self):
-        result = windll.kernel32.WaitForSingleObject(
-            self._mutex, wintypes.INT(self._timeoutMs))
-        if result not in [0, self.WAIT_ABANDONED_CODE]:
-            if result == self.WAIT_TIMEOUT_CODE:
-                errorString = \
-                    'Failed to acquire lock {} after {}ms; ' \
-                    'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
-                        self._mutexName, self._timeoutMs)
-            else:
-                errorString = 'Error! WaitForSingleObject returns {result}, last error {error}'.format(
-                    result=result,
-                    error=windll.kernel32.GetLastError())
-            raise CacheLockException(errorString)
-
-    def release(self):
-        windll.kernel32.ReleaseMutex(self._mutex)
-
-
-class CompilerArtifactsSection(object):
-    def __init__(self, compilerArtifactsSectionDir):
-        self.compilerArtifactsSectionDir = compilerArtifactsSectionDir
-
-    def cacheEntryDir(self, key):
-        return os.path.join(self.compilerArtifactsSectionDir, key)
-
-    def cacheEntries(self):
-        return childDirectories(self.compilerArtifactsSectionDir, absolute=False)
-
-    def cachedObjectName(self, key):
-        return os.path.join(self.cacheEntryDir(key), "object")
-
-    def hasEntry(self, key):
-        return os.path.exists(self.cacheEntryDir(key))
-
-    def setEntry(self, key, artifacts):
-        ensureDirectoryExists(self.cacheEntryDir(key))
-        if artifacts.objectFilePath is not None:
-            copyOrLink(artifacts.objectFilePath, self.cachedObjectName(key))
-        self._setCachedCompilerConsoleOutput(key, 'output.txt', artifacts.stdout)
-        if artifacts.stderr != '':
-            self._setCachedCompilerConsoleOutput(key, 'stderr.txt', artifacts.stderr)
-
-    def getEntry(self, key):
-        assert self.hasEntry(key)
-        return CompilerArtifacts(
-            self.cachedObjectName(key),
-            self._getCachedCompilerConsoleOutput(key, 'output.txt'),
-            self._getCachedCompilerConsoleOutput(key, 'stderr.txt')
-            )
-
-    def _getCachedCompilerConsoleOutput(self, key, fileName):
-        try:
-            outputFilePath = os.path.join(self.cacheEntryDir(key), fileName)
-            with open(outputFilePath, 'rb') as f:
-                return f.read().decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
-        except IOError:
-            return ''
-
-    def _setCachedCompilerConsoleOutput(self, key, fileName, output):
-        outputFilePath = os.path.join(self.cacheEntryDir(key), fileName)
-        with open(outputFilePath, 'wb') as f:
-            f.write(output.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC))
-
-
-class CompilerArtifactsRepository(object):
-    def __init__(self, compilerArtifactsRootDir):
-        self._compilerArtifactsRootDir = compilerArtifactsRootDir
-
-    def section(self, key):
-        return CompilerArtifactsSection(os.path.join(self._compilerArtifactsRootDir, key[:2]))
-
-    def sections(self):
-        return (CompilerArtifactsSection(path) for path in childDirectories(self._compilerArtifactsRootDir))
-
-    def removeEntry(self, keyToBeRemoved):
-        compilerArtifactsDir = self.section(keyToBeRemoved).cacheEntryDir(keyToBeRemoved)
-        rmtree(compilerArtifactsDir, ignore_errors=True)
-
-    def clean(self, maxCompilerArtifactsSize):
-        objectInfos = []
-        for section in self.sections():
-            for cachekey in section.cacheEntries():
-                try:
-                    objectStat = os.stat(section.cachedObjectName(cachekey))
-                    objectInfos.append((objectStat, cachekey))
-                except OSError:
-                    pass
-
-        objectInfos.sort(key=lambda t: t[0].st_atime)
-
-        # compute real current size to fix up the stored cacheSize
-        currentSizeObjects = sum(x[0].st_size for x in objectInfos)
-
-        removedItems = 0
-        for stat, cachekey in objectInfos:
-            self.removeEntry(cachekey)
-            removedItems += 1
-            currentSizeObjects -= stat.st_size
-            if currentSizeObjects < maxCompilerArtifactsSize:
-                break
-
-        return len(objectInfos)-removedItems, currentSizeObjects
-
-    @staticmethod
-    def computeKeyDirect(manifestHash, includesContentHash):
-        # We must take into account manifestHash to avoid
-        # collisions when different source files use the same
-        # set of includes.
-        return getStringHash(manifestHash + includesContentHash)
-
-    @staticmethod
-    def computeKeyNodirect(compilerBinary, commandLine, environment):
-        ppcmd = ["/EP"] + [arg for arg in commandLine if arg not in ("-c", "/c")]
-
-        returnCode, preprocessedSourceCode, ppStderrBinary = \
-            invokeRealCompiler(compilerBinary, ppcmd, captureOutput=True, outputAsString=False, environment=environment)
-
-        if returnCode != 0:
-            printBinary(sys.stderr, ppStderrBinary)
-            print("clcache: preprocessor failed", file=sys.stderr)
-            sys.exit(returnCode)
-
-        compilerHash = getCompilerHash(compilerBinary)
-        normalizedCmdLine = CompilerArtifactsRepository._normalizedCommandLine(commandLine)
-
-        h = HashAlgorithm()
-        h.update(compilerHash.encode("UTF-8"))
-        h.update(' '.join(normalizedCmdLine).encode("UTF-8"))
-        h.update(preprocessedSourceCode)
-        return h.hexdigest()
-
-    @staticmethod
-    def _normalizedCommandLine(cmdline):
-        # Remove all arguments from the command line which only influence the
-        # preprocessor; the preprocessor's output is already included into the
-        # hash sum so we don't have to care about these switches in the
-        # command line as well.
-        argsToStrip = ("AI", "C", "E", "P", "FI", "u", "X",
-                       "FU", "D", "EP", "Fx", "U", "I")
-
-        # Also remove the switch for specifying the output file name; we don't
-        # want two invocations which are identical except for the output file
-        # name to be treated differently.
-        argsToStrip += ("Fo",)
-
-        # Also strip the switch for specifying the number of parallel compiler
-        # processes to use (when specifying multiple source files on the
-        # command line).
-        argsToStrip += ("MP",)
-
-        return [arg for arg in cmdline
-                if not (arg[0] in "/-" and arg[1:].startswith(argsToStrip))]
-
-
-class Cache(object):
-    def __init__(self, cacheDirectory=None):
-        self.dir = cacheDirectory
-        if not self.dir:
-            try:
-                self.dir = os.environ["CLCACHE_DIR"]
-            except KeyError:
-                self.dir = os.path.join(os.path.expanduser("~"), "clcache")
-
-        manifestsRootDir = os.path.join(self.dir, "manifests")
-        ensureDirectoryExists(manifestsRootDir)
-        self.manifestRepository = ManifestRepository(manifestsRootDir)
-
-        compilerArtifactsRootDir = os.path.join(self.dir, "objects")
-        ensureDirectoryExists(compilerArtifactsRootDir)
-        self.compilerArtifactsRepository = CompilerArtifactsRepository(compilerArtifactsRootDir)
-
-        lockName = self.cacheDirectory().replace(':', '-').replace('\\', '-')
-        timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
-        self.lock = CacheLock(lockName, timeoutMs)
-
-        self.configuration = Configuration(os.path.join(self.dir, "config.txt"))
-        self.statistics = Statistics(os.path.join(self.dir, "stats.txt"))
-
-    def cacheDirectory(self):
-        return self.dir
-
-    def clean(self, stats, maximumSize):
-        currentSize = stats.currentCacheSize()
-        if currentSize < maximumSize:
-            return
-
-        # Free at least 10% to avoid cleaning up too often which
-        # is a big performance hit with large caches.
-        effectiveMaximumSizeOverall = maximumSize * 0.9
-
-        # Split limit in manifests (10 %) and objects (90 %)
-        effectiveMaximumSizeManifests = effectiveMaximumSizeOverall * 0.1
-        effectiveMaximumSizeObjects = effectiveMaximumSizeOverall - effectiveMaximumSizeManifests
-
-        # Clean manifests
-        currentSizeManifests = self.manifestRepository.clean(effectiveMaximumSizeManifests)
-
-        # Clean artifacts
-        currentCompilerArtifactsCount, currentCompilerArtifactsSize = self.compilerArtifactsRepository.clean(
-            effectiveMaximumSizeObjects)
-
-        stats.setCacheSize(currentCompilerArtifactsSize + currentSizeManifests)
-        stats.setNumCacheEntries(currentCompilerArtifactsCount)
-
-
-class PersistentJSONDict(object):
-    def __init__(self, fileName):
-        self._dirty = False
-        self._dict = {}
-        self._fileName = fileName
-        try:
-            with open(self._fileName, 'r') as f:
-                self._dict = json.load(f)
-        except IOError:
-            pass
-
-    def save(self):
-        if self._dirty:
-            with open(self._fileName, 'w') as f:
-                json.dump(self._dict, f, sort_keys=True, indent=4)
-
-    def __setitem__(self, key, value):
-        self._dict[key] = value
-        self._dirty = True
-
-    def __getitem__(self, key):
-        return self._dict[key]
-
-    def __contains__(self, key):
-        return key in self._dict
-
-    def __eq__(self, other):
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-
-
-class Configuration(object):
-    _defaultValues = {"MaximumCacheSize": 1073741824} # 1 GiB
-
-    def __init__(self, configurationFile):
-        self._configurationFile = configurationFile
-        self._cfg = None
-
-    def __enter__(self):
-        self._cfg = PersistentJSONDict(self._configurationFile)
-        for setting, defaultValue in self._defaultValues.items():
-            if setting not in self._cfg:
-                self._cfg[setting] = defaultValue
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        # Does not write to disc when unchanged
-        self._cfg.save()
-
-    def maximumCacheSize(self):
-        return self._cfg["MaximumCacheSize"]
-
-    def setMaximumCacheSize(self, size):
-        self._cfg["MaximumCacheSize"] = size
-
-
-class Statistics(object):
-    CALLS_WITH_INVALID_ARGUMENT = "CallsWithInvalidArgument"
-    CALLS_WITHOUT_SOURCE_FILE = "CallsWithoutSourceFile"
-    CALLS_WITH_MULTIPLE_SOURCE_FILES = "CallsWithMultipleSourceFiles"
-    CALLS_WITH_PCH = "CallsWithPch"
-    CALLS_FOR_LINKING = "CallsForLinking"
-    CALLS_FOR_EXTERNAL_DEBUG_INFO = "CallsForExternalDebugInfo"
-    CALLS_FOR_PREPROCESSING = "CallsForPreprocessing"
-    CACHE_HITS = "CacheHits"
-    CACHE_MISSES = "CacheMisses"
-    EVICTED_MISSES = "EvictedMisses"
-    HEADER_CHANGED_MISSES = "HeaderChangedMisses"
-    SOURCE_CHANGED_MISSES = "SourceChangedMisses"
-    CACHE_ENTRIES = "CacheEntries"
-    CACHE_SIZE = "CacheSize"
-
-    RESETTABLE_KEYS = {
-        CALLS_WITH_INVALID_ARGUMENT,
-        CALLS_WITHOUT_SOURCE_FILE,
-        CALLS_WITH_MULTIPLE_SOURCE_FILES,
-        CALLS_WITH_PCH,
-        CALLS_FOR_LINKING,
-        CALLS_FOR_EXTERNAL_DEBUG_INFO,
-        CALLS_FOR_PREPROCESSING,
-        CACHE_HITS,
-        CACHE_MISSES,
-        EVICTED_MISSES,
-        HEADER_CHANGED_MISSES,
-        SOURCE_CHANGED_MISSES,
-    }
-    NON_RESETTABLE_KEYS = {
-        CACHE_ENTRIES,
-        CACHE_SIZE,
-    }
-
-    def __init__(self, statsFile):
-        self._statsFile = statsFile
-        self._stats = None
-
-    def __enter__(self):
-        self._stats = PersistentJSONDict(self._statsFile)
-        for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
-            if k not in self._stats:
-                self._stats[k] = 0
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        # Does not write to disc when unchanged
-        self._stats.save()
-
-    def __eq__(self, other):
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-
-    def numCallsWithInvalidArgument(self):
-        return self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT]
-
-    def registerCallWithInvalidArgument(self):
-        self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
-
-    def numCallsWithoutSourceFile(self):
-        return self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE]
-
-    def registerCallWithoutSourceFile(self):
-        self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
-
-    def numCallsWithMultipleSourceFiles(self):
-        return self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES]
-
-    def registerCallWithMultipleSourceFiles(self):
-        self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
-
-    def numCallsWithPch(self):
-        return self._stats[Statistics.CALLS_WITH_PCH]
-
-    def registerCallWithPch(self):
-        self._stats[Statistics.CALLS_WITH_PCH] += 1
-
-    def numCallsForLinking(self):
-        return self._stats[Statistics.CALLS_FOR_LINKING]
-
-    def registerCallForLinking(self):
-        self._stats[Statistics.CALLS_FOR_LINKING] += 1
-
-    def numCallsForExternalDebugInfo(self):
-        return self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO]
-
-    def registerCallForExternalDebugInfo(self):
-        self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
-
-    def numEvictedMisses(self):
-        return self._stats[Statistics.EVICTED_MISSES]
-
-    def registerEvictedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.EVICTED_MISSES] += 1
-
-    def numHeaderChangedMisses(self):
-        return self._stats[Statistics.HEADER_CHANGED_MISSES]
-
-    def registerHeaderChangedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.HEADER_CHANGED_MISSES] += 1
-
-    def numSourceChangedMisses(self):
-        return self._stats[Statistics.SOURCE_CHANGED_MISSES]
-
-    def registerSourceChangedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.SOURCE_CHANGED_MISSES] += 1
-
-    def numCacheEntries(self):
-        return self._stats[Statistics.CACHE_ENTRIES]
-
-    def setNumCacheEntries(self, number):
-        self._stats[Statistics.CACHE_ENTRIES] = number
-
-    def registerCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] += 1
-        self._stats[Statistics.CACHE_SIZE] += size
-
-    def unregisterCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] -= 1
-        self._stats[Statistics.CACHE_SIZE] -= size
-
-    def currentCacheSize(self):
-        return self._stats[Statistics.CACHE_SIZE]
-
-    def setCacheSize(self, size):
-        self._stats[Statistics.CACHE_SIZE] = size
-
-    def numCacheHits(self):
-        return self._stats[Statistics.CACHE_HITS]
-
-    def registerCacheHit(self):
-        self._stats[Statistics.CACHE_HITS] += 1
-
-    def numCacheMisses(self):
-        return self._stats[Statistics.CACHE_MISSES]
-
-    def registerCacheMiss(self):
-        self._stats[Statistics.CACHE_MISSES] += 1
-
-    def numCallsForPreprocessing(self):
-        return self._stats[Statistics.CALLS_FOR_PREPROCESSING]
-
-    def registerCallForPreprocessing(self):
-        self._stats[Statistics.CALLS_FOR_PREPROCESSING] += 1
-
-    def resetCounters(self):
-        for k in Statistics.RESETTABLE_KEYS:
-            self._stats[k] = 0
-
-
 class AnalysisError(Exception):
     pass
 
@@ -698,85 +109,6 @@ class InvalidArgumentError(AnalysisError):
     pass
 
 
-def getCompilerHash(compilerBinary):
-    stat = os.stat(compilerBinary)
-    data = '|'.join([
-        str(stat.st_mtime),
-        str(stat.st_size),
-        VERSION,
-        ])
-    hasher = HashAlgorithm()
-    hasher.update(data.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def getFileHash(filePath, additionalData=None):
-    hasher = HashAlgorithm()
-    with open(filePath, 'rb') as inFile:
-        hasher.update(inFile.read())
-    if additionalData is not None:
-        # Encoding of this additional data does not really matter
-        # as long as we keep it fixed, otherwise hashes change.
-        # The string should fit into ASCII, so UTF8 should not change anything
-        hasher.update(additionalData.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def getStringHash(dataString):
-    hasher = HashAlgorithm()
-    hasher.update(dataString.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def expandBasedirPlaceholder(path, baseDir):
-    if path.startswith(BASEDIR_REPLACEMENT):
-        if not baseDir:
-            raise LogicException('No CLCACHE_BASEDIR set, but found relative path ' + path)
-        return path.replace(BASEDIR_REPLACEMENT, baseDir, 1)
-    else:
-        return path
-
-
-def collapseBasedirToPlaceholder(path, baseDir):
-    assert path == os.path.normcase(path)
-    assert baseDir == os.path.normcase(baseDir)
-    if path.startswith(baseDir):
-        return path.replace(baseDir, BASEDIR_REPLACEMENT, 1)
-    else:
-        return path
-
-
-def ensureDirectoryExists(path):
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-
-
-def copyOrLink(srcFilePath, dstFilePath):
-    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
-
-    if "CLCACHE_HARDLINK" in os.environ:
-        ret = windll.kernel32.CreateHardLinkW(str(dstFilePath), str(srcFilePath), None)
-        if ret != 0:
-            # Touch the time stamp of the new link so that the build system
-            # doesn't confused by a potentially old time on the file. The
-            # hard link gets the same timestamp as the cached file.
-            # Note that touching the time stamp of the link also touches
-            # the time stamp on the cache (and hence on all over hard
-            # links). This shouldn't be a problem though.
-            os.utime(dstFilePath, None)
-            return
-
-    # If hardlinking fails for some reason (or it's not enabled), just
-    # fall back to moving bytes around. Always to a temporary path first to
-    # lower the chances of corrupting it.
-    tempDst = dstFilePath + '.tmp'
-    copyfile(srcFilePath, tempDst)
-    os.rename(tempDst, dstFilePath)
-
-
 def myExecutablePath():
     assert hasattr(sys, "frozen"), "is not frozen by py2exe"
     return sys.executable.upper()
@@ -801,120 +133,107 @@ def findCompilerBinary():
     return None
 
 
-def printTraceStatement(msg):
-    if "CLCACHE_LOG" in os.environ:
-        scriptDir = os.path.realpath(os.path.dirname(sys.argv[0]))
-        print(os.path.join(scriptDir, "clcache.py") + " " + msg)
-
-
 class CommandLineTokenizer(object):
+    """ Splits a command line like the Microsoft C runtime: whitespace outside
+    of double quotes separates arguments, 2n backslashes followed by a double
+    quote become n backslashes and the quote starts or ends a quoted part,
+    2n+1 backslashes followed by a double quote become n backslashes and a
+    literal double quote, other backslashes are taken literally. The content
+    is consumed in runs of characters rather than one character at a time. """
+    # A double quote with the backslashes preceding it, a run of other
+    # characters or (outside of double quotes) a run of whitespace
+    _unquotedPart = re.compile(r'(\\*)"|((?:[^"\s\\]+|\\+(?![\\"]))+)|\s+')
+    _quotedPart = re.compile(r'(\\*)"|((?:[^"\\]+|\\+(?![\\"]))+)')
+
     def __init__(self, content):
         self.argv = []
-        self._content = content
-        self._pos = 0
-        self._token = ''
-        self._parser = self._initialState
-
-        while self._pos < len(self._content):
-            self._parser = self._parser(self._content[self._pos])
-            self._pos += 1
-
-        if self._token:
-            self.argv.append(self._token)
-
-    def _initialState(self, currentChar):
-        if currentChar.isspace():
-            return self._initialState
-
-        if currentChar == '"':
-            return self._quotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._unquotedState
-
-        self._token += currentChar
-        return self._unquotedState
-
-    def _unquotedState(self, currentChar):
-        if currentChar.isspace():
-            self.argv.append(self._token)
-            self._token = ''
-            return self._initialState
-
-        if currentChar == '"':
-            return self._quotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._unquotedState
-
-        self._token += currentChar
-        return self._unquotedState
-
-    def _quotedState(self, currentChar):
-        if currentChar == '"':
-            return self._unquotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._quotedState
-
-        self._token += currentChar
-        return self._quotedState
-
-    def _parseBackslash(self):
-        numBackslashes = 0
-        while self._pos < len(self._content) and self._content[self._pos] == '\\':
-            self._pos += 1
-            numBackslashes += 1
-
-        followedByDoubleQuote = self._pos < len(self._content) and self._content[self._pos] == '"'
-        if followedByDoubleQuote:
-            self._token += '\\' * (numBackslashes // 2)
-            if numBackslashes % 2 == 0:
-                self._pos -= 1
-            else:
-                self._token += '"'
-        else:
-            self._token += '\\' * numBackslashes
-            self._pos -= 1
+        token = []
+        inToken = False
+        inQuotes = False
+        pos = 0
+        while pos < len(content):
+            match = (self._quotedPart if inQuotes else self._unquotedPart).match(content, pos)
+            pos = match.end()
+            backslashes, text = match.groups()
+            if backslashes is not None:
+                token.append('\\' * (len(backslashes) // 2))
+                if len(backslashes) % 2 == 1:
+                    token.append('"')
+                else:
+                    inQuotes = not inQuotes
+                inToken = True
+            elif text is not None:
+                token.append(text)
+                inToken = True
+            elif inToken:
+                self.argv.append(''.join(token))
+                token = []
+                inToken = False
+
+        # An empty argument (i.e. "") at the very end is dropped
+        token = ''.join(token)
+        if token:
+            self.argv.append(token)
 
 
 def splitCommandsFile(content):
     return CommandLineTokenizer(content).argv
 
 
+# Maps the absolute path of each response file read by this process to its
+# file stamp and arguments, see readResponseFile()
+responseFilesInMemory = {}
+
+
+def readResponseFile(includeFile):
+    """ Returns the arguments given in a response file. The files generated by
+    build systems are typically shared by many compiler invocations, so a
+    long-lived process (e.g. a clcache server) keeps the arguments in memory as
+    long as size, modification time and file id of the file are unchanged. """
+    includeFile = os.path.abspath(includeFile)
+    with open(includeFile, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        fileStamp = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        inMemory = responseFilesInMemory.get(includeFile)
+        if inMemory is not None and inMemory[0] == fileStamp:
+            return inMemory[1]
+        rawBytes = f.read()
+
+    encoding = None
+
+    bomToEncoding = {
+        codecs.BOM_UTF32_BE: 'utf-32-be',
+        codecs.BOM_UTF32_LE: 'utf-32-le',
+        codecs.BOM_UTF16_BE: 'utf-16-be',
+        codecs.BOM_UTF16_LE: 'utf-16-le',
+    }
+
+    for bom, enc in bomToEncoding.items():
+        if rawBytes.startswith(bom):
+            encoding = enc
+            rawBytes = rawBytes[len(bom):]
+            break
+
+    if encoding:
+        includeFileContents = rawBytes.decode(encoding)
+    else:
+        includeFileContents = rawBytes.decode("UTF-8")
+
+    arguments = tuple(splitCommandsFile(includeFileContents.strip()))
+    if len(responseFilesInMemory) >= MAX_RESPONSE_FILES_IN_MEMORY:
+        responseFilesInMemory.clear()
+    responseFilesInMemory[includeFile] = (fileStamp, arguments)
+    return arguments
+
+
 def expandCommandLine(cmdline):
     ret = []
 
     for arg in cmdline:
         if arg[0] == '@':
-            includeFile = arg[1:]
-            with open(includeFile, 'rb') as f:
-                rawBytes = f.read()
-
-            encoding = None
-
-            bomToEncoding = {
-                codecs.BOM_UTF32_BE: 'utf-32-be',
-                codecs.BOM_UTF32_LE: 'utf-32-le',
-                codecs.BOM_UTF16_BE: 'utf-16-be',
-                codecs.BOM_UTF16_LE: 'utf-16-le',
-            }
-
-            for bom, enc in bomToEncoding.items():
-                if rawBytes.startswith(bom):
-                    encoding = enc
-                    rawBytes = rawBytes[len(bom):]
-                    break
-
-            if encoding:
-                includeFileContents = rawBytes.decode(encoding)
-            else:
-                includeFileContents = rawBytes.decode("UTF-8")
-
-            ret.extend(expandCommandLine(splitCommandsFile(includeFileContents.strip())))
+            # Nested response files are expanded every time, they may have
+            # changed independently
+            ret.extend(expandCommandLine(readResponseFile(arg[1:])))
         else:
             ret.append(arg)
 
@@ -973,30 +292,40 @@ class ArgumentT4(Argument):
     pass
 
 
+def argumentsByFirstCharacter(arguments):
+    """ Indexes the given arguments by the first character of their names.
+    Arguments with the same first character are sorted by length, longest
+    first, to handle prefixes. """
+    index = {}
+    for arg in sorted(arguments, key=len, reverse=True):
+        index.setdefault(arg.name[0], []).append(arg)
+    return index
+
+
 class CommandLineAnalyzer(object):
+    # Built once instead of for every argument on the command line, which
+    # can have hundreds of /I and /D arguments
+    _argumentsWithParameter = argumentsByFirstCharacter([
+        # /NAMEparameter
+        ArgumentT1('Ob'), ArgumentT1('Yl'), ArgumentT1('Zm'),
+        # /NAME[parameter]
+        ArgumentT2('doc'), ArgumentT2('FA'), ArgumentT2('FR'), ArgumentT2('Fr'),
+        ArgumentT2('Gs'), ArgumentT2('MP'), ArgumentT2('Yc'), ArgumentT2('Yu'),
+        ArgumentT2('Zp'), ArgumentT2('Fa'), ArgumentT2('Fd'), ArgumentT2('Fe'),
+        ArgumentT2('Fi'), ArgumentT2('Fm'), ArgumentT2('Fo'), ArgumentT2('Fp'),
+        ArgumentT2('Wv'),
+        # /NAME[ ]parameter
+        ArgumentT3('AI'), ArgumentT3('D'), ArgumentT3('Tc'), ArgumentT3('Tp'),
+        ArgumentT3('FI'), ArgumentT3('U'), ArgumentT3('I'), ArgumentT3('F'),
+        ArgumentT3('FU'), ArgumentT3('w1'), ArgumentT3('w2'), ArgumentT3('w3'),
+        ArgumentT3('w4'), ArgumentT3('wd'), ArgumentT3('we'), ArgumentT3('wo'),
+        ArgumentT3('V'),
+        # /NAME parameter
+    ])
 
     @staticmethod
     def _getParameterizedArgumentType(cmdLineArgument):
-        argumentsWithParameter = {
-            # /NAMEparameter
-            ArgumentT1('Ob'), ArgumentT1('Yl'), ArgumentT1('Zm'),
-            # /NAME[parameter]
-            ArgumentT2('doc'), ArgumentT2('FA'), ArgumentT2('FR'), ArgumentT2('Fr'),
-            ArgumentT2('Gs'), ArgumentT2('MP'), ArgumentT2('Yc'), ArgumentT2('Yu'),
-            ArgumentT2('Zp'), ArgumentT2('Fa'), ArgumentT2('Fd'), ArgumentT2('Fe'),
-            ArgumentT2('Fi'), ArgumentT2('Fm'), ArgumentT2('Fo'), ArgumentT2('Fp'),
-            ArgumentT2('Wv'),
-            # /NAME[ ]parameter
-            ArgumentT3('AI'), ArgumentT3('D'), ArgumentT3('Tc'), ArgumentT3('Tp'),
-            ArgumentT3('FI'), ArgumentT3('U'), ArgumentT3('I'), ArgumentT3('F'),
-            ArgumentT3('FU'), ArgumentT3('w1'), ArgumentT3('w2'), ArgumentT3('w3'),
-            ArgumentT3('w4'), ArgumentT3('wd'), ArgumentT3('we'), ArgumentT3('wo'),
-            ArgumentT3('V'),
-            # /NAME parameter
-        }
-        # Sort by length to handle prefixes
-        argumentsWithParameterSorted = sorted(argumentsWithParameter, key=len, reverse=True)
-        for arg in argumentsWithParameterSorted:
+        for arg in CommandLineAnalyzer._argumentsWithParameter.get(cmdLineArgument[1:2], ()):
             if cmdLineArgument.startswith(arg.name, 1):
                 return arg
         return None
@@ -1096,58 +425,6 @@ class CommandLineAnalyzer(object):
         return inputFiles, objectFile
 
 
-def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None):
-    realCmdline = [compilerBinary] + cmdLine
-    printTraceStatement("Invoking real compiler as {}".format(realCmdline))
-
-    environment = environment or os.environ
-
-    # Environment variable set by the Visual Studio IDE to make cl.exe write
-    # Unicode output to named pipes instead of stdout. Unset it to make sure
-    # we can catch stdout output.
-    environment.pop("VS_UNICODE_OUTPUT", None)
-
-    returnCode = None
-    stdout = b''
-    stderr = b''
-    if captureOutput:
-        compilerProcess = Popen(realCmdline, stdout=PIPE, stderr=PIPE, env=environment)
-        stdout, stderr = compilerProcess.communicate()
-        returnCode = compilerProcess.returncode
-    else:
-        returnCode = subprocess.call(realCmdline, env=environment)
-
-    printTraceStatement("Real compiler returned code {0:d}".format(returnCode))
-
-    if outputAsString:
-        stdoutString = stdout.decode(CL_DEFAULT_CODEC)
-        stderrString = stderr.decode(CL_DEFAULT_CODEC)
-        return returnCode, stdoutString, stderrString
-
-    return returnCode, stdout, stderr
-
-
-# Given a list of Popen objects, removes and returns
-# a completed Popen object.
-#
-# This is a bit inefficient but Python on Windows does not appear to
-# provide any blocking "wait for any process to complete" out of the box.
-def waitForAnyProcess(procs):
-    out = [p for p in procs if p.poll() is not None]
-    if len(out) >= 1:
-        out = out[0]
-        procs.remove(out)
-        return out
-
-    # Damn, none finished yet.
-    # Do a blocking wait for the first one.
-    # This could waste time waiting for one process while others have
-    # already finished :(
-    out = procs.pop(0)
-    out.wait()
-    return out
-
-
 # Returns the amount of jobs which should be run in parallel when
 # invoked in batch mode as determined by the /MP argument
 def jobCount(cmdLine):
@@ -1170,53 +447,176 @@ def jobCount(cmdLine):
         return 2
 
 
-# Run commands, up to j concurrently.
-# Aborts on first failure and returns the first non-zero exit code.
-def runJobs(commands, environment, j=1):
-    running = []
-
-    while len(commands):
-
-        while len(running) > j:
-            thiscode = waitForAnyProcess(running).returncode
-            if thiscode != 0:
-                return thiscode
-
-        thiscmd = commands.pop(0)
-        running.append(Popen(thiscmd, env=environment))
-
-    while len(running) > 0:
-        thiscode = waitForAnyProcess(running).returncode
-        if thiscode != 0:
-            return thiscode
-
-    return 0
-
-
-# re-invoke clcache.py once per source file.
-# Used when called via nmake 'batch mode'.
-# Returns the first non-zero exit code encountered, or 0 if all jobs succeed.
-def reinvokePerSourceFile(cmdLine, sourceFiles, environment):
-    printTraceStatement("Will reinvoke self for: {}".format(sourceFiles))
-    commands = []
-    for sourceFile in sourceFiles:
-        # The child command consists of clcache.py ...
-        newCmdLine = [sys.executable]
-        if not hasattr(sys, "frozen"):
-            newCmdLine.append(sys.argv[0])
-
-        for arg in cmdLine:
-            # and the current source file ...
-            if arg == sourceFile:
-                newCmdLine.append(arg)
-            # and all other arguments which are not a source file
-            elif arg not in sourceFiles:
-                newCmdLine.append(arg)
+# Returns the command line for compiling one of the source files of a command
+# line with multiple source files
+def commandLineForSourceFile(cmdLine, sourceFile, sourceFiles):
+    return [arg for arg in cmdLine if arg == sourceFile or arg not in sourceFiles]
+
+
+# Splits the output of a compiler invocation with multiple source files into
+# the output for each source file: cl.exe prints the name of each source file
+# before its diagnostics and include notes (with /MP, the output of each
+# source file is printed at once). Output preceding the first file name is
+# attributed to the first source file printed. Returns None if the output
+# doesn't mention any of the source files.
+def splitCompilerOutput(output, sourceFiles):
+    sourceFilesByName = {os.path.normcase(os.path.basename(sourceFile)): sourceFile for sourceFile in sourceFiles}
+    outputs = {}
+    leadingLines = []
+    currentLines = leadingLines
+    for line in output.splitlines(True):
+        sourceFile = sourceFilesByName.get(os.path.normcase(line.strip()))
+        if sourceFile is not None and sourceFile not in outputs:
+            currentLines = [] if outputs else leadingLines
+            outputs[sourceFile] = currentLines
+        currentLines.append(line)
+    if not outputs:
+        return None
+    return {sourceFile: ''.join(lines) for sourceFile, lines in outputs.items()}
 
-        printTraceStatement("Child: {}".format(newCmdLine))
-        commands.append(newCmdLine)
 
-    return runJobs(commands, environment, jobCount(cmdLine))
+# Compiles a single source file, returns the compiler result and the number of
+# seconds it took.
+def compileTimed(compiler, cmdLine, sourceFile, environment=None):
+    startTime = time.time()
+    compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True, environment=environment)
+    duration = time.time() - startTime
+    printTraceStatement("Compiling {} took {:.2f}s".format(sourceFile, duration))
+    return compilerResult, duration
+
+
+# Compiles the source files which missed the cache using a single compiler
+# invocation, which keeps /MP such that the compiler runs the compilations in
+# parallel itself; the source files are passed in the given order. misses is a
+# list of tuples of the source file, its object file, its command line and
+# postprocessing as returned by lookUpDirect or lookUpNoDirect. Returns the exit
+# code, the exit code and output of each source file, the compiler's stderr
+# output and the estimated compile duration of each source file.
+def compileMissesTogether(compiler, cmdLine, sourceFiles, misses, environment):
+    missedSourceFiles = [sourceFile for sourceFile, _, _, _ in misses]
+    batchCmdLine = [arg for arg in cmdLine if arg not in sourceFiles] + missedSourceFiles
+    if '/showIncludes' not in batchCmdLine and any('/showIncludes' in jobCmdLine for _, _, jobCmdLine, _ in misses):
+        batchCmdLine.insert(0, '/showIncludes')
+    # If compiling some source file fails, the others succeeded if the
+    # compiler wrote their object files, so none may be left from earlier
+    # builds.
+    staleObjectFiles = set()
+    for _, objectFile, _, _ in misses:
+        try:
+            os.remove(objectFile)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            staleObjectFiles.add(objectFile)
+
+    startTime = time.time()
+    returnCode, stdout, stderr = invokeRealCompiler(
+        compiler, batchCmdLine, captureOutput=True, environment=environment)
+    batchDuration = time.time() - startTime
+    printTraceStatement("Compiling {} source files took {:.2f}s".format(len(misses), batchDuration))
+    # The compile duration of the individual source files is not known; this
+    # assumes that the compiler kept all of its /MP processes busy.
+    compileDuration = batchDuration * min(jobCount(cmdLine), len(misses)) / len(misses)
+    outputs = splitCompilerOutput(stdout, missedSourceFiles)
+    if outputs is None:
+        printTraceStatement("Cannot attribute compiler output to source files, not caching them")
+        return returnCode, [(returnCode, stdout)] + [(returnCode, '')] * (len(misses) - 1), stderr, compileDuration
+
+    def postprocess(miss):
+        sourceFile, objectFile, jobCmdLine, postProcessing = miss
+        output = outputs.get(sourceFile)
+        if output is None:
+            # Not compiled at all, e.g. because the compiler bailed out early
+            return returnCode, ''
+        if '/showIncludes' not in jobCmdLine:
+            # Needed by other source files only
+            _, output = parseIncludesSet(output, sourceFile, True)
+        fileReturnCode = returnCode
+        if returnCode != 0 and objectFile not in staleObjectFiles and os.path.exists(objectFile):
+            fileReturnCode = 0
+        # The stderr output belongs to the whole compiler invocation, so it is
+        # not stored with the cache entries.
+        return postProcessing((fileReturnCode, output, ''), compileDuration)[:2]
+
+    with concurrent.futures.ThreadPoolExecutor(min(len(misses), MULTIPLE_SOURCES_LOOKUP_THREADS)) as executor:
+        return returnCode, list(executor.map(postprocess, misses)), stderr, compileDuration
+
+
+# Handles an invocation with multiple source files (e.g. nmake batch mode or
+# /MP) in this process: the cache entries of all source files are looked up
+# concurrently, then the source files which missed the cache are compiled
+# using a single compiler invocation. If the output of that could not be
+# attributed to the source files (because several source files have the same
+# name), they are compiled separately by exactly jobCount(cmdLine) compiler
+# processes at once (as long as there are enough source files) instead. In
+# both cases, the source files which took longest to compile the last time are
+# compiled first, such that no slow source file is left for the end. The output
+# is returned in the order of the source files; the exit code is the first
+# non-zero exit code, if any.
+def processMultipleSourceFiles(cache, compiler, cmdLine, sourceFiles, environment):
+    printTraceStatement("Processing source files {} in parallel".format(sourceFiles))
+    lookups = lookUpSourceFiles(cache, compiler, cmdLine, sourceFiles, environment)
+
+    results = [compilerResult for _, _, compilerResult, _, _ in lookups]
+    misses = [i for i, compilerResult in enumerate(results) if compilerResult is None]
+    # Source files never compiled before come first, their duration is unknown
+    durations = cache.compileDurations.durations([lookups[i][0] for i in misses])
+    misses.sort(key=lambda i: -durations.get(lookups[i][0], float('inf')))
+    missedJobs = [lookups[i][:2] + lookups[i][3:] for i in misses]
+    missedNames = {os.path.normcase(os.path.basename(sourceFile)) for sourceFile, _, _, _ in missedJobs}
+    printTraceStatement("Compiling {} of {} source files".format(len(misses), len(lookups)))
+    batchReturnCode, batchStderr = 0, ''
+    if len(misses) > 1 and len(missedNames) == len(misses):
+        batchReturnCode, outputs, batchStderr, compileDuration = compileMissesTogether(
+            compiler, cmdLine, sourceFiles, missedJobs, environment)
+        for i, (returnCode, output) in zip(misses, outputs):
+            results[i] = returnCode, output, ''
+        # The duration of each source file of a batch is not observable, so
+        # the estimate must not replace durations measured before
+        cache.compileDurations.record({sourceFile: compileDuration
+                                       for sourceFile, _, _, _ in missedJobs if sourceFile not in durations})
+    elif misses:
+        for i, compilerResult in zip(misses, compileMissesSeparately(
+                cache, compiler, missedJobs, jobCount(cmdLine), environment)):
+            results[i] = compilerResult
+
+    exitCode = next((returnCode for returnCode, _, _ in results if returnCode != 0), batchReturnCode)
+    return (exitCode,
+            ''.join(stdout for _, stdout, _ in results),
+            ''.join(stderr for _, _, stderr in results) + batchStderr)
+
+
+# Looks up the cache entries of the source files of a command line with
+# multiple source files concurrently. Returns a tuple for each source file:
+# the source file, its object file and the compiler result, command line and
+# postprocessing as returned by lookUpDirect or lookUpNoDirect.
+def lookUpSourceFiles(cache, compiler, cmdLine, sourceFiles, environment):
+    def lookUp(sourceFile):
+        jobCmdLine = commandLineForSourceFile(cmdLine, sourceFile, sourceFiles)
+        _, objectFile = CommandLineAnalyzer.analyze(jobCmdLine)
+        if 'CLCACHE_NODIRECT' in os.environ:
+            return (sourceFile, objectFile) + lookUpNoDirect(cache, objectFile, compiler, jobCmdLine, environment)
+        return (sourceFile, objectFile) + lookUpDirect(cache, objectFile, compiler, jobCmdLine, sourceFile)
+
+    with concurrent.futures.ThreadPoolExecutor(min(len(sourceFiles), MULTIPLE_SOURCES_LOOKUP_THREADS)) as executor:
+        return list(executor.map(lookUp, sourceFiles))
+
+
+# Compiles the source files which missed the cache (given like for
+# compileMissesTogether) separately, running the given number of compiler
+# processes at once. The executor starts the compilations in the order of the
+# misses whenever one of its threads becomes idle. Returns the compiler result
+# of each source file.
+def compileMissesSeparately(cache, compiler, misses, jobs, environment):
+    def compileMiss(miss):
+        sourceFile, _, jobCmdLine, postProcessing = miss
+        compilerResult, duration = compileTimed(compiler, jobCmdLine, sourceFile, environment)
+        return postProcessing(compilerResult, duration), duration
+
+    with concurrent.futures.ThreadPoolExecutor(min(len(misses), jobs)) as executor:
+        compiled = list(executor.map(compileMiss, misses))
+    cache.compileDurations.record({miss[0]: duration for miss, (_, duration) in zip(misses, compiled)})
+    return [compilerResult for compilerResult, _ in compiled]
 
 
 def printStatistics(cache):
@@ -1226,12 +626,22 @@ clcache statistics:
   cache size                : {:,} bytes
   maximum cache size        : {:,} bytes
   cache entries             : {}
-  cache hits                : {}
+  cache hits
+    total                      : {}
+    from local cache           : {}
+    from remote cache          : {}
+    compile time saved         : {:.1f} s
   cache misses
     total                      : {}
     evicted                    : {}
     header changed             : {}
     source changed             : {}
+  header hashes
+    from index                 : {}
+    rehashed                   : {}
+  objects added to cache
+    size                       : {:,} bytes
+    stored size                : {:,} bytes
   passed to real compiler
     called w/ invalid argument : {}
     called for preprocessing   : {}
@@ -1242,16 +652,28 @@ clcache statistics:
     called w/ PCH              : {}""".strip()
 
     with cache.statistics as stats, cache.configuration as cfg:
+        if cache.shared:
+            # The statistics of a shared cache only cover this machine
+            cacheSize, cacheEntries = cache.indexedSize()
+        else:
+            cacheSize, cacheEntries = stats.currentCacheSize(), stats.numCacheEntries()
         print(template.format(
             cache.cacheDirectory(),
-            stats.currentCacheSize(),
+            cacheSize,
             cfg.maximumCacheSize(),
-            stats.numCacheEntries(),
+            cacheEntries,
             stats.numCacheHits(),
+            stats.numCacheHits() - stats.numRemoteCacheHits(),
+            stats.numRemoteCacheHits(),
+            stats.compileTimeSaved(),
             stats.numCacheMisses(),
             stats.numEvictedMisses(),
             stats.numHeaderChangedMisses(),
             stats.numSourceChangedMisses(),
+            stats.numHeaderHashIndexHits(),
+            stats.numHeaderRehashes(),
+            stats.addedObjectsSize(),
+            stats.addedObjectsStoredSize(),
             stats.numCallsWithInvalidArgument(),
             stats.numCallsForPreprocessing(),
             stats.numCallsForLinking(),
@@ -1272,11 +694,39 @@ def cleanCache(cache):
         cache.clean(stats, cfg.maximumCacheSize())
 
 
+def cleanSharedCache(cache):
+    """ Cleans a cache shared by several machines. Only one machine, the
+    designated cleaner, cleans such a cache: other processes trying to clean it
+    at the same time fail to acquire the cleaner lock. """
+    with CacheFileLock(os.path.join(cache.cacheDirectory(), "cleaner.lock"), 0):
+        with cache.configuration as cfg:
+            maximumSize = cfg.maximumCacheSize()
+        if cache.indexedSize()[0] >= maximumSize:
+            cache.cleanIncrementally(maximumSize)
+
+
+def cleanCacheInBackground(cache):
+    try:
+        with cache.configuration as cfg:
+            maximumSize = cfg.maximumCacheSize()
+        cache.cleanIncrementally(maximumSize)
+    finally:
+        try:
+            os.remove(cleanupRequestPath(cache))
+        except OSError:
+            pass
+
+
 def clearCache(cache):
     with cache.statistics as stats:
         cache.clean(stats, 0)
 
 
+def rebuildIndex(cache):
+    with cache.statistics as stats:
+        cache.rebuildIndex(stats)
+
+
 # Returns pair:
 #   1. set of include filepaths
 #   2. new compiler output
@@ -1316,162 +766,527 @@ def parseIncludesSet(compilerOutput, sourceFile, strip):
         return includesSet, compilerOutput
 
 
+# Returns True if the cache grew too large and needs to be cleaned. Cleaning
+# takes section locks, so it must be done after releasing the section locks.
 def addObjectToCache(stats, cache, cachekey, artifacts):
     printTraceStatement("Adding file {} to cache using key {}".format(artifacts.objectFilePath, cachekey))
-    cache.compilerArtifactsRepository.section(cachekey).setEntry(cachekey, artifacts)
-    stats.registerCacheEntry(os.path.getsize(artifacts.objectFilePath))
     with cache.configuration as cfg:
-        cache.clean(stats, cfg.maximumCacheSize())
-
-
-def processCacheHit(cache, objectFile, cachekey):
-    with cache.statistics as stats:
-        stats.registerCacheHit()
+        compression, compressionLevel = cfg.compression(), cfg.compressionLevel()
+        packed = cfg.packFiles()
+        maximumCacheSize = cfg.maximumCacheSize()
+    storedSize = cache.compilerArtifactsRepository.section(cachekey).setEntry(
+        cachekey, artifacts, compression, compressionLevel, packed)
+    stats.registerCacheEntry(storedSize)
+    stats.registerAddedObject(os.path.getsize(artifacts.objectFilePath), storedSize)
+    return stats.currentCacheSize() >= maximumCacheSize
+
+
+# Returns None if the cache entry turned out to be damaged (it is removed then)
+# or was removed by the cleaner of a shared cache in the meantime; the source
+# file needs to be compiled then. Requires holding the read lock of the section
+# of the entry.
+def processCacheHit(cache, objectFile, cachekey, fromRemote=False):
     printTraceStatement("Reusing cached object for key {} for object file {}".format(cachekey, objectFile))
     if os.path.exists(objectFile):
         os.remove(objectFile)
     section = cache.compilerArtifactsRepository.section(cachekey)
-    cachedArtifacts = section.getEntry(cachekey)
-    copyOrLink(cachedArtifacts.objectFilePath, objectFile)
+    try:
+        cachedArtifacts = section.restoreEntry(cachekey, objectFile)
+    except CorruptCacheEntryException as e:
+        printTraceStatement("Removing damaged cache entry: {}".format(e))
+        with section.lock:
+            blobHash = section.index.entries().get(cachekey, [None] * 4)[3]
+            freedSize = section.removeEntry(cachekey)
+        if blobHash is not None:
+            cache.compilerArtifactsRepository.collectGarbage([blobHash])
+        with cache.statistics as stats:
+            stats.unregisterCacheEntry(freedSize)
+        return None
+    except FileNotFoundError:
+        printTraceStatement("Cache entry {} was removed in the meantime".format(cachekey))
+        return None
+    with cache.statistics as stats:
+        stats.registerCacheHit()
+        if fromRemote:
+            stats.registerRemoteCacheHit()
+        if cachedArtifacts.compileDuration is not None:
+            stats.registerCompileTimeSaved(cachedArtifacts.compileDuration)
+    section.touchEntry(cachekey)
     printTraceStatement("Finished. Exit code 0")
     return 0, cachedArtifacts.stdout, cachedArtifacts.stderr
 
 
-def postprocessObjectEvicted(cache, objectFile, cachekey, compilerResult):
+# Returns None on a cache miss. Entries missing in the local cache are copied
+# from the remote cache, if any.
+def lookUpCacheEntry(cache, objectFile, cachekey):
+    section = cache.compilerArtifactsRepository.section(cachekey)
+    with section.readLock:
+        if section.hasEntry(cachekey):
+            compilerResult = processCacheHit(cache, objectFile, cachekey)
+            if compilerResult is not None:
+                return compilerResult
+
+    storedSize = section.fetchEntry(cachekey)
+    if storedSize is None:
+        return None
+    with cache.configuration as cfg:
+        maximumCacheSize = cfg.maximumCacheSize()
+    with cache.statistics as stats:
+        stats.registerCacheEntry(storedSize)
+        cleanupRequired = stats.currentCacheSize() >= maximumCacheSize
+    with section.readLock:
+        compilerResult = processCacheHit(cache, objectFile, cachekey, fromRemote=True) \
+            if section.hasEntry(cachekey) else None
+    if cleanupRequired:
+        scheduleCleanup(cache)
+    return compilerResult
+
+
+def postprocessObjectEvicted(cache, objectFile, cachekey, compilerResult, compileDuration=None):
     printTraceStatement("Cached object already evicted for key {} for object {}".format(cachekey, objectFile))
     returnCode, compilerOutput, compilerStderr = compilerResult
 
-    with cache.lock, cache.statistics as stats:
+    cleanupRequired = False
+    section = cache.compilerArtifactsRepository.section(cachekey)
+    with section.lock, cache.statistics as stats:
         stats.registerEvictedMiss()
         if returnCode == 0 and os.path.exists(objectFile):
-            addObjectToCache(stats, cache, cachekey, CompilerArtifacts(objectFile, compilerOutput, compilerStderr))
+            cleanupRequired = addObjectToCache(
+                stats, cache, cachekey,
+                CompilerArtifacts(objectFile, compilerOutput, compilerStderr, compileDuration))
+
+    if cleanupRequired:
+        scheduleCleanup(cache)
 
     return compilerResult
 
 
-def createManifest(manifestHash, includePaths):
+def createManifestEntry(manifestHash, includePaths):
     baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
 
     includes = {path:getFileHash(path) for path in includePaths}
-    includesContentHash = ManifestRepository.getIncludesContentHashForFiles(includes)
+    fingerprints = ManifestRepository.getIncludeFingerprints(includes.keys())
+    includesContentHash = ManifestRepository.getIncludesContentHashForHashes(
+        [includes[path] for path in sorted(includes.keys())])
     cachekey = CompilerArtifactsRepository.computeKeyDirect(manifestHash, includesContentHash)
 
-    # Create new manifest
     if baseDir:
         relocatableIncludePaths = {
             collapseBasedirToPlaceholder(path, baseDir):contentHash
             for path, contentHash in includes.items()
         }
-        manifest = Manifest(relocatableIncludePaths, {})
-    else:
-        manifest = Manifest(includes, {})
-    manifest.includesContentToObjectMap[includesContentHash] = cachekey
-    return manifest, cachekey
+        relocatableFingerprints = {
+            collapseBasedirToPlaceholder(path, baseDir):fingerprint
+            for path, fingerprint in fingerprints.items()
+        }
+        return ManifestEntry(relocatableIncludePaths, relocatableFingerprints, includesContentHash, cachekey)
+    return ManifestEntry(includes, fingerprints, includesContentHash, cachekey)
+
+
+# Adds entry to the manifest, keeping the entries for other include sets.
+# Requires holding the lock of the manifest section.
+def addManifestEntry(manifestSection, manifestHash, entry):
+    existingManifest = manifestSection.getManifest(manifestHash)
+    manifest = existingManifest.copy() if existingManifest is not None else Manifest()
+    manifest.addEntry(entry)
+    manifestSection.setManifest(manifestHash, manifest)
+    manifestSection.uploadManifest(manifestHash, manifest)
 
 
 def postprocessHeaderChangedMiss(
-        cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes):
+        cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes,
+        compileDuration=None):
     returnCode, compilerOutput, compilerStderr = compilerResult
     includePaths, compilerOutput = parseIncludesSet(compilerOutput, sourceFile, stripIncludes)
 
+    cleanupRequired = False
     if returnCode == 0 and os.path.exists(objectFile):
-        manifest, cachekey = createManifest(manifestHash, includePaths)
+        entry = createManifestEntry(manifestHash, includePaths)
+        artifactsSection = cache.compilerArtifactsRepository.section(entry.objectHash)
+        with manifestSection.lock, artifactsSection.lock, cache.statistics as stats:
+            stats.registerHeaderChangedMiss()
+            cleanupRequired = addObjectToCache(
+                stats, cache, entry.objectHash,
+                CompilerArtifacts(objectFile, compilerOutput, compilerStderr, compileDuration))
+            addManifestEntry(manifestSection, manifestHash, entry)
+    else:
+        updateCacheStatistics(cache, Statistics.registerHeaderChangedMiss)
 
-    with cache.lock, cache.statistics as stats:
-        stats.registerHeaderChangedMiss()
-        if returnCode == 0 and os.path.exists(objectFile):
-            addObjectToCache(stats, cache, cachekey, CompilerArtifacts(objectFile, compilerOutput, compilerStderr))
-            manifestSection.setManifest(manifestHash, manifest)
+    if cleanupRequired:
+        scheduleCleanup(cache)
 
     return returnCode, compilerOutput, compilerStderr
 
 
 def postprocessNoManifestMiss(
-        cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes):
+        cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes,
+        compileDuration=None):
     returnCode, compilerOutput, compilerStderr = compilerResult
     includePaths, compilerOutput = parseIncludesSet(compilerOutput, sourceFile, stripIncludes)
 
-    manifest = None
-    cachekey = None
-
+    cleanupRequired = False
     if returnCode == 0 and os.path.exists(objectFile):
-        manifest, cachekey = createManifest(manifestHash, includePaths)
-
-    with cache.lock, cache.statistics as stats:
-        stats.registerSourceChangedMiss()
-        if returnCode == 0 and os.path.exists(objectFile):
+        entry = createManifestEntry(manifestHash, includePaths)
+        artifactsSection = cache.compilerArtifactsRepository.section(entry.objectHash)
+        with manifestSection.lock, artifactsSection.lock, cache.statistics as stats:
+            stats.registerSourceChangedMiss()
             # Store compile output and manifest
-            addObjectToCache(stats, cache, cachekey, CompilerArtifacts(objectFile, compilerOutput, compilerStderr))
-            manifestSection.setManifest(manifestHash, manifest)
+            cleanupRequired = addObjectToCache(
+                stats, cache, entry.objectHash,
+                CompilerArtifacts(objectFile, compilerOutput, compilerStderr, compileDuration))
+            addManifestEntry(manifestSection, manifestHash, entry)
+    else:
+        updateCacheStatistics(cache, Statistics.registerSourceChangedMiss)
+
+    if cleanupRequired:
+        scheduleCleanup(cache)
 
     return returnCode, compilerOutput, compilerStderr
 
 
+def serverAddress(cacheDirectory):
+    name = 'clcache-' + getStringHash(os.path.normcase(os.path.abspath(cacheDirectory)))
+    if os.name == 'nt':
+        return r'\\.\pipe\{}'.format(name), 'AF_PIPE'
+    return os.path.join(tempfile.gettempdir(), name + '.sock'), 'AF_UNIX'
+
+
+def serverKeyPath(cacheDirectory):
+    return os.path.join(cacheDirectory, 'server.key')
+
+
+def sendToServer(cacheDirectory, request):
+    try:
+        with open(serverKeyPath(cacheDirectory), 'rb') as f:
+            authkey = f.read()
+        address, family = serverAddress(cacheDirectory)
+        connection = Client(address, family, authkey=authkey)
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+        return None
+
+    try:
+        connection.send(request)
+        return connection.recv()
+    except (OSError, EOFError):
+        return None
+    finally:
+        connection.close()
+
+
+# Forwards a compiler invocation to a clcache server serving the given cache
+# directory. Returns None if no server is running; the caller is expected to
+# process the request itself then.
+def forwardToServer(cacheDirectory, argv, cwd, environment):
+    response = sendToServer(cacheDirectory, {
+        'command': 'compile',
+        'argv': argv,
+        'cwd': cwd,
+        'environment': environment,
+    })
+    if response is None:
+        return None
+    return response['exitCode'], response['stdout'], response['stderr']
+
+
+def stopServer(cacheDirectory):
+    return sendToServer(cacheDirectory, {'command': 'shutdown'}) is not None
+
+
+def initializeServerWorker(cacheDirectory):
+    ServerWorker.cache = Cache(cacheDirectory)
+
+
+# Runs a compiler invocation in a server worker process. Each worker processes
+# only one request at a time, so it is safe to adopt the working directory and
+# environment of the client for the duration of the request.
+def processServerRequest(argv, cwd, environment):
+    savedCwd = os.getcwd()
+    savedEnvironment = dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(environment)
+    # Child processes (e.g. for multiple source files) must not be forwarded
+    # to the server again, all workers might be busy.
+    os.environ.pop('CLCACHE_SERVER', None)
+
+    try:
+        with tempfile.TemporaryFile() as stdoutFile, tempfile.TemporaryFile() as stderrFile:
+            exitCode = runWithRedirectedOutput(
+                lambda: handleCompileRequest(ServerWorker.cache, argv), stdoutFile, stderrFile)
+            stdoutFile.seek(0)
+            stderrFile.seek(0)
+            return {'exitCode': exitCode, 'stdout': stdoutFile.read(), 'stderr': stderrFile.read()}
+    finally:
+        os.chdir(savedCwd)
+        os.environ.clear()
+        os.environ.update(savedEnvironment)
+
+
+# Redirects the standard output and error streams on file descriptor level,
+# such that the output of child processes (i.e. the real compiler) is captured
+# as well.
+def runWithRedirectedOutput(function, stdoutFile, stderrFile):
+    savedStreams = sys.stdout, sys.stderr
+    savedDescriptors = os.dup(1), os.dup(2)
+    for stream in savedStreams:
+        stream.flush()
+    os.dup2(stdoutFile.fileno(), 1)
+    os.dup2(stderrFile.fileno(), 2)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+    try:
+        return function()
+    except SystemExit as e:
+        return e.code
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = savedStreams
+        os.dup2(savedDescriptors[0], 1)
+        os.dup2(savedDescriptors[1], 2)
+        os.close(savedDescriptors[0])
+        os.close(savedDescriptors[1])
+
+
+class CompileServer(object):
+    def __init__(self, cacheDirectory, workers=None):
+        self._cacheDirectory = cacheDirectory
+        self._workers = workers or multiprocessing.cpu_count()
+
+    def serveForever(self):
+        ensureDirectoryExists(self._cacheDirectory)
+        authkey = os.urandom(32)
+        address, family = serverAddress(self._cacheDirectory)
+        if family == 'AF_UNIX' and os.path.exists(address):
+            # Left behind by a server which was not shut down properly
+            os.remove(address)
+        listener = Listener(address, family, authkey=authkey)
+
+        keyPath = serverKeyPath(self._cacheDirectory)
+        writeFileAtomically(keyPath, authkey)
+
+        pool = multiprocessing.Pool(self._workers, initializeServerWorker, (self._cacheDirectory,))
+        stopCleaning = threading.Event()
+        cleaner = threading.Thread(target=self._cleanPeriodically, args=(stopCleaning,))
+        cleaner.daemon = True
+        cleaner.start()
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                    request = connection.recv()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    continue
+
+                if request['command'] == 'shutdown':
+                    connection.send({})
+                    connection.close()
+                    break
+
+                thread = threading.Thread(target=self._processRequest, args=(pool, connection, request))
+                thread.daemon = True
+                thread.start()
+        finally:
+            stopCleaning.set()
+            os.remove(keyPath)
+            listener.close()
+            pool.terminate()
+            pool.join()
+
+    def _cleanPeriodically(self, stopCleaning):
+        cache = Cache(self._cacheDirectory)
+        if cache.shared:
+            # See cleanSharedCache()
+            return
+        while not stopCleaning.wait(SERVER_CLEANUP_INTERVAL):
+            try:
+                with cache.statistics as stats, cache.configuration as cfg:
+                    maximumSize = cfg.maximumCacheSize()
+                    cleanupRequired = stats.currentCacheSize() >= maximumSize
+                if cleanupRequired:
+                    cache.cleanIncrementally(maximumSize)
+            except (CacheLockException, OSError) as e:
+                printTraceStatement("Failed to clean cache: {}".format(e))
+
+    @staticmethod
+    def _processRequest(pool, connection, request):
+        try:
+            response = pool.apply(processServerRequest,
+                                  (request['argv'], request['cwd'], request['environment']))
+            connection.send(response)
+        except (OSError, EOFError):
+            # Client went away
+            pass
+        finally:
+            connection.close()
+
+
 def main():
     if len(sys.argv) == 2 and sys.argv[1] == "--help":
         print("""
 clcache.py v{}
-  --help    : show this help
-  -s        : print cache statistics
-  -c        : clean cache
-  -C        : clear cache
-  -z        : reset cache statistics
-  -M <size> : set maximum cache size (in bytes)
+  --help              : show this help
+  -s                  : print cache statistics
+  -c                  : clean cache
+  -C                  : clear cache
+  -z                  : reset cache statistics
+  -M <size>           : set maximum cache size (in bytes)
+  --compression <c>   : set compression of new cache entries, one of none,
+                        zlib[:<level>] and lzma[:<level>] (level 0-9)
+  --pack-files <x>    : store new cache entries in pack files (on or off)
+  --shared <x>        : use the cache from several machines (on or off)
+  --eviction-policy <p> : evict least recently used entries first (lru) or
+                        take compile time and size into account (cost)
+  --rebuild-index     : rebuild the cache index from the files in the cache
+  --server            : run a server process handling compiler invocations
+  --stop-server       : stop the server process
 """.strip().format(VERSION))
         return 0
 
+    if len(sys.argv) == 2 and sys.argv[1] == "--stop-server":
+        if not stopServer(defaultCacheDirectory()):
+            print("No clcache server running", file=sys.stderr)
+            return 1
+        print('Server stopped')
+        return 0
+
+    isConfigurationCommand = len(sys.argv) == 3 and sys.argv[1] in ("-M", "--compression", "--pack-files",
+                                                                     "--shared", "--eviction-policy")
+    isCacheCommand = isConfigurationCommand or \
+        (len(sys.argv) == 2 and sys.argv[1] in ("-s", "-c", "-C", "-z", "--rebuild-index", "--server",
+                                                "--clean-background"))
+    if "CLCACHE_SERVER" in os.environ and not isCacheCommand:
+        response = forwardToServer(defaultCacheDirectory(), sys.argv, os.getcwd(), dict(os.environ))
+        if response is not None:
+            exitCode, compilerStdout, compilerStderr = response
+            printBinary(sys.stdout, compilerStdout)
+            printBinary(sys.stderr, compilerStderr)
+            return exitCode
+        printTraceStatement("No clcache server running, processing invocation in this process")
+
     cache = Cache()
 
+    if len(sys.argv) == 2 and sys.argv[1] == "--server":
+        print("clcache server running for cache directory {}".format(cache.cacheDirectory()))
+        sys.stdout.flush()
+        try:
+            CompileServer(cache.cacheDirectory()).serveForever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
     if len(sys.argv) == 2 and sys.argv[1] == "-s":
-        with cache.lock:
-            printStatistics(cache)
+        printStatistics(cache)
         return 0
 
     if len(sys.argv) == 2 and sys.argv[1] == "-c":
-        with cache.lock:
-            cleanCache(cache)
+        if cache.shared:
+            try:
+                cleanSharedCache(cache)
+            except CacheLockException:
+                print("The shared cache is being cleaned by another process", file=sys.stderr)
+                return 1
+        else:
+            with cache.lock:
+                cleanCache(cache)
         print('Cache cleaned')
         return 0
 
+    # Used internally to clean the cache in a detached process
+    if len(sys.argv) == 2 and sys.argv[1] == "--clean-background":
+        cleanCacheInBackground(cache)
+        return 0
+
     if len(sys.argv) == 2 and sys.argv[1] == "-C":
         with cache.lock:
             clearCache(cache)
         print('Cache cleared')
         return 0
 
-    if len(sys.argv) == 2 and sys.argv[1] == "-z":
+    if len(sys.argv) == 2 and sys.argv[1] == "--rebuild-index":
         with cache.lock:
+            rebuildIndex(cache)
+        print('Cache index rebuilt')
+        return 0
+
+    if len(sys.argv) == 2 and sys.argv[1] == "-z":
+        with cache.statistics.lock:
             resetStatistics(cache)
         print('Statistics reset')
         return 0
 
-    if len(sys.argv) == 3 and sys.argv[1] == "-M":
-        arg = sys.argv[2]
+    if isConfigurationCommand:
+        return configureCache(cache, sys.argv[1], sys.argv[2])
+
+    exitCode = handleCompileRequest(cache, sys.argv)
+    if cache.remote is not None:
+        # New cache entries are uploaded in the background while the compiler
+        # output is printed, but the uploads must finish before exiting.
+        cache.remote.flush()
+    return exitCode
+
+
+def configureCache(cache, option, value):
+    """ Handles the command line options changing the configuration of the
+    cache; returns the exit code. """
+    if option == "-M":
         try:
-            maxSizeValue = int(arg)
+            maxSizeValue = int(value)
         except ValueError:
-            print("Given max size argument is not a valid integer: '{}'.".format(arg), file=sys.stderr)
+            print("Given max size argument is not a valid integer: '{}'.".format(value), file=sys.stderr)
             return 1
         if maxSizeValue < 1:
             print("Max size argument must be greater than 0.", file=sys.stderr)
             return 1
+        update = lambda cfg: cfg.setMaximumCacheSize(maxSizeValue)
+    elif option == "--compression":
+        compression, _, level = value.partition(':')
+        if compression not in ["none"] + sorted(OBJECT_COMPRESSIONS):
+            print("Unsupported compression: '{}'.".format(compression), file=sys.stderr)
+            return 1
+        try:
+            levelValue = int(level) if level else 6
+        except ValueError:
+            levelValue = -1
+        if not 0 <= levelValue <= 9:
+            print("Compression level must be in the range 0-9.", file=sys.stderr)
+            return 1
+        update = lambda cfg: cfg.setCompression(compression, levelValue)
+    elif option == "--pack-files":
+        if value not in ("on", "off"):
+            print("Pack files must be either 'on' or 'off'.", file=sys.stderr)
+            return 1
+        update = lambda cfg: cfg.setPackFiles(value == "on")
+    elif option == "--shared":
+        if value not in ("on", "off"):
+            print("Shared mode must be either 'on' or 'off'.", file=sys.stderr)
+            return 1
+        update = lambda cfg: cfg.setShared(value == "on")
+    else:
+        assert option == "--eviction-policy"
+        if value not in ("lru", "cost"):
+            print("Eviction policy must be either 'lru' or 'cost'.", file=sys.stderr)
+            return 1
+        update = lambda cfg: cfg.setEvictionPolicy(value)
 
-        with cache.lock, cache.configuration as cfg:
-            cfg.setMaximumCacheSize(maxSizeValue)
-        return 0
+    with cache.lock, cache.configuration as cfg:
+        update(cfg)
+    return 0
 
+
+def handleCompileRequest(cache, argv):
     compiler = findCompilerBinary()
     if not compiler:
         print("Failed to locate cl.exe on PATH (and CLCACHE_CL is not set), aborting.")
         return 1
 
     printTraceStatement("Found real compiler binary at '{0!s}'".format(compiler))
-    printTraceStatement("Arguments we care about: '{}'".format(sys.argv))
+    printTraceStatement("Arguments we care about: '{}'".format(argv))
 
     if "CLCACHE_DISABLE" in os.environ:
-        return invokeRealCompiler(compiler, sys.argv[1:])[0]
+        return invokeRealCompiler(compiler, argv[1:])[0]
     try:
-        exitCode, compilerStdout, compilerStderr = processCompileRequest(cache, compiler, sys.argv)
+        exitCode, compilerStdout, compilerStderr = processCompileRequest(cache, compiler, argv)
         printBinary(sys.stdout, compilerStdout.encode(CL_DEFAULT_CODEC))
         printBinary(sys.stderr, compilerStderr.encode(CL_DEFAULT_CODEC))
         return exitCode
@@ -1481,7 +1296,8 @@ clcache.py v{}
 
 
 def updateCacheStatistics(cache, method):
-    with cache.lock, cache.statistics as stats:
+    # Registering events does not require the statistics lock
+    with cache.statistics as stats:
         method(stats)
 
 
@@ -1496,11 +1312,11 @@ def processCompileRequest(cache, compiler, args):
         sourceFiles, objectFile = CommandLineAnalyzer.analyze(cmdLine)
 
         if len(sourceFiles) > 1:
-            return reinvokePerSourceFile(cmdLine, sourceFiles, environment), '', ''
+            return processMultipleSourceFiles(cache, compiler, cmdLine, sourceFiles, environment)
         else:
             assert objectFile is not None
             if 'CLCACHE_NODIRECT' in os.environ:
-                compilerResult = processNoDirect(cache, objectFile, compiler, cmdLine, environment)
+                compilerResult = processNoDirect(cache, objectFile, compiler, cmdLine, sourceFiles[0], environment)
             else:
                 compilerResult = processDirect(cache, objectFile, compiler, cmdLine, sourceFiles[0])
             printTraceStatement("Finished. Exit code {0:d}".format(compilerResult[0]))
@@ -1532,39 +1348,84 @@ def processCompileRequest(cache, compiler, args):
     return invokeRealCompiler(compiler, args[1:])
 
 
-def processDirect(cache, objectFile, compiler, cmdLine, sourceFile):
+# Returns the index and object hash of the first unchanged manifest entry, or (0, None).
+def matchManifestEntry(cache, manifest):
     baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
+    # Hashing the includes is the expensive part of the lookup, it is
+    # done without holding any lock.
+    with cache.fileHashIndex as hashIndex:
+        try:
+            for entryIndex, entry in enumerate(manifest.iterEntries()):
+                try:
+                    includesContentHash = ManifestRepository.getIncludesContentHashForFiles({
+                        expandBasedirPlaceholder(path, baseDir):contentHash
+                        for path, contentHash in entry.includeFiles.items()
+                    }, hashIndex, {
+                        expandBasedirPlaceholder(path, baseDir):fingerprint
+                        for path, fingerprint in entry.includeFingerprints.items()
+                    })
+                except (IncludeChangedException, IncludeNotFoundException):
+                    # Try the include sets the source file was compiled
+                    # with before, e.g. on another branch
+                    continue
+                assert includesContentHash == entry.includesContentHash
+                return entryIndex, entry.objectHash
+        except ValueError as e:
+            # The entries are decoded without holding the lock of the section,
+            # the path table may have been compacted in the meantime
+            printTraceStatement("Cannot decode manifest: {}".format(e))
+        finally:
+            hits, rehashes = hashIndex.takeCounts()
+            with cache.statistics as stats:
+                stats.registerHeaderHashIndexHits(hits)
+                stats.registerHeaderRehashes(rehashes)
+    return 0, None
+
+
+# Looks up the cache entry of a source file in direct mode. Returns the compiler
+# result on a cache hit. On a cache miss, returns None, the command line to
+# compile the source file with and a function which takes the compiler result
+# and the compile duration and adds it to the cache.
+def lookUpDirect(cache, objectFile, compiler, cmdLine, sourceFile):
     manifestHash = ManifestRepository.getManifestHash(compiler, cmdLine, sourceFile)
     manifestSection = cache.manifestRepository.section(manifestHash)
-    with cache.lock:
-        createNewManifest = False
+    with manifestSection.readLock:
         manifest = manifestSection.getManifest(manifestHash)
         if manifest is not None:
-            # NOTE: command line options already included in hash for manifest name
-            try:
-                includesContentHash = ManifestRepository.getIncludesContentHashForFiles({
-                    expandBasedirPlaceholder(path, baseDir):contentHash
-                    for path, contentHash in manifest.includeFiles.items()
-                })
-
-                cachekey = manifest.includesContentToObjectMap.get(includesContentHash)
-                assert cachekey is not None
-                if cache.compilerArtifactsRepository.section(cachekey).hasEntry(cachekey):
-                    return processCacheHit(cache, objectFile, cachekey)
-                else:
-                    postProcessing = lambda compilerResult: postprocessObjectEvicted(
-                        cache, objectFile, cachekey, compilerResult)
-            except IncludeChangedException:
-                createNewManifest = True
-                postProcessing = lambda compilerResult: postprocessHeaderChangedMiss(
-                    cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes)
-            except IncludeNotFoundException:
-                # register nothing. This is probably just a compile error
-                postProcessing = None
+            manifestSection.touchManifest(manifestHash)
+    if manifest is None:
+        manifest = manifestSection.fetchManifest(manifestHash)
+
+    createNewManifest = False
+    if manifest is not None:
+        # NOTE: command line options already included in hash for manifest name
+        entryIndex, cachekey = matchManifestEntry(cache, manifest)
+
+        if cachekey is not None:
+            if entryIndex > 0:
+                # Move the entry to the top of the entries in the manifest
+                with manifestSection.lock:
+                    currentManifest = manifestSection.getManifest(manifestHash)
+                    if currentManifest is not None:
+                        currentManifest = currentManifest.copy()
+                        currentManifest.touchEntry(cachekey)
+                        manifestSection.setManifest(manifestHash, currentManifest)
+
+            compilerResult = lookUpCacheEntry(cache, objectFile, cachekey)
+            if compilerResult is not None:
+                return compilerResult, None, None
+            postProcessing = lambda compilerResult, compileDuration: postprocessObjectEvicted(
+                cache, objectFile, cachekey, compilerResult, compileDuration)
         else:
             createNewManifest = True
-            postProcessing = lambda compilerResult: postprocessNoManifestMiss(
-                cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes)
+            postProcessing = lambda compilerResult, compileDuration: postprocessHeaderChangedMiss(
+                cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes,
+                compileDuration)
+    else:
+        createNewManifest = True
+        postProcessing = lambda compilerResult, compileDuration: postprocessNoManifestMiss(
+            cache, objectFile, manifestSection, manifestHash, sourceFile, compilerResult, stripIncludes,
+            compileDuration)
 
     if createNewManifest:
         stripIncludes = False
@@ -1572,24 +1433,51 @@ def processDirect(cache, objectFile, compiler, cmdLine, sourceFile):
             cmdLine.insert(0, '/showIncludes')
             stripIncludes = True
 
-    compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True)
-    if postProcessing:
-        compilerResult = postProcessing(compilerResult)
-    return compilerResult
+    return None, cmdLine, postProcessing
+
+
+def processDirect(cache, objectFile, compiler, cmdLine, sourceFile):
+    compilerResult, cmdLine, postProcessing = lookUpDirect(cache, objectFile, compiler, cmdLine, sourceFile)
+    if compilerResult is not None:
+        return compilerResult
+    compilerResult, duration = compileTimed(compiler, cmdLine, sourceFile)
+    cache.compileDurations.record({sourceFile: duration})
+    return postProcessing(compilerResult, duration)
 
 
-def processNoDirect(cache, objectFile, compiler, cmdLine, environment):
+# Like lookUpDirect, but in non-direct mode
+def lookUpNoDirect(cache, objectFile, compiler, cmdLine, environment):
     cachekey = CompilerArtifactsRepository.computeKeyNodirect(compiler, cmdLine, environment)
-    with cache.lock:
-        if cache.compilerArtifactsRepository.section(cachekey).hasEntry(cachekey):
-            return processCacheHit(cache, objectFile, cachekey)
+    compilerResult = lookUpCacheEntry(cache, objectFile, cachekey)
+    if compilerResult is not None:
+        return compilerResult, None, None
+    postProcessing = lambda compilerResult, compileDuration: postprocessNoDirectMiss(
+        cache, objectFile, cachekey, compilerResult, compileDuration)
+    return None, cmdLine, postProcessing
 
-    compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True, environment=environment)
+
+def processNoDirect(cache, objectFile, compiler, cmdLine, sourceFile, environment):
+    compilerResult, cmdLine, postProcessing = lookUpNoDirect(cache, objectFile, compiler, cmdLine, environment)
+    if compilerResult is not None:
+        return compilerResult
+    compilerResult, duration = compileTimed(compiler, cmdLine, sourceFile, environment)
+    cache.compileDurations.record({sourceFile: duration})
+    return postProcessing(compilerResult, duration)
+
+
+def postprocessNoDirectMiss(cache, objectFile, cachekey, compilerResult, compileDuration=None):
     returnCode, compilerStdout, compilerStderr = compilerResult
-    with cache.lock, cache.statistics as stats:
+    artifactsSection = cache.compilerArtifactsRepository.section(cachekey)
+    cleanupRequired = False
+    with artifactsSection.lock, cache.statistics as stats:
         stats.registerCacheMiss()
         if returnCode == 0 and os.path.exists(objectFile):
-            addObjectToCache(stats, cache, cachekey, CompilerArtifacts(objectFile, compilerStdout, compilerStderr))
+            cleanupRequired = addObjectToCache(
+                stats, cache, cachekey,
+                CompilerArtifacts(objectFile, compilerStdout, compilerStderr, compileDuration))
+
+    if cleanupRequired:
+        scheduleCleanup(cache)
 
     return returnCode, compilerStdout, compilerStderr
 
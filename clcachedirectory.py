@@ -0,0 +1,1057 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# The cache directory: its configuration, statistics, indexes and cleaning.
+#
+import binascii
+from collections import defaultdict
+import contextlib
+import heapq
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from clcacheutil import (
+    CacheLock,
+    CacheLockException,
+    ensureDirectoryExists,
+    getFileHash,
+    getStringHash,
+    HASH_ALGORITHM_NAME,
+    printTraceStatement,
+    writeFileAtomically,
+)
+
+from clcachestorage import (
+    allSectionsLocked,
+    BlobStore,
+    CLEANUP_REQUEST_TIMEOUT,
+    CompilerArtifactsRepository,
+    CompilerArtifactsSection,
+    CorruptCacheEntryException,
+    HASH_INDEX_RACY_SECONDS,
+    leastRecentlyUsedEntries,
+    Manifest,
+    ManifestRepository,
+    ManifestSection,
+    OBJECT_COMPRESSIONS,
+    REMOTE_CACHE_TIMEOUT_MS,
+    RemoteCache,
+    UploadQueue,
+)
+
+
+# When cleaning the cache, the table of include paths shared by all manifests
+# is rebuilt if it grew larger than this number of bytes.
+MAX_PATH_TABLE_SIZE = 16 * 1024 * 1024
+
+# The header hash index will hold at most this number of entries. When it
+# grows larger, the least recently used 10% of the entries are dropped.
+MAX_HASH_INDEX_ENTRIES = 20000
+
+# The compile durations remembered for scheduling compilations are limited to
+# this number of source files. When there are more, the durations recorded
+# longest ago are dropped.
+MAX_COMPILE_DURATIONS = 20000
+
+# When there are more than this number of statistics shards, they are folded
+# into the statistics file.
+MAX_STATISTICS_SHARDS = 100
+
+# When the cache grows beyond its maximum size, a background process is started
+# to clean it. When it grows beyond this factor times the maximum size (e.g.
+# because cleaning does not keep up), compiler invocations also remove some
+# entries themselves.
+HARD_WATERMARK_FACTOR = 1.2
+
+# Cache entries are removed in batches of at most this many entries; no lock
+# is held for longer than it takes to remove one batch.
+CLEANUP_BATCH_SIZE = 100
+
+# Number of sections which are sampled by a compiler invocation which removes
+# entries itself, see HARD_WATERMARK_FACTOR.
+CLEANUP_SAMPLE_SECTIONS = 8
+
+# Process creation flags for detaching the cleaning process on Windows
+WINDOWS_DETACHED_PROCESS = 0x00000008
+WINDOWS_CREATE_NEW_PROCESS_GROUP = 0x00000200
+
+
+class FileHashIndex(object):
+    """ Persistent mapping of file paths to content hashes which can be used
+    in 'with' statements. An entry is only valid as long as the size, the
+    modification time and the file id of the file are unchanged. Several
+    threads may use the index at once; it is written when the last one leaves
+    its 'with' block. """
+    def __init__(self, indexFile):
+        self._indexFile = indexFile
+        self._index = None
+        self._indexFileStamp = None
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._users = 0
+        # Numbers of hits and rehashes, see takeCounts()
+        self._counts = defaultdict(int)
+
+    @property
+    def hits(self):
+        return self._counts['hits']
+
+    @property
+    def rehashes(self):
+        return self._counts['rehashes']
+
+    def __enter__(self):
+        with self._lock:
+            self._users += 1
+            if self._users == 1:
+                self._load()
+        return self
+
+    def _load(self):
+        self._dirty = False
+        self._counts.clear()
+
+        # Long-lived processes keep the index in memory as long as nobody
+        # else modified the file.
+        indexFileStamp = self._currentIndexFileStamp()
+        if self._index is not None and indexFileStamp == self._indexFileStamp:
+            return
+
+        self._index = {}
+        self._indexFileStamp = indexFileStamp
+        try:
+            with open(self._indexFile, 'r') as f:
+                self._index = json.load(f)
+        except (IOError, ValueError):
+            # A missing or corrupted index is not fatal, it just means that
+            # all headers need to be hashed again.
+            pass
+
+    def __exit__(self, typ, value, traceback):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._save()
+
+    def takeCounts(self):
+        """ Returns the number of hits and rehashes since the last call and
+        resets them; with several threads using the index, each hit is
+        reported by exactly one of them. """
+        with self._lock:
+            counts = self.hits, self.rehashes
+            self._counts.clear()
+            return counts
+
+    def _save(self):
+        if not self._dirty:
+            return
+
+        if len(self._index) > MAX_HASH_INDEX_ENTRIES:
+            self._evict(int(MAX_HASH_INDEX_ENTRIES * 0.9))
+
+        # The index is used without holding a lock: every entry is validated
+        # before use, so the worst thing which can happen is that concurrent
+        # updates of other processes get lost. The file is replaced
+        # atomically such that readers never see a partially written index.
+        try:
+            writeFileAtomically(self._indexFile, json.dumps(self._index, separators=(',', ':')))
+        except OSError:
+            # E.g. the index file is opened by another process on Windows
+            return
+        self._indexFileStamp = self._currentIndexFileStamp()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _currentIndexFileStamp(self):
+        try:
+            stat = os.stat(self._indexFile)
+            return (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return None
+
+    def _evict(self, maxEntries):
+        # The last element of each entry is a coarse time stamp of the last use
+        keysByAge = sorted(self._index, key=lambda k: self._index[k][-1], reverse=True)
+        for key in keysByAge[maxEntries:]:
+            del self._index[key]
+
+    @staticmethod
+    def _fingerprint(stat):
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    @staticmethod
+    def _currentTimeStamp():
+        # Hours are precise enough for eviction and avoid rewriting the index
+        # on every lookup.
+        return int(time.time()) // 3600
+
+    def getFileHash(self, filePath):
+        key = os.path.normcase(os.path.abspath(filePath))
+        stat = os.stat(filePath)
+        fingerprint = FileHashIndex._fingerprint(stat)
+
+        # May be called by multiple threads at once; files are hashed
+        # without holding the lock.
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and entry[:3] == fingerprint:
+                self._counts['hits'] += 1
+                timeStamp = FileHashIndex._currentTimeStamp()
+                if entry[4] != timeStamp:
+                    entry[4] = timeStamp
+                    self._dirty = True
+                return entry[3]
+            self._counts['rehashes'] += 1
+
+        fileHash = getFileHash(filePath)
+        with self._lock:
+            if stat.st_mtime < time.time() - HASH_INDEX_RACY_SECONDS:
+                self._index[key] = fingerprint + [fileHash, FileHashIndex._currentTimeStamp()]
+                self._dirty = True
+            elif key in self._index:
+                del self._index[key]
+                self._dirty = True
+        return fileHash
+
+
+class CompileDurations(object):
+    """ Remembers how long compiling each source file took the last time it
+    missed the cache, such that the slowest source files of an invocation with
+    multiple source files can be compiled first. Like the FileHashIndex, the
+    file is used without holding a lock. """
+    def __init__(self, durationsFile):
+        self._durationsFile = durationsFile
+
+    @staticmethod
+    def _key(sourceFile):
+        return os.path.normcase(os.path.abspath(sourceFile))
+
+    def _load(self):
+        try:
+            with open(self._durationsFile, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def durations(self, sourceFiles):
+        """ Returns the known durations (in seconds) of the given source files """
+        durations = self._load()
+        return {sourceFile: durations[self._key(sourceFile)][0]
+                for sourceFile in sourceFiles if self._key(sourceFile) in durations}
+
+    def record(self, durations):
+        """ Remembers the durations (in seconds) of the given source files """
+        if not durations:
+            return
+        allDurations = self._load()
+        now = int(time.time())
+        for sourceFile, duration in durations.items():
+            allDurations[self._key(sourceFile)] = [round(duration, 3), now]
+        if len(allDurations) > MAX_COMPILE_DURATIONS:
+            keysByAge = sorted(allDurations, key=lambda k: allDurations[k][1], reverse=True)
+            for key in keysByAge[int(MAX_COMPILE_DURATIONS * 0.9):]:
+                del allDurations[key]
+        try:
+            writeFileAtomically(self._durationsFile, json.dumps(allDurations, separators=(',', ':')))
+        except OSError:
+            # E.g. the file is opened by another process on Windows
+            pass
+
+
+class DirectoryRemoteCache(object):
+    """ Uses another cache directory, typically a shared cache (see 'clcache
+    --shared') on a network share, like a RemoteCache. The other cache is
+    cleaned according to its own maximum size. Like with a RemoteCache, new
+    entries are stored in the background; see flush(). """
+    def __init__(self, cacheDirectory, readOnly=False):
+        self._cacheDirectory = cacheDirectory
+        self.readOnly = readOnly
+        self._cache = None
+        self._unreachable = False
+        self._uploads = UploadQueue(1)
+
+    def _otherCache(self):
+        # Created on first use, this reads the configuration of the other cache
+        if self._cache is None:
+            self._cache = Cache(self._cacheDirectory, useRemote=False)
+        return self._cache
+
+    def get(self, kind, key):
+        if self._unreachable:
+            return None
+        try:
+            cache = self._otherCache()
+            if kind == 'objects':
+                section = cache.compilerArtifactsRepository.section(key)
+                with section.readLock:
+                    if not section.hasEntry(key):
+                        return None
+                    data = section.entryData(key)
+                    section.touchEntry(key)
+                    return data
+            section = cache.manifestRepository.section(key)
+            with section.readLock:
+                manifest = section.getManifest(key)
+                if manifest is None:
+                    return None
+                section.touchManifest(key)
+            return RemoteCache.serializeManifest(manifest)
+        except (FileNotFoundError, ValueError):
+            # Removed by the cleaner of the other cache in the meantime, or the
+            # manifest was rewritten when it compacted its path table
+            return None
+        except (OSError, CacheLockException, CorruptCacheEntryException) as e:
+            printTraceStatement("Remote cache {} unusable: {}".format(self._cacheDirectory, e))
+            self._unreachable = True
+            return None
+
+    def put(self, kind, key, data):
+        if self.readOnly or self._unreachable:
+            return
+        self._uploads.submit(self._store, kind, key, data)
+
+    def _store(self, kind, key, data):
+        if self._unreachable:
+            return
+        try:
+            cache = self._otherCache()
+            if kind == 'objects':
+                section = cache.compilerArtifactsRepository.section(key)
+                with section.lock:
+                    if section.hasEntry(key):
+                        return
+                    storedSize = section.setEntryData(key, data)
+                with cache.statistics as stats:
+                    stats.registerCacheEntry(storedSize)
+                scheduleCleanup(cache)
+            else:
+                # Other machines may have added entries for other include sets
+                section = cache.manifestRepository.section(key)
+                with section.lock:
+                    remoteManifest = section.getManifest(key)
+                    manifest = remoteManifest.copy() if remoteManifest is not None else Manifest()
+                    for entry in reversed(RemoteCache.deserializeManifest(data).entries()):
+                        manifest.addEntry(entry)
+                    section.setManifest(key, manifest)
+        except (OSError, CacheLockException) as e:
+            printTraceStatement("Remote cache {} unusable: {}".format(self._cacheDirectory, e))
+            self._unreachable = True
+
+    def flush(self):
+        """ Waits until all entries passed to put() are stored. """
+        self._uploads.wait()
+
+
+def remoteCacheFromEnvironment():
+    # CLCACHE_REMOTE is either the URL of an HTTP server or a cache directory
+    location = os.environ.get('CLCACHE_REMOTE')
+    if not location:
+        return None
+    readOnly = 'CLCACHE_REMOTE_READONLY' in os.environ
+    if urllib.parse.urlsplit(location).scheme in ('http', 'https'):
+        return RemoteCache(location, readOnly,
+                           int(os.environ.get('CLCACHE_REMOTE_TIMEOUT_MS', REMOTE_CACHE_TIMEOUT_MS)))
+    return DirectoryRemoteCache(location, readOnly)
+
+
+def defaultCacheDirectory():
+    try:
+        return os.environ["CLCACHE_DIR"]
+    except KeyError:
+        return os.path.join(os.path.expanduser("~"), "clcache")
+
+
+def localCacheDirectory(cacheDirectory):
+    """ Returns the directory on the local machine holding the state of a
+    shared cache which is not shared with other machines. """
+    root = os.environ.get('LOCALAPPDATA') or os.path.expanduser("~")
+    return os.path.join(root, "clcache-local", getStringHash(os.path.normcase(os.path.abspath(cacheDirectory))))
+
+
+class Cache(object):
+    def __init__(self, cacheDirectory=None, useRemote=True):
+        self.dir = cacheDirectory
+        if not self.dir:
+            self.dir = defaultCacheDirectory()
+
+        remote = remoteCacheFromEnvironment() if useRemote else None
+
+        ensureDirectoryExists(self.dir)
+        self.configuration = Configuration(os.path.join(self.dir, "config.txt"))
+        with self.configuration as cfg:
+            shared = cfg.shared()
+
+        manifestsRootDir = os.path.join(self.dir, "manifests")
+        ensureDirectoryExists(manifestsRootDir)
+        self.manifestRepository = ManifestRepository(manifestsRootDir, remote, shared)
+
+        compilerArtifactsRootDir = os.path.join(self.dir, "objects")
+        ensureDirectoryExists(compilerArtifactsRootDir)
+        self.compilerArtifactsRepository = CompilerArtifactsRepository(
+            compilerArtifactsRootDir, BlobStore(os.path.join(self.dir, "blobs")), remote, shared)
+
+        # Statistics and header hashes of a shared cache are kept per machine
+        localDir = localCacheDirectory(self.dir) if shared else self.dir
+        ensureDirectoryExists(localDir)
+        self.statistics = Statistics(os.path.join(localDir, "stats.txt"))
+        # Hashes computed using different algorithms must not be mixed up
+        self.fileHashIndex = FileHashIndex(os.path.join(localDir, "hashindex-{}.txt".format(HASH_ALGORITHM_NAME)))
+        self.compileDurations = CompileDurations(os.path.join(localDir, "durations.txt"))
+
+    @property
+    @contextlib.contextmanager
+    def lock(self):
+        # Locks are always taken in this order: manifest sections, compiler
+        # artifacts sections, statistics.
+        with allSectionsLocked(self.manifestRepository), \
+             allSectionsLocked(self.compilerArtifactsRepository), \
+             self.statistics.lock:
+            yield
+
+    @property
+    def shared(self):
+        # Whether the cache is used by several machines, see 'clcache --shared'
+        return self.manifestRepository.shared
+
+    @property
+    def remote(self):
+        # The second-level cache, if any, shared by both repositories
+        return self.manifestRepository.remote
+
+    def cacheDirectory(self):
+        return self.dir
+
+    def clean(self, stats, maximumSize):
+        currentSize = stats.currentCacheSize()
+        if currentSize < maximumSize:
+            return
+
+        effectiveMaximumSizeManifests, effectiveMaximumSizeObjects = self._effectiveMaximumSizes(maximumSize)
+
+        # Clean manifests
+        currentSizeManifests = self.manifestRepository.clean(effectiveMaximumSizeManifests)
+        if maximumSize == 0 or self.manifestRepository.pathTable.size() > MAX_PATH_TABLE_SIZE:
+            self.manifestRepository.compactPathTable()
+
+        # Clean artifacts
+        currentCompilerArtifactsCount, currentCompilerArtifactsSize = self.compilerArtifactsRepository.clean(
+            effectiveMaximumSizeObjects, self.evictionPolicy())
+
+        stats.setCacheSize(currentCompilerArtifactsSize + currentSizeManifests)
+        stats.setNumCacheEntries(currentCompilerArtifactsCount)
+
+    @staticmethod
+    def _effectiveMaximumSizes(maximumSize):
+        # Free at least 10% to avoid cleaning up too often which
+        # is a big performance hit with large caches.
+        effectiveMaximumSizeOverall = maximumSize * 0.9
+
+        # Split limit in manifests (10 %) and objects (90 %)
+        effectiveMaximumSizeManifests = effectiveMaximumSizeOverall * 0.1
+        effectiveMaximumSizeObjects = effectiveMaximumSizeOverall - effectiveMaximumSizeManifests
+        return effectiveMaximumSizeManifests, effectiveMaximumSizeObjects
+
+    def evictionPolicy(self):
+        # Only applies to cache entries, manifests are always evicted LRU
+        with self.configuration as cfg:
+            return cfg.evictionPolicy()
+
+    @staticmethod
+    def indexedSections(sections):
+        """ Returns the given sections along with their indexed entries, as
+        expected by leastRecentlyUsedEntries(). """
+        indexedSections = []
+        for section in sections:
+            with section.lock:
+                indexedSections.append((section, section.indexedEntries()))
+        return indexedSections
+
+    def cleanIncrementally(self, maximumSize):
+        """ Like clean(), but does not lock the whole cache: the entries to be
+        removed are determined up front and then removed in batches, holding
+        only the lock of one section at a time. Only compacting the path table
+        (rarely required) locks all manifest sections. """
+        effectiveMaximumSizeManifests, effectiveMaximumSizeObjects = self._effectiveMaximumSizes(maximumSize)
+        manifestVictims, _, _ = leastRecentlyUsedEntries(
+            self.indexedSections(self.manifestRepository.sections()), effectiveMaximumSizeManifests)
+        objectVictims, _, _ = leastRecentlyUsedEntries(
+            self.indexedSections(self.compilerArtifactsRepository.sections()), effectiveMaximumSizeObjects,
+            self.evictionPolicy())
+
+        victims = sorted(manifestVictims + objectVictims, key=lambda victim: victim[0])
+        for batchStart in range(0, len(victims), CLEANUP_BATCH_SIZE):
+            self.evictBatch(victims[batchStart:batchStart + CLEANUP_BATCH_SIZE])
+        for section in self.compilerArtifactsRepository.sections():
+            with section.lock:
+                section.compactPacks()
+        if self.manifestRepository.pathTable.size() > MAX_PATH_TABLE_SIZE:
+            with allSectionsLocked(self.manifestRepository):
+                self.manifestRepository.compactPathTable()
+
+    def _sampleVictims(self, repository, policy):
+        # All entries of a few randomly chosen sections of the repository,
+        # lowest priority first
+        sections = list(repository.sections())
+        sample = random.sample(sections, min(CLEANUP_SAMPLE_SECTIONS, len(sections)))
+        victims, _, _ = leastRecentlyUsedEntries(self.indexedSections(sample), 0, policy)
+        return victims
+
+    def evictSample(self):
+        """ Removes the CLEANUP_BATCH_SIZE entries with the lowest eviction
+        priority (e.g. the least recently used ones) of a few randomly chosen
+        sections. This is used by compiler invocations when the cache grows too
+        large; the entries removed are not necessarily the ones of the whole
+        cache with the lowest priority. """
+        manifestVictims = self._sampleVictims(self.manifestRepository, 'lru')
+        objectVictims = self._sampleVictims(self.compilerArtifactsRepository, self.evictionPolicy())
+
+        # The priorities of manifests and objects are not comparable if the
+        # objects are not evicted least recently used first, so the batch is
+        # split by time of last use. At least half of it are objects: only
+        # those count towards the cache size which triggered the eviction.
+        leastRecentlyUsed = heapq.nsmallest(
+            CLEANUP_BATCH_SIZE, manifestVictims + objectVictims, key=lambda victim: victim[4])
+        manifestCount = min(sum(1 for victim in leastRecentlyUsed if isinstance(victim[3], ManifestSection)),
+                            CLEANUP_BATCH_SIZE // 2)
+        self.evictBatch(heapq.nsmallest(manifestCount, manifestVictims, key=lambda victim: victim[0]) +
+                         heapq.nsmallest(CLEANUP_BATCH_SIZE - manifestCount, objectVictims,
+                                         key=lambda victim: victim[0]))
+
+    def evictBatch(self, victims):
+        """ Removes the given entries, as returned by leastRecentlyUsedEntries(),
+        unless they were used or replaced since. """
+        victimsBySection = defaultdict(list)
+        sections = {}
+        for victim in victims:
+            section = victim[3]
+            victimsBySection[id(section)].append(victim)
+            sections[id(section)] = section
+
+        removedObjectSizes = []
+        removedBlobHashes = []
+        for sectionId, sectionVictims in victimsBySection.items():
+            section = sections[sectionId]
+            with section.lock:
+                entries = section.index.entries()
+                for _, key, size, _, accessTime, blobHash in sectionVictims:
+                    # Skip entries which were used or replaced in the meantime
+                    if entries.get(key, [])[:2] != [size, accessTime]:
+                        continue
+                    if self.shared:
+                        # Readers of a shared cache only touch the entry file
+                        lastUseTime = section.lastUseTime(key)
+                        if lastUseTime is not None and lastUseTime > accessTime:
+                            entries[key][1] = lastUseTime
+                            continue
+                    try:
+                        removedSize = section.removeEntry(key)
+                    except OSError:
+                        # E.g. still opened by a reader on Windows
+                        continue
+                    del entries[key]
+                    if isinstance(section, CompilerArtifactsSection):
+                        removedObjectSizes.append(removedSize)
+                    if blobHash is not None:
+                        removedBlobHashes.append(blobHash)
+                section.index.rewrite(entries)
+        self.compilerArtifactsRepository.collectGarbage(removedBlobHashes)
+
+        # Manifests are only accounted for in the cache size by clean()
+        with self.statistics as stats:
+            for size in removedObjectSizes:
+                stats.unregisterCacheEntry(size)
+
+    def indexedSize(self):
+        """ Returns the overall size and the number of cache entries according
+        to the section indices. """
+        manifestsSize = sum(size
+                            for section in self.manifestRepository.sections()
+                            for size, _, _, _ in section.indexedEntries().values())
+        artifactsSizes = [size
+                          for section in self.compilerArtifactsRepository.sections()
+                          for size, _, _, _ in section.indexedEntries().values()]
+        return manifestsSize + sum(artifactsSizes), len(artifactsSizes)
+
+    def rebuildIndex(self, stats):
+        # Reconstructs the section indices from the files on disk, e.g. after
+        # the cache directory was modified manually.
+        self.manifestRepository.rebuildIndex()
+        self.compilerArtifactsRepository.rebuildIndex()
+
+        # Blobs left behind by entries which were removed manually are only
+        # found by checking all of them.
+        self.compilerArtifactsRepository.collectGarbage()
+        size, count = self.indexedSize()
+        stats.setCacheSize(size - self.compilerArtifactsRepository.duplicateBytes())
+        stats.setNumCacheEntries(count)
+
+
+class PersistentJSONDict(object):
+    def __init__(self, fileName):
+        self._dirty = False
+        self._dict = {}
+        self._fileName = fileName
+        try:
+            with open(self._fileName, 'r') as f:
+                self._dict = json.load(f)
+        except IOError:
+            pass
+
+    def save(self):
+        if self._dirty:
+            writeFileAtomically(self._fileName, json.dumps(self._dict, sort_keys=True, indent=4))
+            self._dirty = False
+
+    def __setitem__(self, key, value):
+        self._dict[key] = value
+        self._dirty = True
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+
+class Configuration(object):
+    _defaultValues = {
+        "MaximumCacheSize": 1073741824, # 1 GiB
+        "Compression": "none",
+        "CompressionLevel": 6,
+        "PackFiles": False,
+        "Shared": False,
+        "EvictionPolicy": "lru",
+    }
+
+    def __init__(self, configurationFile):
+        self._configurationFile = configurationFile
+        self._cfg = None
+
+    def __enter__(self):
+        self._cfg = PersistentJSONDict(self._configurationFile)
+        for setting, defaultValue in self._defaultValues.items():
+            if setting not in self._cfg:
+                self._cfg[setting] = defaultValue
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        # Does not write to disc when unchanged
+        self._cfg.save()
+
+    def maximumCacheSize(self):
+        return self._cfg["MaximumCacheSize"]
+
+    def setMaximumCacheSize(self, size):
+        self._cfg["MaximumCacheSize"] = size
+
+    def compression(self):
+        # None if objects are stored uncompressed
+        compression = self._cfg["Compression"]
+        return compression if compression in OBJECT_COMPRESSIONS else None
+
+    def compressionLevel(self):
+        return self._cfg["CompressionLevel"]
+
+    def setCompression(self, compression, level):
+        self._cfg["Compression"] = compression
+        self._cfg["CompressionLevel"] = level
+
+    def packFiles(self):
+        return self._cfg["PackFiles"]
+
+    def setPackFiles(self, enabled):
+        self._cfg["PackFiles"] = enabled
+
+    def shared(self):
+        return self._cfg["Shared"]
+
+    def setShared(self, enabled):
+        self._cfg["Shared"] = enabled
+
+    def evictionPolicy(self):
+        # 'lru' or 'cost', see evictionPriority()
+        return self._cfg["EvictionPolicy"]
+
+    def setEvictionPolicy(self, policy):
+        self._cfg["EvictionPolicy"] = policy
+
+
+def threadLocalProperty(name):
+    # An attribute which has a separate value in each thread, stored in the
+    # threading.local object 'threadState' of the instance
+    def getter(self):
+        return getattr(self.threadState, name, None)
+
+    def setter(self, value):
+        setattr(self.threadState, name, value)
+
+    return property(getter, setter)
+
+
+class Statistics(object):
+    CALLS_WITH_INVALID_ARGUMENT = "CallsWithInvalidArgument"
+    CALLS_WITHOUT_SOURCE_FILE = "CallsWithoutSourceFile"
+    CALLS_WITH_MULTIPLE_SOURCE_FILES = "CallsWithMultipleSourceFiles"
+    CALLS_WITH_PCH = "CallsWithPch"
+    CALLS_FOR_LINKING = "CallsForLinking"
+    CALLS_FOR_EXTERNAL_DEBUG_INFO = "CallsForExternalDebugInfo"
+    CALLS_FOR_PREPROCESSING = "CallsForPreprocessing"
+    CACHE_HITS = "CacheHits"
+    REMOTE_CACHE_HITS = "RemoteCacheHits"
+    COMPILE_TIME_SAVED = "CompileTimeSavedMs"
+    CACHE_MISSES = "CacheMisses"
+    EVICTED_MISSES = "EvictedMisses"
+    HEADER_CHANGED_MISSES = "HeaderChangedMisses"
+    SOURCE_CHANGED_MISSES = "SourceChangedMisses"
+    HEADER_HASH_INDEX_HITS = "HeaderHashIndexHits"
+    HEADER_REHASHES = "HeaderRehashes"
+    ADDED_OBJECTS_SIZE = "AddedObjectsSize"
+    ADDED_OBJECTS_STORED_SIZE = "AddedObjectsStoredSize"
+    CACHE_ENTRIES = "CacheEntries"
+    CACHE_SIZE = "CacheSize"
+
+    RESETTABLE_KEYS = {
+        CALLS_WITH_INVALID_ARGUMENT,
+        CALLS_WITHOUT_SOURCE_FILE,
+        CALLS_WITH_MULTIPLE_SOURCE_FILES,
+        CALLS_WITH_PCH,
+        CALLS_FOR_LINKING,
+        CALLS_FOR_EXTERNAL_DEBUG_INFO,
+        CALLS_FOR_PREPROCESSING,
+        CACHE_HITS,
+        REMOTE_CACHE_HITS,
+        COMPILE_TIME_SAVED,
+        CACHE_MISSES,
+        EVICTED_MISSES,
+        HEADER_CHANGED_MISSES,
+        SOURCE_CHANGED_MISSES,
+        HEADER_HASH_INDEX_HITS,
+        HEADER_REHASHES,
+        ADDED_OBJECTS_SIZE,
+        ADDED_OBJECTS_STORED_SIZE,
+    }
+    NON_RESETTABLE_KEYS = {
+        CACHE_ENTRIES,
+        CACHE_SIZE,
+    }
+
+    # Several threads may use a Statistics object at once, the increments of
+    # their 'with' blocks must not get mixed up.
+    _stats = threadLocalProperty('stats')
+    _folded = threadLocalProperty('folded')
+    _pendingShardCounts = threadLocalProperty('pendingShardCounts')
+    _increments = threadLocalProperty('increments')
+
+    def __init__(self, statsFile):
+        # Holds the attributes declared using threadLocalProperty
+        self.threadState = threading.local()
+        self._statsFile = statsFile
+        self._stats = None
+        self._folded = False
+        self._pendingShardCounts = None
+        self._increments = None
+        self.lock = CacheLock.forPath(self._statsFile)
+
+    # Registering events does not require holding the lock: the increments
+    # are written to a new shard file when leaving the 'with' block. Reading
+    # values does not require the lock either. Setting values (and folding
+    # the shards into the statistics file) requires holding the lock.
+    def __enter__(self):
+        self._stats = None
+        self._folded = False
+        self._pendingShardCounts = None
+        self._increments = defaultdict(int)
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if self._folded:
+            # Does not write to disc when unchanged
+            self._stats.save()
+        if any(self._increments.values()):
+            self._writeShard()
+
+        if len(self._shardFiles()) > MAX_STATISTICS_SHARDS:
+            with self.lock:
+                self.fold()
+                self._stats.save()
+
+    def _shardsDirectory(self):
+        return os.path.splitext(self._statsFile)[0] + '-shards'
+
+    def _shardFiles(self):
+        shardsDir = self._shardsDirectory()
+        try:
+            return [os.path.join(shardsDir, name) for name in os.listdir(shardsDir) if name.endswith('.json')]
+        except OSError:
+            return []
+
+    def _readShards(self):
+        shards = []
+        for shardFile in self._shardFiles():
+            try:
+                with open(shardFile, 'r') as f:
+                    shards.append((shardFile, json.load(f)))
+            except (IOError, ValueError):
+                # Being removed by the process folding the shards
+                pass
+        return shards
+
+    def _writeShard(self):
+        shardsDir = self._shardsDirectory()
+        ensureDirectoryExists(shardsDir)
+        # Shards only become visible under their final name once they are
+        # complete.
+        shardFile = os.path.join(shardsDir, binascii.hexlify(os.urandom(8)).decode('ascii') + '.json')
+        writeFileAtomically(shardFile, json.dumps({k: v for k, v in self._increments.items() if v}))
+        self._increments.clear()
+
+    def _value(self, key):
+        if self._stats is None:
+            self._stats = PersistentJSONDict(self._statsFile)
+            self._pendingShardCounts = defaultdict(int)
+            for _, counts in self._readShards():
+                for k, v in counts.items():
+                    self._pendingShardCounts[k] += v
+        storedValue = self._stats[key] if key in self._stats else 0
+        return storedValue + self._pendingShardCounts[key] + self._increments[key]
+
+    def fold(self):
+        # Requires holding the lock
+        if not self._folded:
+            self._stats = PersistentJSONDict(self._statsFile)
+            for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
+                if k not in self._stats:
+                    self._stats[k] = 0
+            self._folded = True
+
+        shards = self._readShards()
+        shards.append((None, self._increments))
+        for shardFile, counts in shards:
+            if shardFile is not None:
+                try:
+                    os.remove(shardFile)
+                except OSError:
+                    # E.g. opened by a reader on Windows; it is folded next time
+                    continue
+            for k, v in counts.items():
+                self._stats[k] = (self._stats[k] if k in self._stats else 0) + v
+
+        self._increments = defaultdict(int)
+        self._pendingShardCounts = defaultdict(int)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def numCallsWithInvalidArgument(self):
+        return self._value(Statistics.CALLS_WITH_INVALID_ARGUMENT)
+
+    def registerCallWithInvalidArgument(self):
+        self._increments[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
+
+    def numCallsWithoutSourceFile(self):
+        return self._value(Statistics.CALLS_WITHOUT_SOURCE_FILE)
+
+    def registerCallWithoutSourceFile(self):
+        self._increments[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
+
+    def numCallsWithMultipleSourceFiles(self):
+        return self._value(Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES)
+
+    def registerCallWithMultipleSourceFiles(self):
+        self._increments[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
+
+    def numCallsWithPch(self):
+        return self._value(Statistics.CALLS_WITH_PCH)
+
+    def registerCallWithPch(self):
+        self._increments[Statistics.CALLS_WITH_PCH] += 1
+
+    def numCallsForLinking(self):
+        return self._value(Statistics.CALLS_FOR_LINKING)
+
+    def registerCallForLinking(self):
+        self._increments[Statistics.CALLS_FOR_LINKING] += 1
+
+    def numCallsForExternalDebugInfo(self):
+        return self._value(Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO)
+
+    def registerCallForExternalDebugInfo(self):
+        self._increments[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
+
+    def numEvictedMisses(self):
+        return self._value(Statistics.EVICTED_MISSES)
+
+    def registerEvictedMiss(self):
+        self.registerCacheMiss()
+        self._increments[Statistics.EVICTED_MISSES] += 1
+
+    def numHeaderChangedMisses(self):
+        return self._value(Statistics.HEADER_CHANGED_MISSES)
+
+    def registerHeaderChangedMiss(self):
+        self.registerCacheMiss()
+        self._increments[Statistics.HEADER_CHANGED_MISSES] += 1
+
+    def numSourceChangedMisses(self):
+        return self._value(Statistics.SOURCE_CHANGED_MISSES)
+
+    def registerSourceChangedMiss(self):
+        self.registerCacheMiss()
+        self._increments[Statistics.SOURCE_CHANGED_MISSES] += 1
+
+    def numHeaderHashIndexHits(self):
+        return self._value(Statistics.HEADER_HASH_INDEX_HITS)
+
+    def registerHeaderHashIndexHits(self, count):
+        self._increments[Statistics.HEADER_HASH_INDEX_HITS] += count
+
+    def numHeaderRehashes(self):
+        return self._value(Statistics.HEADER_REHASHES)
+
+    def registerHeaderRehashes(self, count):
+        self._increments[Statistics.HEADER_REHASHES] += count
+
+    def addedObjectsSize(self):
+        return self._value(Statistics.ADDED_OBJECTS_SIZE)
+
+    def addedObjectsStoredSize(self):
+        return self._value(Statistics.ADDED_OBJECTS_STORED_SIZE)
+
+    def registerAddedObject(self, size, storedSize):
+        # storedSize is smaller than size for compressed or deduplicated objects
+        self._increments[Statistics.ADDED_OBJECTS_SIZE] += size
+        self._increments[Statistics.ADDED_OBJECTS_STORED_SIZE] += storedSize
+
+    def numCacheEntries(self):
+        return self._value(Statistics.CACHE_ENTRIES)
+
+    def setNumCacheEntries(self, number):
+        self.fold()
+        self._stats[Statistics.CACHE_ENTRIES] = number
+
+    def registerCacheEntry(self, size):
+        self._increments[Statistics.CACHE_ENTRIES] += 1
+        self._increments[Statistics.CACHE_SIZE] += size
+
+    def unregisterCacheEntry(self, size):
+        self._increments[Statistics.CACHE_ENTRIES] -= 1
+        self._increments[Statistics.CACHE_SIZE] -= size
+
+    def currentCacheSize(self):
+        return self._value(Statistics.CACHE_SIZE)
+
+    def setCacheSize(self, size):
+        self.fold()
+        self._stats[Statistics.CACHE_SIZE] = size
+
+    def numCacheHits(self):
+        return self._value(Statistics.CACHE_HITS)
+
+    def registerCacheHit(self):
+        self._increments[Statistics.CACHE_HITS] += 1
+
+    def numRemoteCacheHits(self):
+        return self._value(Statistics.REMOTE_CACHE_HITS)
+
+    def registerRemoteCacheHit(self):
+        # Also counted as a cache hit by registerCacheHit()
+        self._increments[Statistics.REMOTE_CACHE_HITS] += 1
+
+    def compileTimeSaved(self):
+        # In seconds, summed up over the cache hits of entries whose compile
+        # duration is known
+        return self._value(Statistics.COMPILE_TIME_SAVED) / 1000.0
+
+    def registerCompileTimeSaved(self, seconds):
+        self._increments[Statistics.COMPILE_TIME_SAVED] += int(round(seconds * 1000))
+
+    def numCacheMisses(self):
+        return self._value(Statistics.CACHE_MISSES)
+
+    def registerCacheMiss(self):
+        self._increments[Statistics.CACHE_MISSES] += 1
+
+    def numCallsForPreprocessing(self):
+        return self._value(Statistics.CALLS_FOR_PREPROCESSING)
+
+    def registerCallForPreprocessing(self):
+        self._increments[Statistics.CALLS_FOR_PREPROCESSING] += 1
+
+    def resetCounters(self):
+        self.fold()
+        for k in Statistics.RESETTABLE_KEYS:
+            self._stats[k] = 0
+
+
+class ServerWorker(object):
+    """ The state of a server worker process, see initializeServerWorker() """
+    cache = None
+
+
+def cleanupRequestPath(cache):
+    return os.path.join(cache.cacheDirectory(), "cleanup-requested")
+
+
+# Starts a detached clcache process cleaning the cache, unless one was started
+# already.
+def requestBackgroundCleanup(cache):
+    requestPath = cleanupRequestPath(cache)
+    try:
+        os.close(os.open(requestPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        try:
+            if time.time() - os.path.getmtime(requestPath) < CLEANUP_REQUEST_TIMEOUT:
+                return
+            os.utime(requestPath, None)
+        except OSError:
+            return
+
+    printTraceStatement("Starting background process to clean cache")
+    if getattr(sys, 'frozen', False):
+        command = [sys.executable, '--clean-background']
+    else:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clcache.py')
+        command = [sys.executable, script, '--clean-background']
+    environment = dict(os.environ)
+    environment['CLCACHE_DIR'] = cache.cacheDirectory()
+    environment.pop('CLCACHE_SERVER', None)
+    if os.name == 'nt':
+        detachArguments = {'creationflags': WINDOWS_DETACHED_PROCESS | WINDOWS_CREATE_NEW_PROCESS_GROUP}
+    else:
+        detachArguments = {'start_new_session': True}
+    subprocess.Popen(command, env=environment, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, **detachArguments)
+
+
+# Called by compiler invocations which added an entry to a cache which grew
+# too large. Must be called after releasing all section locks.
+def scheduleCleanup(cache):
+    if cache.shared:
+        # A shared cache is only cleaned by its designated cleaner, see
+        # cleanSharedCache()
+        return
+    with cache.statistics as stats, cache.configuration as cfg:
+        currentSize = stats.currentCacheSize()
+        maximumSize = cfg.maximumCacheSize()
+
+    if currentSize >= maximumSize * HARD_WATERMARK_FACTOR:
+        printTraceStatement("Cache size {} exceeds hard limit, removing entries".format(currentSize))
+        cache.evictSample()
+    # A clcache server cleans its own cache periodically, but not e.g. the
+    # cache of a DirectoryRemoteCache
+    if currentSize >= maximumSize and cache is not ServerWorker.cache:
+        requestBackgroundCleanup(cache)
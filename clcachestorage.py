@@ -0,0 +1,1775 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# Storage of manifests and compiler artifacts in cache sections, packs and
+# remote caches.
+#
+import binascii
+import concurrent.futures
+from collections import defaultdict, namedtuple
+import contextlib
+import heapq
+import http.client
+import json
+import mmap
+import os
+from shutil import rmtree
+import sys
+import re
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+from clcacheutil import (
+    CacheLock,
+    childDirectories,
+    copyOrLink,
+    ensureDirectoryExists,
+    filesBeneath,
+    getCompilerHash,
+    getFileHash,
+    getStringHash,
+    HashAlgorithm,
+    HASHING_THREAD_POOL,
+    IncludeChangedException,
+    IncludeNotFoundException,
+    invokeRealCompiler,
+    lastModificationTime,
+    printBinary,
+    printTraceStatement,
+    touchFile,
+    writeFileAtomically,
+    writeTemporaryFile,
+)
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Compression methods for cached object files which can be selected using
+# 'clcache --compression'. Maps the name to a pair of functions creating a
+# compressor (given the compression level) and a decompressor.
+OBJECT_COMPRESSIONS = {'zlib': (zlib.compressobj, zlib.decompressobj)}
+if lzma is not None:
+    OBJECT_COMPRESSIONS['lzma'] = (lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor)
+
+# Exceptions raised by the decompressors in OBJECT_COMPRESSIONS when reading
+# damaged data
+DECOMPRESSION_ERRORS = (zlib.error, EOFError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+# Object files are (de)compressed in chunks of this size.
+COMPRESSION_BUFFER_SIZE = 256 * 1024
+
+# Manifests listing at least this number of includes are validated by hashing
+# the includes concurrently using this number of threads.
+MIN_INCLUDES_FOR_PARALLEL_HASHING = 8
+
+# The codec that is used by clcache to store compiler STDOUR and STDERR in
+# output.txt and stderr.txt.
+# This codec is up to us and only used for clcache internal storage.
+# For possible values see https://docs.python.org/2/library/codecs.html
+CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
+
+# Manifest file will have at most this number of hash lists in it. Need to avoi
+# manifests grow too large.
+MAX_MANIFEST_HASHES = 100
+
+# Files modified less than this number of seconds ago are not added to the
+# header hash index: a second modification within the resolution of the file
+# system time stamps would go unnoticed otherwise.
+HASH_INDEX_RACY_SECONDS = 2
+
+# When the journal of a section index grows larger than this number of bytes,
+# it is rewritten such that it holds one line per entry.
+MAX_SECTION_INDEX_JOURNAL_SIZE = 1024 * 1024
+
+# A request for a background cleanup is considered stale (e.g. because the
+# cleaning process was killed) after this number of seconds.
+CLEANUP_REQUEST_TIMEOUT = 600
+
+# The in-memory manifest cache of a long-lived process will hold at most this
+# number of manifests.
+MAX_MANIFESTS_IN_MEMORY = 1000
+
+# When storing cache entries in pack files, a new pack file is started once
+# the current one of a section is larger than this.
+MAX_PACK_FILE_SIZE = 64 * 1024 * 1024
+
+# The pack files of a section are compacted when cleaning the cache if more
+# than this fraction of them is taken up by removed entries.
+PACK_COMPACTION_THRESHOLD = 0.3
+
+# Requests to a remote cache (see CLCACHE_REMOTE) time out after this number
+# of milliseconds unless overridden by CLCACHE_REMOTE_TIMEOUT_MS.
+REMOTE_CACHE_TIMEOUT_MS = 5000
+
+# Number of threads uploading new cache entries to a remote cache.
+REMOTE_CACHE_UPLOAD_THREADS = 2
+
+# With the 'cost' eviction policy, a cache entry is kept this number of
+# seconds longer than with the 'lru' policy for every second of compile time
+# per MiB of its size.
+COST_EVICTION_WEIGHT = 3600
+
+# `includeFiles`: dictionary
+#   key: path of an include file, which this source file uses
+#   value: hash of the include file's content
+# `includeFingerprints`: dictionary
+#   key: path of an include file (as in includeFiles)
+#   value: [size, mtime in nanoseconds] of the include file when it was hashed
+# `includesContentHash`: cumulative hash of all include files' content in includeFiles
+# `objectHash`: key in the cache, under which the object file is stored
+ManifestEntry = namedtuple('ManifestEntry',
+                           ['includeFiles', 'includeFingerprints', 'includesContentHash', 'objectHash'])
+
+# compileDuration is the number of seconds compiling took, None if unknown
+CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr', 'compileDuration'])
+CompilerArtifacts.__new__.__defaults__ = (None,)
+
+
+class Manifest(object):
+    """ A list of ManifestEntry objects, one for each set of include files
+    (and their contents) a source file was compiled with. The most recently
+    used entry comes first. """
+    def __init__(self, entries=None):
+        if entries is None:
+            entries = []
+        self._entries = list(entries)
+
+    def entries(self):
+        self._entries = list(self.iterEntries())
+        return self._entries
+
+    def copy(self):
+        # Entries which are not decoded yet are decoded by each copy
+        # separately
+        return Manifest(self._entries)
+
+    def iterEntries(self):
+        # Entries of manifests read from disk are decoded on first access,
+        # see ManifestSerializer
+        for entryIndex, entry in enumerate(self._entries):
+            if not isinstance(entry, ManifestEntry):
+                entry = self._entries[entryIndex] = entry()
+            yield entry
+
+    def addEntry(self, entry):
+        # Adds entry at the top of the entries, replacing an entry for the
+        # same object and dropping the least recently used entries
+        self._entries = [e for e in self.entries() if e.objectHash != entry.objectHash]
+        self._entries.insert(0, entry)
+        del self._entries[MAX_MANIFEST_HASHES:]
+
+    def touchEntry(self, objectHash):
+        # Moves the entry for objectHash to the top of the entries
+        for entryIndex, entry in enumerate(self.entries()):
+            if entry.objectHash == objectHash:
+                self._entries.insert(0, self._entries.pop(entryIndex))
+                break
+
+
+class PathTable(object):
+    """ Cache-wide table of include paths, which manifests refer to by id. The
+    id of a path is the offset of its record in the table file. Records are
+    only ever appended (holding the lock), so ids stay valid and the table can
+    be read without holding the lock. The file starts with a random table id;
+    a new table (with a new id) is only created by
+    ManifestRepository.compactPathTable, which rewrites all manifests.
+
+    Looking up the cache only reads the records of the paths it resolves, so
+    its cost does not grow with the table. Adding paths reads all records
+    appended since the last time, since that requires the ids of all paths. """
+    MAGIC = b'CLCP'
+    _header = struct.Struct('<4s8s')     # magic, table id
+    _pathLength = struct.Struct('<H')
+
+    def __init__(self, tableFile, shared=False):
+        self._tableFile = tableFile
+        self.lock = CacheLock.forPath(tableFile, shared)
+        self._threadLock = threading.RLock()
+        self._tableId = None
+        self._loadedSize = 0
+        # Paths by table id and path id, as far as they were read; paths of
+        # the previous table are kept, such that manifests loaded before
+        # compacting the table stay usable.
+        self._paths = {}
+        # Ids by path of all paths read by _refresh()
+        self._ids = {}
+
+    def tableFile(self):
+        return self._tableFile
+
+    def size(self):
+        try:
+            return os.path.getsize(self._tableFile)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _tableIdOf(header):
+        if len(header) < PathTable._header.size:
+            return None
+        magic, tableId = PathTable._header.unpack(header[:PathTable._header.size])
+        return tableId if magic == PathTable.MAGIC else None
+
+    def _useTable(self, tableId):
+        if tableId is not None and tableId != self._tableId:
+            self._dropPreviousTables()
+            self._paths[tableId] = {}
+            self._ids = {}
+            self._tableId = tableId
+            self._loadedSize = PathTable._header.size
+
+    def _refreshTableId(self):
+        try:
+            with open(self._tableFile, 'rb') as f:
+                self._useTable(PathTable._tableIdOf(f.read(PathTable._header.size)))
+        except IOError:
+            pass
+
+    def _refresh(self):
+        # Reads the records appended since the last call
+        try:
+            with open(self._tableFile, 'rb') as f:
+                tableId = PathTable._tableIdOf(f.read(PathTable._header.size))
+                if tableId is None:
+                    return
+                self._useTable(tableId)
+                f.seek(self._loadedSize)
+                data = f.read()
+        except IOError:
+            return
+
+        paths = self._paths[self._tableId]
+        offset = 0
+        while offset + PathTable._pathLength.size <= len(data):
+            length, = PathTable._pathLength.unpack_from(data, offset)
+            recordEnd = offset + PathTable._pathLength.size + length
+            if recordEnd > len(data):
+                # Being written by another process
+                break
+            # All manifests share the same string objects
+            path = sys.intern(data[offset + PathTable._pathLength.size:recordEnd].decode('utf-8'))
+            pathId = self._loadedSize + offset
+            paths[pathId] = path
+            self._ids.setdefault(path, pathId)
+            offset = recordEnd
+        self._loadedSize += offset
+
+    def _dropPreviousTables(self):
+        # Keeps only the paths of the current table, if any; otherwise the
+        # paths of the table which was removed last are kept
+        if self._tableId is not None:
+            self._paths = {self._tableId: self._paths[self._tableId]}
+
+    def checkTableId(self, tableId):
+        """ Raises ValueError if the given table does not exist anymore. Only
+        reads the header of the table file. """
+        with self._threadLock:
+            self._refreshTableId()
+            if tableId not in self._paths:
+                raise ValueError("Manifest refers to an unknown path table")
+
+    def resolve(self, tableId, pathIds):
+        """ Returns the paths with the given ids. Raises ValueError if one of
+        them is unknown, e.g. because the table was compacted since
+        checkTableId() was called. """
+        if any(pathId not in self._paths.get(tableId, {}) for pathId in pathIds):
+            with self._threadLock:
+                self._readPaths(tableId, pathIds)
+        paths = self._paths.get(tableId, {})
+        try:
+            return [paths[pathId] for pathId in pathIds]
+        except KeyError as e:
+            raise ValueError("Manifest refers to an unknown path") from e
+
+    def _readPaths(self, tableId, pathIds):
+        # Reads the records of the given paths, unless the table was replaced
+        paths = self._paths.get(tableId)
+        if paths is None:
+            return
+        try:
+            with open(self._tableFile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if PathTable._tableIdOf(data) != tableId:
+                    return
+                for pathId in pathIds:
+                    pathStart = pathId + PathTable._pathLength.size
+                    if pathId in paths or pathId < PathTable._header.size or pathStart > len(data):
+                        continue
+                    length, = PathTable._pathLength.unpack_from(data, pathId)
+                    if pathStart + length <= len(data):
+                        # All manifests share the same string objects
+                        paths[pathId] = sys.intern(data[pathStart:pathStart + length].decode('utf-8'))
+        except (IOError, ValueError):
+            # E.g. the table is empty or was removed; unknown paths make
+            # resolve() fail
+            pass
+
+    def ids(self, paths):
+        """ Returns the current table id and a dictionary mapping each of the
+        given paths to its id. Paths are added to the table as needed. """
+        with self._threadLock:
+            self._refresh()
+            if self._tableId is not None and all(path in self._ids for path in paths):
+                return self._tableId, {path: self._ids[path] for path in paths}
+
+            with self.lock:
+                self._refresh()
+                if self._tableId is None:
+                    with open(self._tableFile, 'wb') as f:
+                        f.write(PathTable._header.pack(PathTable.MAGIC, os.urandom(8)))
+                    self._refresh()
+
+                missingPaths = sorted(set(path for path in paths if path not in self._ids))
+                if missingPaths:
+                    records = []
+                    for path in missingPaths:
+                        encodedPath = path.encode('utf-8')
+                        records.append(PathTable._pathLength.pack(len(encodedPath)))
+                        records.append(encodedPath)
+                    with open(self._tableFile, 'r+b') as f:
+                        # Drops incomplete records of processes which were killed
+                        f.truncate(self._loadedSize)
+                        f.seek(self._loadedSize)
+                        f.write(b''.join(records))
+                    self._refresh()
+            return self._tableId, {path: self._ids[path] for path in paths}
+
+    def reset(self):
+        # Removes the table; requires holding the lock. All paths of the
+        # removed table are read first, so they can still be resolved by this
+        # object.
+        with self._threadLock:
+            self._refresh()
+            try:
+                os.remove(self._tableFile)
+            except OSError:
+                pass
+            self._dropPreviousTables()
+            self._tableId = None
+            self._ids = {}
+            self._loadedSize = 0
+
+
+class ManifestSerializer(object):
+    """ Converts manifests to and from a compact binary format: a header
+    naming the PathTable the manifest refers to, followed by length-prefixed
+    entry records which refer to include paths by their id in the path table
+    and store hashes as raw bytes. Entries are only decoded when they are
+    accessed. All numbers are little endian. """
+    MAGIC = b'CLCM'
+    VERSION = 2
+
+    _header = struct.Struct('<4sB8sI')      # magic, version, path table id, number of entries
+    _count = struct.Struct('<I')            # record size, number of includes
+    _include = struct.Struct('<I?Qq')       # path id, has fingerprint, size, mtime
+
+    @staticmethod
+    def _packHash(hexHash):
+        digest = binascii.unhexlify(hexHash)
+        return struct.pack('<B', len(digest)) + digest
+
+    @staticmethod
+    def _unpackHash(buf, offset):
+        length = buf[offset]
+        return binascii.hexlify(buf[offset + 1:offset + 1 + length]).decode('ascii'), offset + 1 + length
+
+    @staticmethod
+    def serialize(manifest, pathTable):
+        entries = manifest.entries()
+        tableId, pathIds = pathTable.ids({path for entry in entries for path in entry.includeFiles})
+
+        chunks = [ManifestSerializer._header.pack(
+            ManifestSerializer.MAGIC, ManifestSerializer.VERSION, tableId, len(entries))]
+        for entry in entries:
+            record = [
+                ManifestSerializer._packHash(entry.includesContentHash),
+                ManifestSerializer._packHash(entry.objectHash),
+                ManifestSerializer._count.pack(len(entry.includeFiles)),
+            ]
+            for path in sorted(entry.includeFiles):
+                fingerprint = entry.includeFingerprints.get(path)
+                record.append(ManifestSerializer._include.pack(
+                    pathIds[path], fingerprint is not None, *(fingerprint or (0, 0))))
+                record.append(ManifestSerializer._packHash(entry.includeFiles[path]))
+            record = b''.join(record)
+            chunks.append(ManifestSerializer._count.pack(len(record)))
+            chunks.append(record)
+        return b''.join(chunks)
+
+    @staticmethod
+    def deserialize(data, pathTable):
+        """ Returns a Manifest; raises ValueError if data is no valid
+        manifest. """
+        buf = memoryview(data)
+        try:
+            magic, version, tableId, entryCount = ManifestSerializer._header.unpack_from(buf, 0)
+            if magic != ManifestSerializer.MAGIC or version != ManifestSerializer.VERSION:
+                raise ValueError("Unsupported manifest format")
+            pathTable.checkTableId(tableId)
+            offset = ManifestSerializer._header.size
+
+            decoders = []
+            for _ in range(entryCount):
+                recordSize, = ManifestSerializer._count.unpack_from(buf, offset)
+                offset += ManifestSerializer._count.size
+                if offset + recordSize > len(buf):
+                    raise ValueError("Truncated manifest")
+                decoders.append(ManifestSerializer._entryDecoder(buf, offset, pathTable, tableId))
+                offset += recordSize
+        except struct.error as e:
+            raise ValueError("Corrupted manifest: {}".format(e)) from e
+        return Manifest(decoders)
+
+    @staticmethod
+    def _entryDecoder(buf, offset, pathTable, tableId):
+        return lambda: ManifestSerializer._decodeEntry(buf, offset, pathTable, tableId)
+
+    @staticmethod
+    def _decodeEntry(buf, offset, pathTable, tableId):
+        includesContentHash, offset = ManifestSerializer._unpackHash(buf, offset)
+        objectHash, offset = ManifestSerializer._unpackHash(buf, offset)
+        includeCount, = ManifestSerializer._count.unpack_from(buf, offset)
+        offset += ManifestSerializer._count.size
+
+        includes = []
+        for _ in range(includeCount):
+            pathId, hasFingerprint, size, mtime = ManifestSerializer._include.unpack_from(buf, offset)
+            offset += ManifestSerializer._include.size
+            contentHash, offset = ManifestSerializer._unpackHash(buf, offset)
+            includes.append((pathId, hasFingerprint, [size, mtime], contentHash))
+
+        includeFiles = {}
+        includeFingerprints = {}
+        paths = pathTable.resolve(tableId, [pathId for pathId, _, _, _ in includes])
+        for path, (_, hasFingerprint, fingerprint, contentHash) in zip(paths, includes):
+            includeFiles[path] = contentHash
+            if hasFingerprint:
+                includeFingerprints[path] = fingerprint
+        return ManifestEntry(includeFiles, includeFingerprints, includesContentHash, objectHash)
+
+
+class SectionIndex(object):
+    """ Remembers size, time of last access, compile duration (in
+    milliseconds, 0 if unknown) and the blob (see BlobStore) of all entries of
+    a cache section, such that the cache can be cleaned without walking the
+    file system. The index is an append-only journal; all methods require
+    holding the lock of the section. """
+    def __init__(self, indexFile):
+        self._indexFile = indexFile
+
+    def exists(self):
+        return os.path.exists(self._indexFile)
+
+    def addEntry(self, key, size, compileDuration=None, blobHash=None):
+        self._append(self._entryLine(
+            key, [size, int(time.time()), CacheEntrySerializer.durationMs(compileDuration), blobHash]))
+
+    @staticmethod
+    def _entryLine(key, entry):
+        # The blob is only listed for entries linked to one
+        return "+ {}\n".format(" ".join(str(field) for field in [key] + entry if field is not None))
+
+    def touchEntry(self, key):
+        self._append("t {} {}\n".format(key, int(time.time())))
+
+    def removeEntry(self, key):
+        self._append("- {}\n".format(key))
+
+    def _append(self, line):
+        with open(self._indexFile, 'a') as f:
+            f.write(line)
+            journalSize = f.tell()
+        if journalSize > MAX_SECTION_INDEX_JOURNAL_SIZE:
+            self.rewrite(self.entries())
+
+    def entries(self):
+        """ Returns a dictionary mapping the key of each entry to a
+        [size, time of last access, compile duration, blob hash or None]
+        list. """
+        entries = {}
+        try:
+            with open(self._indexFile, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    try:
+                        if fields[0] == '+' and len(fields) in (4, 5, 6):
+                            # Journals written by older clcache versions
+                            # have no compile durations
+                            entries[fields[1]] = [int(fields[2]), int(fields[3]),
+                                                  int(fields[4]) if len(fields) >= 5 else 0,
+                                                  fields[5] if len(fields) == 6 else None]
+                        elif fields[0] == 't' and len(fields) == 3 and fields[1] in entries:
+                            entries[fields[1]][1] = int(fields[2])
+                        elif fields[0] == '-' and len(fields) == 2:
+                            entries.pop(fields[1], None)
+                    except (IndexError, ValueError):
+                        # Incomplete line written by a process which was killed
+                        pass
+        except IOError:
+            pass
+        return entries
+
+    def rewrite(self, entries):
+        writeFileAtomically(self._indexFile, ''.join(self._entryLine(key, entry) for key, entry in entries.items()))
+
+
+def evictionPriority(size, accessTime, durationMs, policy):
+    """ Entries with the lowest priority are evicted first. With the 'lru'
+    policy, this is the time of last access. The 'cost' policy implements
+    GreedyDual-Size, using the time of last access as the inflation value: an
+    entry is kept longer the more compile time per byte it saves. """
+    if policy == 'cost' and size > 0:
+        return accessTime + COST_EVICTION_WEIGHT * (durationMs / 1000.0) / (size / 1048576.0)
+    return accessTime
+
+
+def leastRecentlyUsedEntries(indexedSections, maximumSize, policy='lru'):
+    """ Determines the entries of the given sections with the lowest eviction
+    priority which need to be removed such that their overall size is below
+    maximumSize. indexedSections is a list of (section, entries) pairs, entries
+    as returned by SectionIndex.entries(). Returns a list of (eviction
+    priority, key, size, section, time of last access, blob hash) tuples,
+    lowest priority first, plus the number and the overall size of the
+    remaining entries. """
+    heap = []
+    currentSize = 0
+    count = 0
+    for section, entries in indexedSections:
+        for key, (size, accessTime, durationMs, blobHash) in entries.items():
+            heap.append((evictionPriority(size, accessTime, durationMs, policy), key, size, section, accessTime,
+                         blobHash))
+            currentSize += size
+            count += 1
+    heapq.heapify(heap)
+
+    victims = []
+    while heap and currentSize > maximumSize:
+        victim = heapq.heappop(heap)
+        victims.append(victim)
+        currentSize -= victim[2]
+        count -= 1
+    return victims, count, currentSize
+
+
+def evictLeastRecentlyUsed(indexedSections, maximumSize, policy='lru'):
+    """ Removes the entries of the given sections with the lowest eviction
+    priority until their overall size is below maximumSize. Requires holding
+    the locks of all sections. Returns the number and the overall size of the
+    remaining entries, plus the blobs of the removed entries. """
+    victims, count, currentSize = leastRecentlyUsedEntries(indexedSections, maximumSize, policy)
+
+    touchedSections = {}
+    blobHashes = []
+    for _, key, _, section, _, blobHash in victims:
+        section.removeEntry(key)
+        touchedSections[id(section)] = section
+        if blobHash is not None:
+            blobHashes.append(blobHash)
+
+    for section in touchedSections.values():
+        section.index.rewrite(section.index.entries())
+    return count, currentSize, blobHashes
+
+
+class ManifestSection(object):
+    def __init__(self, manifestSectionDir, pathTable, manifestsInMemory=None, remote=None, shared=False):
+        self.manifestSectionDir = manifestSectionDir
+        self._pathTable = pathTable
+        self._remote = remote
+        self._shared = shared
+        self._manifestsInMemory = manifestsInMemory if manifestsInMemory is not None else {}
+        self.lock = CacheLock.forPath(self.manifestSectionDir, shared)
+        self.index = SectionIndex(self.manifestSectionDir + '.index')
+
+    def manifestPath(self, manifestHash):
+        return os.path.join(self.manifestSectionDir, manifestHash + ".manifest")
+
+    def jsonManifestPath(self, manifestHash):
+        # Manifests written by older clcache versions, which are only removed
+        # when cleaning the cache
+        return os.path.join(self.manifestSectionDir, manifestHash + ".json")
+
+    def manifestFiles(self):
+        return filesBeneath(self.manifestSectionDir)
+
+    def setManifest(self, manifestHash, manifest):
+        ensureDirectoryExists(self.manifestSectionDir)
+        data = ManifestSerializer.serialize(manifest, self._pathTable)
+        # Manifests are replaced atomically, such that a manifest which is
+        # still in use by another thread is never modified.
+        writeFileAtomically(self.manifestPath(manifestHash), data)
+        self.index.addEntry(manifestHash, len(data))
+
+    def uploadManifest(self, manifestHash, manifest):
+        if self._remote is not None:
+            self._remote.put('manifests', manifestHash, RemoteCache.serializeManifest(manifest))
+
+    def fetchManifest(self, manifestHash):
+        """ Copies the manifest from the remote cache (if any) into this
+        section. Returns None if the remote cache does not have it. Takes the
+        lock of the section only for storing the manifest. """
+        if self._remote is None:
+            return None
+        data = self._remote.get('manifests', manifestHash)
+        if data is None:
+            return None
+        try:
+            manifest = RemoteCache.deserializeManifest(data)
+        except ValueError as e:
+            printTraceStatement(str(e))
+            return None
+        with self.lock:
+            # Stored by another process in the meantime
+            existingManifest = self.getManifest(manifestHash)
+            if existingManifest is not None:
+                return existingManifest
+            self.setManifest(manifestHash, manifest)
+        return manifest
+
+    @property
+    def readLock(self):
+        # Readers of a shared cache don't lock, manifests are replaced
+        # atomically.
+        return contextlib.ExitStack() if self._shared else self.lock
+
+    def touchManifest(self, manifestHash):
+        if self._shared:
+            touchFile(self.manifestPath(manifestHash))
+        else:
+            self.index.touchEntry(manifestHash)
+
+    def lastUseTime(self, manifestHash):
+        return lastModificationTime(self.manifestPath(manifestHash))
+
+    def removeEntry(self, manifestHash):
+        for path in [self.manifestPath(manifestHash), self.jsonManifestPath(manifestHash)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.index.removeEntry(manifestHash)
+
+    def indexedEntries(self):
+        # Sections created by older clcache versions (or whose index was
+        # deleted) are indexed on first use.
+        if not self.index.exists():
+            self.rebuildIndex()
+        return self.index.entries()
+
+    def rebuildIndex(self):
+        entries = {}
+        for filePath in self.manifestFiles():
+            manifestHash, extension = os.path.splitext(os.path.basename(filePath))
+            if extension not in ('.manifest', '.json'):
+                continue
+            try:
+                stat = os.stat(filePath)
+            except OSError:
+                continue
+            entries[manifestHash] = [stat.st_size, int(max(stat.st_atime, stat.st_mtime)), 0, None]
+        self.index.rewrite(entries)
+
+    def getManifest(self, manifestHash):
+        fileName = self.manifestPath(manifestHash)
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            return None
+
+        # Manifests are never modified in place, so size, modification time
+        # and file id are enough to tell whether the copy in memory is still
+        # current.
+        fileStamp = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        inMemory = self._manifestsInMemory.get(fileName)
+        if inMemory is not None and inMemory[0] == fileStamp:
+            return inMemory[1]
+
+        try:
+            with open(fileName, 'rb') as inFile:
+                manifest = ManifestSerializer.deserialize(inFile.read(), self._pathTable)
+        except (IOError, ValueError):
+            return None
+
+        if len(self._manifestsInMemory) >= MAX_MANIFESTS_IN_MEMORY:
+            self._manifestsInMemory.clear()
+        self._manifestsInMemory[fileName] = (fileStamp, manifest)
+        return manifest
+
+
+class ManifestRepository(object):
+    # Bump this counter whenever the current manifest file format changes.
+    # E.g. changing the file format from {'oldkey': ...} to {'newkey': ...} requires
+    # invalidation, such that a manifest that was stored using the old format is not
+    # interpreted using the new format. Instead the old file will not be touched
+    # again due to a new manifest hash and is cleaned away after some time.
+    MANIFEST_FILE_FORMAT_VERSION = 7
+
+    def __init__(self, manifestsRootDir, remote=None, shared=False):
+        self._manifestsRootDir = manifestsRootDir
+        self._manifestsInMemory = {}
+        self.pathTable = PathTable(manifestsRootDir + '.paths', shared)
+        self.remote = remote
+        self.shared = shared
+
+    def section(self, manifestHash):
+        return ManifestSection(os.path.join(self._manifestsRootDir, manifestHash[:2]),
+                               self.pathTable, self._manifestsInMemory, self.remote, self.shared)
+
+    def sections(self):
+        return (ManifestSection(path, self.pathTable, self._manifestsInMemory, self.remote, self.shared)
+                for path in sorted(childDirectories(self._manifestsRootDir)))
+
+    def clean(self, maxManifestsSize):
+        _, remainingManifestsSize, _ = evictLeastRecentlyUsed(
+            [(section, section.indexedEntries()) for section in self.sections()], maxManifestsSize)
+        return remainingManifestsSize
+
+    def rebuildIndex(self):
+        for section in self.sections():
+            section.rebuildIndex()
+
+    def compactPathTable(self):
+        """ Replaces the path table by a new one which only contains the paths
+        used by the remaining manifests, rewriting all manifests. Requires
+        holding the locks of all sections. """
+        with self.pathTable.lock:
+            self.pathTable.reset()
+            for section in self.sections():
+                for manifestHash in section.indexedEntries():
+                    manifest = section.getManifest(manifestHash)
+                    if manifest is not None:
+                        section.setManifest(manifestHash, Manifest(manifest.entries()))
+
+    @staticmethod
+    def getManifestHash(compilerBinary, commandLine, sourceFile):
+        compilerHash = getCompilerHash(compilerBinary)
+
+        # NOTE: We intentionally do not normalize command line to include
+        # preprocessor options. In direct mode we do not perform
+        # preprocessing before cache lookup, so all parameters are important.
+        # One of the few exceptions to this rule is the /MP switch, which only
+        # defines how many compiler processes are running simultaneusly.
+        commandLine = [arg for arg in commandLine if not arg.startswith("/MP")]
+
+        additionalData = "{}|{}|{}".format(
+            compilerHash, commandLine, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION)
+        return getFileHash(sourceFile, additionalData)
+
+    @staticmethod
+    def getIncludesContentHashForFiles(includes, hashIndex=None, fingerprints=None):
+        # The hash index trusts modification times as well
+        trustMtime = 'CLCACHE_IGNORE_MTIME' not in os.environ
+        hashFunction = hashIndex.getFileHash if hashIndex is not None and trustMtime else getFileHash
+        paths = sorted(includes.keys())
+
+        # A cheap pass of stat calls first: a changed size means a changed
+        # include, an unchanged size and mtime means an unchanged include.
+        # Only the remaining includes need to be hashed.
+        knownHashes = {}
+        if fingerprints:
+            knownHashes = ManifestRepository._checkFingerprints(includes, fingerprints, trustMtime)
+        pathsToHash = [path for path in paths if path not in knownHashes]
+
+        if len(pathsToHash) < MIN_INCLUDES_FOR_PARALLEL_HASHING:
+            computedHashes = [ManifestRepository._checkedIncludeHash(hashFunction, path, includes[path])
+                              for path in pathsToHash]
+        else:
+            # Hashing is I/O bound (and hashlib releases the GIL for large
+            # files), so the includes are hashed concurrently. As soon as one
+            # changed include is detected, the remaining ones are skipped.
+            changeDetected = threading.Event()
+            futures = [HASHING_THREAD_POOL.executor().submit(ManifestRepository._checkedIncludeHash,
+                                                             hashFunction, path, includes[path], changeDetected)
+                       for path in pathsToHash]
+            try:
+                computedHashes = [future.result() for future in futures]
+            finally:
+                changeDetected.set()
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+
+        knownHashes.update(zip(pathsToHash, computedHashes))
+        listOfIncludesHashes = [knownHashes[path] for path in paths]
+        if None in listOfIncludesHashes:
+            raise IncludeNotFoundException()
+
+        return ManifestRepository.getIncludesContentHashForHashes(listOfIncludesHashes)
+
+    @staticmethod
+    def _checkFingerprints(includes, fingerprints, trustMtime):
+        # Returns the hashes of the includes whose fingerprint is unchanged;
+        # None for missing includes.
+        knownHashes = {}
+        for path, fingerprint in fingerprints.items():
+            if path not in includes:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                knownHashes[path] = None
+                continue
+            if stat.st_size != fingerprint[0]:
+                raise IncludeChangedException()
+            if trustMtime and stat.st_mtime_ns == fingerprint[1]:
+                knownHashes[path] = includes[path]
+        return knownHashes
+
+    @staticmethod
+    def getIncludeFingerprints(paths):
+        """ Returns the fingerprints to be stored in a manifest for the given
+        (already hashed) includes. """
+        fingerprints = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # A modification within the resolution of the file system time
+            # stamps would go unnoticed otherwise.
+            if stat.st_mtime < time.time() - HASH_INDEX_RACY_SECONDS:
+                fingerprints[path] = [stat.st_size, stat.st_mtime_ns]
+        return fingerprints
+
+    @staticmethod
+    def _checkedIncludeHash(hashFunction, path, expectedHash, changeDetected=None):
+        # Returns None for missing includes (and for skipped includes, if
+        # a changed include was detected already)
+        if changeDetected is not None and changeDetected.is_set():
+            return None
+        try:
+            fileHash = hashFunction(path)
+        except FileNotFoundError:
+            return None
+        if fileHash != expectedHash:
+            if changeDetected is not None:
+                changeDetected.set()
+            raise IncludeChangedException()
+        return fileHash
+
+    @staticmethod
+    def getIncludesContentHashForHashes(listOfIncludesHashes):
+        return HashAlgorithm(','.join(listOfIncludesHashes).encode()).hexdigest()
+
+
+class PackIndex(object):
+    """ Maps the keys of the entries stored in the pack files of a compiler
+    artifacts section to the location of their records. Like SectionIndex,
+    this is an append-only journal and requires holding the lock of the
+    section. The entries are kept in memory, so only lines appended by other
+    processes are read again. The first line is a random id which changes
+    whenever the journal is rewritten. """
+    def __init__(self, indexFile):
+        self._indexFile = indexFile
+        self._journalId = None
+        self._loadedSize = 0
+        self._entries = {}
+
+    def entries(self):
+        """ Returns a dictionary mapping the key of each entry to a
+        (pack file number, offset, length) tuple. """
+        self._refresh()
+        return self._entries
+
+    def addEntry(self, key, packFile, offset, length):
+        self._append("+ {} {} {} {}\n".format(key, packFile, offset, length))
+
+    def removeEntry(self, key):
+        self._append("- {}\n".format(key))
+
+    def _append(self, line):
+        if not os.path.exists(self._indexFile):
+            self.rewrite({})
+        with open(self._indexFile, 'a') as f:
+            f.write(line)
+
+    def _refresh(self):
+        try:
+            with open(self._indexFile, 'rb') as f:
+                journalId = f.readline()
+                if journalId != self._journalId:
+                    self._journalId = journalId
+                    self._entries = {}
+                    self._loadedSize = f.tell()
+                f.seek(self._loadedSize)
+                data = f.read()
+        except IOError:
+            self._journalId = None
+            self._entries = {}
+            self._loadedSize = 0
+            return
+
+        # An incomplete last line is read again next time
+        end = data.rfind(b'\n') + 1
+        self._loadedSize += end
+        for line in data[:end].decode('ascii').splitlines():
+            fields = line.split()
+            try:
+                if fields[0] == '+' and len(fields) == 5:
+                    self._entries[fields[1]] = (int(fields[2]), int(fields[3]), int(fields[4]))
+                elif fields[0] == '-' and len(fields) == 2:
+                    self._entries.pop(fields[1], None)
+            except (IndexError, ValueError):
+                pass
+
+    def rewrite(self, entries):
+        lines = ["{}\n".format(binascii.hexlify(os.urandom(8)).decode('ascii'))]
+        for key, (packFile, offset, length) in entries.items():
+            lines.append("+ {} {} {} {}\n".format(key, packFile, offset, length))
+        writeFileAtomically(self._indexFile, ''.join(lines))
+
+
+class BlobStore(object):
+    """ Stores the entry files (see CacheEntrySerializer) once per content
+    hash. Cache entries hard link to the blobs, so the number of links of a
+    blob tells how many cache entries still refer to it; blobs which are not
+    linked by any cache entry anymore are removed by collectGarbage(). The
+    section indices list the blob of each entry, such that only the blobs of
+    removed entries need to be checked. """
+    def __init__(self, blobsRootDir):
+        self._blobsRootDir = blobsRootDir
+
+    def blobPath(self, blobHash):
+        return os.path.join(self._blobsRootDir, blobHash[:2], blobHash)
+
+    def add(self, filePath, dstFilePath, blobHash=None):
+        """ Moves filePath into the store (unless there is a blob with the same
+        contents already) and makes dstFilePath a hard link to the blob.
+        blobHash identifies the contents, by default it is the hash of the
+        file. Returns the number of bytes added to the cache, i.e. 0 if the
+        file was deduplicated. Raises OSError if hard links are not supported,
+        leaving filePath in place. """
+        blobPath = self.blobPath(blobHash or getFileHash(filePath))
+        try:
+            # A blob which is not linked by any cache entry was already
+            # unaccounted for when the last entry using it was removed.
+            orphaned = os.stat(blobPath).st_nlink <= 1
+            os.link(blobPath, dstFilePath)
+            os.remove(filePath)
+            return os.path.getsize(dstFilePath) if orphaned else 0
+        except FileNotFoundError:
+            pass
+
+        ensureDirectoryExists(os.path.dirname(blobPath))
+        os.link(filePath, dstFilePath)
+        try:
+            # If some other process stored the same blob concurrently, its
+            # cache entries keep their own (identical) copy.
+            os.replace(filePath, blobPath)
+        except OSError:
+            os.remove(filePath)
+        return os.path.getsize(dstFilePath)
+
+    def collectGarbage(self, blobHashes=None):
+        """ Removes the given blobs if they are not linked by any cache entry
+        anymore. Without blobHashes, all blobs are checked, which requires
+        walking the whole store. """
+        if blobHashes is not None:
+            paths = [self.blobPath(blobHash) for blobHash in blobHashes]
+        elif os.path.isdir(self._blobsRootDir):
+            paths = [os.path.join(blobSectionDir, name)
+                     for blobSectionDir in childDirectories(self._blobsRootDir)
+                     for name in os.listdir(blobSectionDir)]
+        else:
+            paths = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                if path.endswith('.tmp'):
+                    # Leftovers of interrupted processes
+                    if stat.st_mtime < time.time() - CLEANUP_REQUEST_TIMEOUT:
+                        os.remove(path)
+                elif stat.st_nlink <= 1:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class CorruptCacheEntryException(Exception):
+    pass
+
+
+class CacheEntrySerializer(object):
+    """ Cache entries are stored as a single file, or as a record in a pack
+    file: a header, followed by the name of the compression method of the
+    object file, the key (only for records in pack files), the compiler's
+    stdout and stderr and the (possibly compressed) object file. The header
+    holds a CRC-32 of everything following it, such that damaged or incomplete
+    entries are detected instead of restoring a broken object file. Since
+    version 2, the header ends with the compile duration in milliseconds (0 if
+    unknown). """
+    MAGIC = b'CLCE'
+    VERSION = 2
+    # magic, version, length of compression name, key length, stdout length,
+    # stderr length, object length, CRC-32
+    _headerVersion1 = struct.Struct('<4sBBHIIQI')
+    # ... plus compile duration
+    _header = struct.Struct('<4sBBHIIQII')
+
+    @staticmethod
+    def headerSize():
+        return CacheEntrySerializer._header.size
+
+    @staticmethod
+    def durationMs(compileDuration):
+        """ Converts a compile duration in seconds (None if unknown) to the
+        milliseconds stored in the header. """
+        return int(round(compileDuration * 1000)) if compileDuration is not None else 0
+
+    @staticmethod
+    def serialize(artifacts, compression=None, compressionLevel=None, key=''):
+        with open(artifacts.objectFilePath, 'rb') as f:
+            objectData = f.read()
+        if compression is not None:
+            compressor = OBJECT_COMPRESSIONS[compression][0](compressionLevel)
+            objectData = compressor.compress(objectData) + compressor.flush()
+        parts = [
+            (compression or '').encode('ascii'),
+            key.encode('ascii'),
+            artifacts.stdout.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+            artifacts.stderr.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+            objectData,
+        ]
+        checksum = 0
+        for part in parts:
+            checksum = zlib.crc32(part, checksum)
+        header = CacheEntrySerializer._header.pack(
+            CacheEntrySerializer.MAGIC, CacheEntrySerializer.VERSION,
+            *([len(part) for part in parts] +
+              [checksum, CacheEntrySerializer.durationMs(artifacts.compileDuration)]))
+        return b''.join([header] + parts)
+
+    @staticmethod
+    def contentHash(data):
+        """ Returns the hash of an entry, disregarding the compile duration in
+        its header, such that identical entries are deduplicated regardless of
+        how long compiling them took. """
+        header = CacheEntrySerializer._header
+        if len(data) < header.size or data[:4] != CacheEntrySerializer.MAGIC or \
+                data[4] != CacheEntrySerializer.VERSION:
+            return HashAlgorithm(data).hexdigest()
+        hasher = HashAlgorithm(data[:header.size - 4])
+        hasher.update(b'\0' * 4)
+        hasher.update(memoryview(data)[header.size:])
+        return hasher.hexdigest()
+
+    @staticmethod
+    def compileDuration(data):
+        """ Returns the compile duration (in seconds) stored in the header at
+        the start of data, None if unknown. """
+        header = CacheEntrySerializer._header
+        if len(data) < header.size or data[:4] != CacheEntrySerializer.MAGIC or \
+                data[4] != CacheEntrySerializer.VERSION:
+            return None
+        durationMs = header.unpack(data[:header.size])[-1]
+        return durationMs / 1000.0 if durationMs else None
+
+    @staticmethod
+    def restore(inFile, length, objectFilePath, key='', sourceName=None):
+        """ Reads an entry of the given length from the current position of
+        inFile, writes its object file to objectFilePath and returns the
+        artifacts of the entry. """
+        sourceName = sourceName or key
+        (compressionLength, keyLength, stdoutLength, stderrLength, objectLength), checksum, durationMs = \
+            CacheEntrySerializer._readHeader(inFile, length, sourceName)
+
+        data = inFile.read(compressionLength + keyLength + stdoutLength + stderrLength)
+        compression = data[:compressionLength].decode('ascii') or None
+        position = compressionLength
+        if data[position:position + keyLength] != key.encode('ascii'):
+            raise CorruptCacheEntryException("Cache entry {} belongs to another key".format(sourceName))
+        position += keyLength
+        stdout = data[position:position + stdoutLength]
+        stderr = data[position + stdoutLength:position + stdoutLength + stderrLength]
+        if compression is not None and compression not in OBJECT_COMPRESSIONS:
+            raise CorruptCacheEntryException(
+                "Cache entry {} uses unsupported compression {}".format(sourceName, compression))
+
+        CacheEntrySerializer._restoreObjectFile(
+            inFile, objectLength, compression, objectFilePath, zlib.crc32(data), checksum, sourceName)
+        return CompilerArtifacts(
+            objectFilePath,
+            stdout.decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+            stderr.decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+            durationMs / 1000.0 if durationMs else None)
+
+    @staticmethod
+    def _readHeader(inFile, length, sourceName):
+        # Returns the lengths of the parts following the header, the CRC-32
+        # and the compile duration (in milliseconds) of an entry of the given
+        # length.
+        header = CacheEntrySerializer._headerVersion1
+        data = inFile.read(header.size)
+        if len(data) < header.size:
+            raise CorruptCacheEntryException("Cache entry {} is truncated".format(sourceName))
+        version = header.unpack(data)[1]
+        if version == 2:
+            header = CacheEntrySerializer._header
+            data += inFile.read(header.size - len(data))
+            if len(data) < header.size:
+                raise CorruptCacheEntryException("Cache entry {} is truncated".format(sourceName))
+        fields = header.unpack(data)
+        lengths = fields[2:7]
+        if fields[0] != CacheEntrySerializer.MAGIC or version not in (1, 2) or header.size + sum(lengths) != length:
+            raise CorruptCacheEntryException("Cache entry {} is invalid or truncated".format(sourceName))
+        return lengths, fields[7], fields[8] if version == 2 else 0
+
+    @staticmethod
+    def _restoreObjectFile(inFile, objectLength, compression, objectFilePath, checksum, expectedChecksum,
+                           sourceName):
+        # Reads the object file following the compiler output, checksum being
+        # the CRC-32 of the entry up to the object file.
+        ensureDirectoryExists(os.path.dirname(os.path.abspath(objectFilePath)))
+        tempFile = objectFilePath + '.tmp'
+        try:
+            with open(tempFile, 'wb') as outFile:
+                decompressor = OBJECT_COMPRESSIONS[compression][1]() if compression is not None else None
+                remaining = objectLength
+                while remaining > 0:
+                    chunk = inFile.read(min(remaining, COMPRESSION_BUFFER_SIZE))
+                    if not chunk:
+                        raise CorruptCacheEntryException("Cache entry {} is truncated".format(sourceName))
+                    remaining -= len(chunk)
+                    checksum = zlib.crc32(chunk, checksum)
+                    outFile.write(decompressor.decompress(chunk) if decompressor is not None else chunk)
+                if checksum != expectedChecksum or (decompressor is not None and not decompressor.eof):
+                    raise CorruptCacheEntryException("Cache entry {} is damaged".format(sourceName))
+        except DECOMPRESSION_ERRORS as e:
+            os.remove(tempFile)
+            raise CorruptCacheEntryException("Cache entry {} is damaged".format(sourceName)) from e
+        except:
+            os.remove(tempFile)
+            raise
+        os.replace(tempFile, objectFilePath)
+
+
+class CompilerArtifactsSection(object):
+    """ Cache entries are either stored as a single file (see
+    CacheEntrySerializer), or appended as a record to one of the pack files of
+    the section. Cache entries written by older clcache versions, and those
+    written with CLCACHE_HARDLINK set (such that the object file can be hard
+    linked), are directories holding the object file and the compiler output
+    in separate files. """
+    _packFileName = re.compile(r'pack-(\d+)\.dat$')
+
+    def __init__(self, compilerArtifactsSectionDir, blobStore=None, packIndex=None, remote=None, shared=False):
+        self.compilerArtifactsSectionDir = compilerArtifactsSectionDir
+        self._blobStore = blobStore
+        self._remote = remote
+        self._shared = shared
+        self.lock = CacheLock.forPath(self.compilerArtifactsSectionDir, shared)
+        self.index = SectionIndex(self.compilerArtifactsSectionDir + '.index')
+        self.packIndex = packIndex or PackIndex(os.path.join(self.compilerArtifactsSectionDir, 'packs.index'))
+
+    def cacheEntryPath(self, key):
+        # Either a file or a directory
+        return os.path.join(self.compilerArtifactsSectionDir, key)
+
+    def cacheEntries(self):
+        try:
+            # Skips pack files, the pack index and temporary files
+            keys = {name for name in os.listdir(self.compilerArtifactsSectionDir) if '.' not in name}
+        except OSError:
+            keys = set()
+        return sorted(keys | set(self.packIndex.entries()))
+
+    def packFilePath(self, packFile):
+        return os.path.join(self.compilerArtifactsSectionDir, "pack-{}.dat".format(packFile))
+
+    def packFiles(self):
+        packFiles = []
+        try:
+            for name in os.listdir(self.compilerArtifactsSectionDir):
+                match = CompilerArtifactsSection._packFileName.match(name)
+                if match:
+                    packFiles.append(int(match.group(1)))
+        except OSError:
+            pass
+        return sorted(packFiles)
+
+    def cachedObjectName(self, key):
+        # Only for cache entries stored as directories
+        return os.path.join(self.cacheEntryPath(key), "object")
+
+    def hasEntry(self, key):
+        return key in self.packIndex.entries() or os.path.exists(self.cacheEntryPath(key))
+
+    def setEntry(self, key, artifacts, compression=None, compressionLevel=None, packed=False):
+        """ Returns the number of bytes added to the cache. The entry is also
+        uploaded to the remote cache, if any. """
+        # An entry file which is replaced may leave its blob unused
+        replacedBlob = None
+        if os.path.isfile(self.cacheEntryPath(key)):
+            replacedBlob = self.index.entries().get(key, [None] * 4)[3]
+        self._removeFromDisk(key)
+        if replacedBlob is not None:
+            self._blobStore.collectGarbage([replacedBlob])
+        # Entries of a shared cache are always published by renaming a single
+        # file, such that readers don't need to lock.
+        if artifacts.objectFilePath is None or ("CLCACHE_HARDLINK" in os.environ and not self._shared):
+            storedSize = self._setDirectoryEntry(key, artifacts)
+        elif packed and not self._shared:
+            storedSize = self._setPackedEntry(key, artifacts, compression, compressionLevel)
+        else:
+            data = CacheEntrySerializer.serialize(artifacts, compression, compressionLevel)
+            storedSize = self.setEntryData(key, data)
+            if self._remote is not None:
+                self._remote.put('objects', key, data)
+            return storedSize
+
+        if self._remote is not None and artifacts.objectFilePath is not None:
+            self._remote.put('objects', key, CacheEntrySerializer.serialize(artifacts, compression, compressionLevel))
+        return storedSize
+
+    def fetchEntry(self, key):
+        """ Copies the entry from the remote cache (if any) into this section.
+        Returns the number of bytes added to the cache, or None if the remote
+        cache does not have the entry. Takes the lock of the section only for
+        storing the entry. """
+        if self._remote is None:
+            return None
+        data = self._remote.get('objects', key)
+        if data is None:
+            return None
+        with self.lock:
+            if self.hasEntry(key):
+                return 0
+            return self.setEntryData(key, data)
+
+    def setEntryData(self, key, data):
+        """ Stores an entry given in the format written by
+        CacheEntrySerializer (without key). Returns the number of bytes added
+        to the cache. """
+        ensureDirectoryExists(self.compilerArtifactsSectionDir)
+        tempFile = writeTemporaryFile(self.compilerArtifactsSectionDir, data)
+        entryPath = self.cacheEntryPath(key)
+        # The entry may be linked to an existing blob written with a different
+        # compile duration; the index records the duration of this entry.
+        storedSize, blobHash = self._addToBlobStore(
+            tempFile, entryPath, CacheEntrySerializer.contentHash(data) if self._blobStore is not None else None)
+        self.index.addEntry(key, os.path.getsize(entryPath), CacheEntrySerializer.compileDuration(data), blobHash)
+        return storedSize
+
+    def _addToBlobStore(self, filePath, dstFilePath, blobHash):
+        # Returns the number of bytes added to the cache and the blob which
+        # dstFilePath is linked to (if any)
+        if self._blobStore is not None:
+            try:
+                return self._blobStore.add(filePath, dstFilePath, blobHash), blobHash
+            except OSError:
+                # E.g. the file system does not support hard links or the
+                # maximum number of links of the blob is reached
+                if os.path.exists(dstFilePath):
+                    os.remove(dstFilePath)
+        os.replace(filePath, dstFilePath)
+        return os.path.getsize(dstFilePath), None
+
+    def _setDirectoryEntry(self, key, artifacts):
+        # Objects of directory entries are not deduplicated: with
+        # CLCACHE_HARDLINK, the build outputs are hard links to them as well,
+        # so the number of links does not tell how many entries use them.
+        ensureDirectoryExists(self.cacheEntryPath(key))
+        storedSize = 0
+        if artifacts.objectFilePath is not None:
+            copyOrLink(artifacts.objectFilePath, self.cachedObjectName(key))
+            storedSize = os.path.getsize(self.cachedObjectName(key))
+        self._setCachedCompilerConsoleOutput(key, 'output.txt', artifacts.stdout)
+        if artifacts.stderr != '':
+            self._setCachedCompilerConsoleOutput(key, 'stderr.txt', artifacts.stderr)
+        if artifacts.objectFilePath is not None:
+            self.index.addEntry(key, storedSize, artifacts.compileDuration)
+        return storedSize
+
+    def _setPackedEntry(self, key, artifacts, compression, compressionLevel):
+        record = CacheEntrySerializer.serialize(artifacts, compression, compressionLevel, key)
+        ensureDirectoryExists(self.compilerArtifactsSectionDir)
+        packFiles = self.packFiles()
+        packFile = packFiles[-1] if packFiles else 0
+        if packFiles and os.path.getsize(self.packFilePath(packFile)) >= MAX_PACK_FILE_SIZE:
+            packFile += 1
+        with open(self.packFilePath(packFile), 'ab') as f:
+            offset = f.tell()
+            f.write(record)
+        # Only listed once the record is complete
+        self.packIndex.addEntry(key, packFile, offset, len(record))
+        self.index.addEntry(key, len(record), artifacts.compileDuration)
+        return len(record)
+
+    @property
+    def readLock(self):
+        # Readers of a shared cache don't lock, entries are replaced
+        # atomically.
+        return contextlib.ExitStack() if self._shared else self.lock
+
+    def touchEntry(self, key):
+        if self._shared:
+            # Readers of a shared cache don't write to the index. Instead, the
+            # cleaner checks the modification time before removing an entry.
+            touchFile(self.cacheEntryPath(key))
+        else:
+            self.index.touchEntry(key)
+
+    def lastUseTime(self, key):
+        return lastModificationTime(self.cacheEntryPath(key))
+
+    def removeEntry(self, key):
+        """ Returns the number of bytes freed, which is 0 if the entry is
+        still shared with other cache entries. Records in pack files are only
+        removed from disk when compacting the pack files. """
+        freedSize = self._removeFromDisk(key)
+        self.index.removeEntry(key)
+        return freedSize
+
+    def _removeFromDisk(self, key):
+        freedSize = 0
+        location = self.packIndex.entries().get(key)
+        if location is not None:
+            self.packIndex.removeEntry(key)
+            freedSize += location[2]
+
+        entryPath = self.cacheEntryPath(key)
+        isDirectory = os.path.isdir(entryPath)
+        try:
+            if isDirectory:
+                freedSize += os.path.getsize(self.cachedObjectName(key))
+            else:
+                stat = os.stat(entryPath)
+                # One link for this entry, one for the blob (if any)
+                freedSize += stat.st_size if stat.st_nlink <= 2 else 0
+        except OSError:
+            pass
+        if isDirectory:
+            rmtree(entryPath, ignore_errors=True)
+        elif os.path.exists(entryPath):
+            os.remove(entryPath)
+        return freedSize
+
+    def indexedEntries(self):
+        # Sections created by older clcache versions (or whose index was
+        # deleted) are indexed on first use.
+        if not self.index.exists():
+            self.rebuildIndex()
+        return self.index.entries()
+
+    def rebuildIndex(self):
+        entries = {}
+        packedEntries = self.packIndex.entries()
+        for key in self.cacheEntries():
+            offset = 0
+            if key in packedEntries:
+                packFile, offset, length = packedEntries[key]
+                path = self.packFilePath(packFile)
+            else:
+                path = self.cacheEntryPath(key)
+                if os.path.isdir(path):
+                    path = self.cachedObjectName(key)
+                    offset = None
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            size = length if key in packedEntries else stat.st_size
+            durationMs = self._storedCompileDurationMs(path, offset) if offset is not None else 0
+            blobHash = self._linkedBlobHash(path, stat) if offset == 0 and key not in packedEntries else None
+            entries[key] = [size, int(max(stat.st_atime, stat.st_mtime)), durationMs, blobHash]
+        self.index.rewrite(entries)
+
+    def _linkedBlobHash(self, entryPath, stat):
+        # Determines the blob which an entry file is linked to, if any
+        if self._blobStore is None or stat.st_nlink <= 1:
+            return None
+        try:
+            with open(entryPath, 'rb') as f:
+                blobHash = CacheEntrySerializer.contentHash(f.read())
+            return blobHash if os.path.samefile(entryPath, self._blobStore.blobPath(blobHash)) else None
+        except OSError:
+            return None
+
+    @staticmethod
+    def _storedCompileDurationMs(path, offset):
+        # Reads the compile duration from the header of an entry
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                compileDuration = CacheEntrySerializer.compileDuration(f.read(CacheEntrySerializer.headerSize()))
+        except OSError:
+            return 0
+        return CacheEntrySerializer.durationMs(compileDuration)
+
+    def compactPacks(self):
+        """ Copies the records of all entries into new pack files if enough
+        space is taken up by removed entries. Requires holding the lock of the
+        section. """
+        packFiles = self.packFiles()
+        if not packFiles:
+            return
+        entries = self.packIndex.entries()
+        totalSize = sum(os.path.getsize(self.packFilePath(packFile)) for packFile in packFiles)
+        liveSize = sum(length for _, _, length in entries.values())
+        if totalSize - liveSize <= totalSize * PACK_COMPACTION_THRESHOLD:
+            return
+
+        newEntries = {}
+        newPackFile = packFiles[-1]
+        outFile = None
+        inFiles = {}
+        try:
+            # In the order of the records, such that the old pack files are
+            # read sequentially
+            for key, (packFile, offset, length) in sorted(entries.items(), key=lambda item: item[1]):
+                if outFile is None or outFile.tell() >= MAX_PACK_FILE_SIZE:
+                    if outFile is not None:
+                        outFile.close()
+                    newPackFile += 1
+                    outFile = open(self.packFilePath(newPackFile), 'wb')
+                if packFile not in inFiles:
+                    inFiles[packFile] = open(self.packFilePath(packFile), 'rb')
+                inFiles[packFile].seek(offset)
+                newEntries[key] = (newPackFile, outFile.tell(), length)
+                outFile.write(inFiles[packFile].read(length))
+        finally:
+            if outFile is not None:
+                outFile.close()
+            for inFile in inFiles.values():
+                inFile.close()
+
+        self.packIndex.rewrite(newEntries)
+        for packFile in packFiles:
+            try:
+                os.remove(self.packFilePath(packFile))
+            except OSError:
+                # Removed when compacting the next time
+                pass
+
+    def restoreEntry(self, key, objectFilePath):
+        """ Copies the object file of the given entry to objectFilePath.
+        Returns the artifacts of the entry. Raises CorruptCacheEntryException
+        if the entry is damaged. """
+        location = self.packIndex.entries().get(key)
+        if location is not None:
+            return self._restorePackedEntry(key, location, objectFilePath)
+
+        entryPath = self.cacheEntryPath(key)
+        if os.path.isdir(entryPath):
+            cachedArtifacts = self.getEntry(key)
+            if not os.path.exists(cachedArtifacts.objectFilePath):
+                raise CorruptCacheEntryException("Cache entry {} has no object file".format(entryPath))
+            copyOrLink(cachedArtifacts.objectFilePath, objectFilePath)
+            # Directory entries keep their compile duration in the index only
+            durationMs = self.index.entries().get(key, [0, 0, 0])[2]
+            return CompilerArtifacts(objectFilePath, cachedArtifacts.stdout, cachedArtifacts.stderr,
+                                     durationMs / 1000.0 if durationMs else None)
+
+        with open(entryPath, 'rb') as f:
+            return CacheEntrySerializer.restore(
+                f, os.fstat(f.fileno()).st_size, objectFilePath, sourceName=entryPath)
+
+    def entryData(self, key):
+        """ Returns the entry in the format written by CacheEntrySerializer
+        (without key). """
+        entryPath = self.cacheEntryPath(key)
+        if key not in self.packIndex.entries() and not os.path.isdir(entryPath):
+            with open(entryPath, 'rb') as f:
+                return f.read()
+
+        handle, tempFile = tempfile.mkstemp(dir=self.compilerArtifactsSectionDir, suffix='.tmp')
+        os.close(handle)
+        try:
+            return CacheEntrySerializer.serialize(self.restoreEntry(key, tempFile))
+        finally:
+            os.remove(tempFile)
+
+    def _restorePackedEntry(self, key, location, objectFilePath):
+        packFile, offset, length = location
+        packFilePath = self.packFilePath(packFile)
+        with open(packFilePath, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # Empty files cannot be mapped
+                raise CorruptCacheEntryException("Record for {} in {} is truncated".format(key, packFilePath)) from e
+            with contextlib.closing(data):
+                if offset + length > len(data):
+                    raise CorruptCacheEntryException("Record for {} in {} is truncated".format(key, packFilePath))
+                data.seek(offset)
+                return CacheEntrySerializer.restore(
+                    data, length, objectFilePath, key, "{} in {}".format(key, packFilePath))
+
+    def getEntry(self, key):
+        # Only for cache entries stored as directories
+        assert self.hasEntry(key)
+        fileNames = os.listdir(self.cacheEntryPath(key))
+        return CompilerArtifacts(
+            self.cachedObjectName(key),
+            self._getCachedCompilerConsoleOutput(key, 'output.txt'),
+            self._getCachedCompilerConsoleOutput(key, 'stderr.txt') if 'stderr.txt' in fileNames else ''
+            )
+
+    def _getCachedCompilerConsoleOutput(self, key, fileName):
+        try:
+            outputFilePath = os.path.join(self.cacheEntryPath(key), fileName)
+            with open(outputFilePath, 'rb') as f:
+                return f.read().decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
+        except IOError:
+            return ''
+
+    def _setCachedCompilerConsoleOutput(self, key, fileName, output):
+        outputFilePath = os.path.join(self.cacheEntryPath(key), fileName)
+        with open(outputFilePath, 'wb') as f:
+            f.write(output.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC))
+
+
+class CompilerArtifactsRepository(object):
+    def __init__(self, compilerArtifactsRootDir, blobStore=None, remote=None, shared=False):
+        self._compilerArtifactsRootDir = compilerArtifactsRootDir
+        self.blobStore = blobStore
+        self.remote = remote
+        self.shared = shared
+        # Kept across sections, such that the pack indices are only read
+        # once by long-lived processes
+        self._packIndices = {}
+
+    def _section(self, compilerArtifactsSectionDir):
+        packIndex = self._packIndices.get(compilerArtifactsSectionDir)
+        if packIndex is None:
+            packIndex = PackIndex(os.path.join(compilerArtifactsSectionDir, 'packs.index'))
+            self._packIndices[compilerArtifactsSectionDir] = packIndex
+        return CompilerArtifactsSection(
+            compilerArtifactsSectionDir, self.blobStore, packIndex, self.remote, self.shared)
+
+    def section(self, key):
+        return self._section(os.path.join(self._compilerArtifactsRootDir, key[:2]))
+
+    def sections(self):
+        return (self._section(path) for path in sorted(childDirectories(self._compilerArtifactsRootDir)))
+
+    def removeEntry(self, keyToBeRemoved):
+        self.section(keyToBeRemoved).removeEntry(keyToBeRemoved)
+
+    def clean(self, maxCompilerArtifactsSize, policy='lru'):
+        # The sizes in the indices are used to fix up the stored cacheSize.
+        # Objects shared by several entries are counted for each of them, so
+        # this may remove more entries than strictly necessary.
+        count, size, blobHashes = evictLeastRecentlyUsed(
+            [(section, section.indexedEntries()) for section in self.sections()], maxCompilerArtifactsSize, policy)
+        for section in self.sections():
+            section.compactPacks()
+        self.collectGarbage(blobHashes)
+        return count, size - self.duplicateBytes()
+
+    def rebuildIndex(self):
+        for section in self.sections():
+            section.rebuildIndex()
+
+    def collectGarbage(self, blobHashes=None):
+        """ Removes the given blobs (all blobs by default) if they are not
+        used anymore. """
+        if self.blobStore is not None:
+            self.blobStore.collectGarbage(blobHashes)
+
+    def duplicateBytes(self):
+        """ Returns the number of bytes by which the sum of the sizes in the
+        indices exceeds the deduplicated size: entries linked to the same blob
+        are listed with the full size each. """
+        blobSizes = {}
+        blobLinks = defaultdict(int)
+        for section in self.sections():
+            for size, _, _, blobHash in section.indexedEntries().values():
+                if blobHash is not None:
+                    blobSizes[blobHash] = size
+                    blobLinks[blobHash] += 1
+        return sum(blobSizes[blobHash] * (links - 1) for blobHash, links in blobLinks.items())
+
+    @staticmethod
+    def computeKeyDirect(manifestHash, includesContentHash):
+        # We must take into account manifestHash to avoid
+        # collisions when different source files use the same
+        # set of includes.
+        return getStringHash(manifestHash + includesContentHash)
+
+    @staticmethod
+    def computeKeyNodirect(compilerBinary, commandLine, environment):
+        ppcmd = ["/EP"] + [arg for arg in commandLine if arg not in ("-c", "/c")]
+
+        returnCode, preprocessedSourceCode, ppStderrBinary = \
+            invokeRealCompiler(compilerBinary, ppcmd, captureOutput=True, outputAsString=False, environment=environment)
+
+        if returnCode != 0:
+            printBinary(sys.stderr, ppStderrBinary)
+            print("clcache: preprocessor failed", file=sys.stderr)
+            sys.exit(returnCode)
+
+        compilerHash = getCompilerHash(compilerBinary)
+        normalizedCmdLine = CompilerArtifactsRepository._normalizedCommandLine(commandLine)
+
+        h = HashAlgorithm()
+        h.update(compilerHash.encode("UTF-8"))
+        h.update(' '.join(normalizedCmdLine).encode("UTF-8"))
+        h.update(preprocessedSourceCode)
+        return h.hexdigest()
+
+    @staticmethod
+    def _normalizedCommandLine(cmdline):
+        # Remove all arguments from the command line which only influence the
+        # preprocessor; the preprocessor's output is already included into the
+        # hash sum so we don't have to care about these switches in the
+        # command line as well.
+        argsToStrip = ("AI", "C", "E", "P", "FI", "u", "X",
+                       "FU", "D", "EP", "Fx", "U", "I")
+
+        # Also remove the switch for specifying the output file name; we don't
+        # want two invocations which are identical except for the output file
+        # name to be treated differently.
+        argsToStrip += ("Fo",)
+
+        # Also strip the switch for specifying the number of parallel compiler
+        # processes to use (when specifying multiple source files on the
+        # command line).
+        argsToStrip += ("MP",)
+
+        return [arg for arg in cmdline
+                if not (arg[0] in "/-" and arg[1:].startswith(argsToStrip))]
+
+
+class UploadQueue(object):
+    """ Runs the uploads of new cache entries to a remote cache on background
+    threads, such that storing an entry in the local cache neither waits for
+    the remote cache nor keeps the locks of the local cache meanwhile. """
+    def __init__(self, threads):
+        self._threads = threads
+        self._executor = None
+        self._uploads = []
+        self._lock = threading.Lock()
+
+    def submit(self, upload, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+            self._uploads = [future for future in self._uploads if not future.done()]
+            self._uploads.append(self._executor.submit(upload, *args))
+
+    def wait(self):
+        """ Waits until all submitted uploads are done. """
+        with self._lock:
+            uploads, self._uploads = self._uploads, []
+        concurrent.futures.wait(uploads)
+
+
+class RemoteCache(object):
+    """ A second-level cache on an HTTP server, shared by several machines.
+    Cache entries are stored at <url>/<kind>/<key> with <kind> being either
+    'objects' or 'manifests'; they are retrieved using GET requests (a 404
+    response indicating a missing entry) and stored using PUT requests. New
+    entries are uploaded in the background. Connections are kept open and
+    reused by subsequent requests of the same thread. Unless readOnly is set,
+    new entries are uploaded. After the server could not be reached once, the
+    remote cache is not used anymore by this process. """
+    def __init__(self, url, readOnly=False, timeoutMs=REMOTE_CACHE_TIMEOUT_MS):
+        self._url = urllib.parse.urlsplit(url)
+        self._timeout = timeoutMs / 1000
+        self.readOnly = readOnly
+        self._connections = threading.local()
+        self._unreachable = False
+        self._uploads = UploadQueue(REMOTE_CACHE_UPLOAD_THREADS)
+
+    def _request(self, method, kind, key, body=None):
+        url = '{}/{}/{}'.format(self._url.path.rstrip('/'), kind, key)
+        while True:
+            connection = getattr(self._connections, 'connection', None)
+            reused = connection is not None
+            if not reused:
+                connectionClass = http.client.HTTPSConnection if self._url.scheme == 'https' \
+                    else http.client.HTTPConnection
+                connection = connectionClass(self._url.netloc, timeout=self._timeout)
+                self._connections.connection = connection
+            try:
+                connection.request(method, url, body=body)
+                response = connection.getresponse()
+                # Reading the whole body is required for reusing the connection
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                self._connections.connection = None
+                # The server may have closed a connection kept open
+                if not reused:
+                    raise
+
+    def get(self, kind, key):
+        """ Returns the contents of the entry, or None if it is missing or the
+        server could not be reached. """
+        if self._unreachable:
+            return None
+        try:
+            status, data = self._request('GET', kind, key)
+        except (OSError, http.client.HTTPException) as e:
+            printTraceStatement("Remote cache unreachable: {}".format(e))
+            self._unreachable = True
+            return None
+        if status != 200:
+            return None
+        return data
+
+    def put(self, kind, key, data):
+        """ Uploads the entry in the background; see flush(). """
+        if self.readOnly or self._unreachable:
+            return
+        self._uploads.submit(self._upload, kind, key, data)
+
+    def _upload(self, kind, key, data):
+        if self._unreachable:
+            return
+        try:
+            status, _ = self._request('PUT', kind, key, data)
+        except (OSError, http.client.HTTPException) as e:
+            printTraceStatement("Remote cache unreachable: {}".format(e))
+            self._unreachable = True
+            return
+        if not 200 <= status < 300:
+            printTraceStatement("Remote cache refused {} {}: HTTP status {}".format(kind, key, status))
+
+    def flush(self):
+        """ Waits until all entries passed to put() are uploaded. """
+        self._uploads.wait()
+
+    @staticmethod
+    def serializeManifest(manifest):
+        # Fingerprints describe the header files on the machine which created
+        # the manifest, so they are not shared.
+        return json.dumps({'entries': [{
+            'includeFiles': entry.includeFiles,
+            'includesContentHash': entry.includesContentHash,
+            'objectHash': entry.objectHash,
+        } for entry in manifest.entries()]}, sort_keys=True).encode('utf-8')
+
+    @staticmethod
+    def deserializeManifest(data):
+        """ Returns a Manifest; raises ValueError if data is no valid
+        manifest. """
+        try:
+            doc = json.loads(data.decode('utf-8'))
+            return Manifest([ManifestEntry(entry['includeFiles'], {}, entry['includesContentHash'], entry['objectHash'])
+                             for entry in doc['entries']])
+        except (UnicodeDecodeError, KeyError, TypeError) as e:
+            raise ValueError("Invalid remote manifest: {}".format(e)) from e
+
+
+@contextlib.contextmanager
+def allSectionsLocked(repository):
+    lockedSections = []
+    try:
+        for section in repository.sections():
+            section.lock.acquire()
+            lockedSections.append(section)
+        yield
+    finally:
+        for section in reversed(lockedSections):
+            section.lock.release()
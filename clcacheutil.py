@@ -0,0 +1,461 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# Settings, hashing, locking and file helpers shared by the clcache modules.
+#
+import concurrent.futures
+import errno
+import hashlib
+import os
+from shutil import copyfile
+import subprocess
+from subprocess import Popen, PIPE
+import sys
+import multiprocessing
+import tempfile
+import threading
+import time
+
+try:
+    from ctypes import windll, wintypes
+except ImportError:
+    # Not running on Windows
+    windll = wintypes = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+VERSION = "3.2.0-dev"
+
+# Hash algorithms which can be selected using the CLCACHE_HASH_ALGORITHM
+# environment variable. All of them produce 128 bit digests.
+HASH_ALGORITHMS = {'md5': hashlib.md5}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = lambda data=b'': hashlib.blake2b(data, digest_size=16)
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGORITHMS['xxh3'] = xxhash.xxh3_128
+
+DEFAULT_HASH_ALGORITHM = 'blake2b' if 'blake2b' in HASH_ALGORITHMS else 'md5'
+
+
+def selectHashAlgorithm(name):
+    if name in HASH_ALGORITHMS:
+        return name, HASH_ALGORITHMS[name]
+    return DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS[DEFAULT_HASH_ALGORITHM]
+
+HASH_ALGORITHM_NAME = selectHashAlgorithm(os.environ.get('CLCACHE_HASH_ALGORITHM'))[0]
+HashAlgorithm = HASH_ALGORITHMS[HASH_ALGORITHM_NAME]
+
+# Files are hashed in chunks of this size.
+HASH_BUFFER_SIZE = 128 * 1024
+
+HASHING_THREADS = max(4, min(16, multiprocessing.cpu_count() * 2))
+
+# try to use os.scandir or scandir.scandir
+# fall back to os.listdir if not found
+# same for scandir.walk
+try:
+    import scandir # pylint: disable=wrong-import-position
+    WALK = scandir.walk
+    LIST = scandir.scandir
+except ImportError:
+    WALK = os.walk
+    try:
+        LIST = os.scandir # pylint: disable=no-name-in-module
+    except AttributeError:
+        LIST = os.listdir
+
+# The cl default codec; 'mbcs' is only available on Windows
+CL_DEFAULT_CODEC = 'mbcs' if os.name == 'nt' else 'utf-8'
+
+# String, by which BASE_DIR will be replaced in paths, stored in manifests.
+# ? is invalid character for file name, so it seems ok
+# to use it as mark for relative path.
+BASEDIR_REPLACEMENT = '?'
+
+
+def printBinary(stream, rawData):
+    stream.buffer.write(rawData)
+
+
+def filesBeneath(path):
+    for path, _, filenames in WALK(path):
+        for filename in filenames:
+            yield os.path.join(path, filename)
+
+
+def childDirectories(path, absolute=True):
+    supportsScandir = (LIST != os.listdir)
+    for entry in LIST(path):
+        if supportsScandir:
+            if entry.is_dir():
+                yield entry.path if absolute else entry.name
+        else:
+            absPath = os.path.join(path, entry)
+            if os.path.isdir(absPath):
+                yield absPath if absolute else entry
+
+
+def normalizeBaseDir(baseDir):
+    if baseDir:
+        baseDir = os.path.normcase(baseDir)
+        if not baseDir.endswith(os.path.sep):
+            baseDir += os.path.sep
+        return baseDir
+    else:
+        # Converts empty string to None
+        return None
+
+
+class IncludeNotFoundException(Exception):
+    pass
+
+
+class IncludeChangedException(Exception):
+    pass
+
+
+class CacheLockException(Exception):
+    pass
+
+
+class LogicException(Exception):
+    def __init__(self, message):
+        super(LogicException, self).__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+
+class CacheLock(object):
+    """ Implements a lock for the object cache which
+    can be used in 'with' statements. """
+    INFINITE = 0xFFFFFFFF
+    WAIT_ABANDONED_CODE = 0x00000080
+    WAIT_TIMEOUT_CODE = 0x00000102
+
+    def __init__(self, mutexName, timeoutMs):
+        self._mutexName = 'Local\\' + mutexName
+        self._mutex = windll.kernel32.CreateMutexW(
+            wintypes.INT(0),
+            wintypes.INT(0),
+            self._mutexName)
+        self._timeoutMs = timeoutMs
+        assert self._mutex
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, typ, value, traceback):
+        self.release()
+
+    def __del__(self):
+        windll.kernel32.CloseHandle(self._mutex)
+
+    def acquire(self):
+        result = windll.kernel32.WaitForSingleObject(
+            self._mutex, wintypes.INT(self._timeoutMs))
+        if result not in [0, self.WAIT_ABANDONED_CODE]:
+            if result == self.WAIT_TIMEOUT_CODE:
+                errorString = \
+                    'Failed to acquire lock {} after {}ms; ' \
+                    'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
+                        self._mutexName, self._timeoutMs)
+            else:
+                errorString = 'Error! WaitForSingleObject returns {result}, last error {error}'.format(
+                    result=result,
+                    error=windll.kernel32.GetLastError())
+            raise CacheLockException(errorString)
+
+    def release(self):
+        windll.kernel32.ReleaseMutex(self._mutex)
+
+    @staticmethod
+    def forPath(path, shared=False):
+        # Named mutexes only work within one machine, so lock files are used
+        # for caches shared by several machines.
+        timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
+        if windll is None or shared:
+            return CacheFileLock(path + '.lock', timeoutMs)
+        lockName = path.replace(':', '-').replace('\\', '-')
+        return CacheLock(lockName, timeoutMs)
+
+
+class CacheFileLock(object):
+    """ Implements a lock based on a lock file which can be used in 'with'
+    statements. Like the named mutex used by CacheLock, it may be acquired
+    recursively by the same thread. """
+    # All CacheFileLock objects for the same lock file within a process share
+    # a thread lock, a recursion counter and the open lock file.
+    _states = {}
+    _statesLock = threading.Lock()
+
+    def __init__(self, lockFilePath, timeoutMs):
+        self._lockFilePath = lockFilePath
+        self._timeoutMs = timeoutMs
+        with CacheFileLock._statesLock:
+            self._state = CacheFileLock._states.setdefault(
+                lockFilePath, {'threadLock': threading.RLock(), 'depth': 0, 'file': None})
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, typ, value, traceback):
+        self.release()
+
+    def _timeoutError(self):
+        return CacheLockException(
+            'Failed to acquire lock {} after {}ms; '
+            'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
+                self._lockFilePath, self._timeoutMs))
+
+    def acquire(self):
+        deadline = time.time() + self._timeoutMs / 1000.0
+        if not self._state['threadLock'].acquire(timeout=self._timeoutMs / 1000.0):
+            raise self._timeoutError()
+
+        if self._state['depth'] == 0:
+            try:
+                self._state['file'] = self._lockFile(deadline)
+            except (CacheLockException, OSError):
+                self._state['threadLock'].release()
+                raise
+        self._state['depth'] += 1
+
+    def release(self):
+        self._state['depth'] -= 1
+        if self._state['depth'] == 0:
+            lockFile = self._state['file']
+            self._state['file'] = None
+            if fcntl is not None:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockFile.seek(0)
+                msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+            lockFile.close()
+        self._state['threadLock'].release()
+
+    def _lockFile(self, deadline):
+        lockFile = open(self._lockFilePath, 'a+b')
+        delay = 0.001
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lockFile.seek(0)
+                    msvcrt.locking(lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+                return lockFile
+            except OSError as e:
+                if time.time() > deadline:
+                    lockFile.close()
+                    raise self._timeoutError() from e
+                time.sleep(delay)
+                delay = min(delay * 2, 0.02)
+
+
+def getCompilerHash(compilerBinary):
+    stat = os.stat(compilerBinary)
+    # The compiler hash is part of all manifest hashes and cache keys, so
+    # including the hash algorithm ensures that entries created using
+    # different algorithms never collide.
+    data = '|'.join([
+        str(stat.st_mtime),
+        str(stat.st_size),
+        VERSION,
+        HASH_ALGORITHM_NAME,
+        ])
+    hasher = HashAlgorithm()
+    hasher.update(data.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+class LazyThreadPool(object):
+    """ A thread pool which is only started when it is used the first
+    time. """
+    def __init__(self, threads):
+        self._threads = threads
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self._threads)
+            return self._executor
+
+
+HASHING_THREAD_POOL = LazyThreadPool(HASHING_THREADS)
+hashBuffers = threading.local()
+
+
+def updateHashWithFile(hasher, filePath):
+    # Each thread reuses one buffer for reading files
+    buf = getattr(hashBuffers, 'buffer', None)
+    if buf is None:
+        buf = hashBuffers.buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(filePath, 'rb', buffering=0) as inFile:
+        while True:
+            bytesRead = inFile.readinto(buf)
+            if not bytesRead:
+                break
+            hasher.update(view[:bytesRead])
+
+
+def getFileHash(filePath, additionalData=None):
+    hasher = HashAlgorithm()
+    updateHashWithFile(hasher, filePath)
+    if additionalData is not None:
+        # Encoding of this additional data does not really matter
+        # as long as we keep it fixed, otherwise hashes change.
+        # The string should fit into ASCII, so UTF8 should not change anything
+        hasher.update(additionalData.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+def getStringHash(dataString):
+    hasher = HashAlgorithm()
+    hasher.update(dataString.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+def expandBasedirPlaceholder(path, baseDir):
+    if path.startswith(BASEDIR_REPLACEMENT):
+        if not baseDir:
+            raise LogicException('No CLCACHE_BASEDIR set, but found relative path ' + path)
+        return path.replace(BASEDIR_REPLACEMENT, baseDir, 1)
+    else:
+        return path
+
+
+def collapseBasedirToPlaceholder(path, baseDir):
+    assert path == os.path.normcase(path)
+    assert baseDir == os.path.normcase(baseDir)
+    if path.startswith(baseDir):
+        return path.replace(baseDir, BASEDIR_REPLACEMENT, 1)
+    else:
+        return path
+
+
+def ensureDirectoryExists(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def writeTemporaryFile(directory, data):
+    # Returns the path of a new file in directory with the given contents,
+    # which may be a string or bytes
+    handle, tempFile = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(handle, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+    except:
+        os.remove(tempFile)
+        raise
+    return tempFile
+
+
+def writeFileAtomically(path, data):
+    """ Replaces the file at path by a file with the given contents, such that
+    readers which do not hold a lock never see a partially written file. """
+    tempFile = writeTemporaryFile(os.path.dirname(path) or None, data)
+    try:
+        os.replace(tempFile, path)
+    except OSError:
+        os.remove(tempFile)
+        raise
+
+
+def touchFile(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def lastModificationTime(path):
+    # None if the file does not exist (anymore)
+    try:
+        return int(os.path.getmtime(path))
+    except OSError:
+        return None
+
+
+def copyOrLink(srcFilePath, dstFilePath):
+    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
+
+    if "CLCACHE_HARDLINK" in os.environ:
+        ret = windll.kernel32.CreateHardLinkW(str(dstFilePath), str(srcFilePath), None)
+        if ret != 0:
+            # Touch the time stamp of the new link so that the build system
+            # doesn't confused by a potentially old time on the file. The
+            # hard link gets the same timestamp as the cached file.
+            # Note that touching the time stamp of the link also touches
+            # the time stamp on the cache (and hence on all over hard
+            # links). This shouldn't be a problem though.
+            os.utime(dstFilePath, None)
+            return
+
+    # If hardlinking fails for some reason (or it's not enabled), just
+    # fall back to moving bytes around. Always to a temporary path first to
+    # lower the chances of corrupting it.
+    tempDst = dstFilePath + '.tmp'
+    copyfile(srcFilePath, tempDst)
+    os.rename(tempDst, dstFilePath)
+
+
+def printTraceStatement(msg):
+    if "CLCACHE_LOG" in os.environ:
+        scriptDir = os.path.realpath(os.path.dirname(sys.argv[0]))
+        print(os.path.join(scriptDir, "clcache.py") + " " + msg)
+
+
+def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None):
+    realCmdline = [compilerBinary] + cmdLine
+    printTraceStatement("Invoking real compiler as {}".format(realCmdline))
+
+    environment = environment or os.environ
+
+    # Environment variable set by the Visual Studio IDE to make cl.exe write
+    # Unicode output to named pipes instead of stdout. Unset it to make sure
+    # we can catch stdout output.
+    environment.pop("VS_UNICODE_OUTPUT", None)
+
+    returnCode = None
+    stdout = b''
+    stderr = b''
+    if captureOutput:
+        compilerProcess = Popen(realCmdline, stdout=PIPE, stderr=PIPE, env=environment)
+        stdout, stderr = compilerProcess.communicate()
+        returnCode = compilerProcess.returncode
+    else:
+        returnCode = subprocess.call(realCmdline, env=environment)
+
+    printTraceStatement("Real compiler returned code {0:d}".format(returnCode))
+
+    if outputAsString:
+        stdoutString = stdout.decode(CL_DEFAULT_CODEC)
+        stderrString = stderr.decode(CL_DEFAULT_CODEC)
+        return returnCode, stdoutString, stderrString
+
+    return returnCode, stdout, stderr
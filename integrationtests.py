@@ -19,7 +19,8 @@ import sys
 import tempfile
 import unittest
 
-import clcache
+import clcacheutil
+import clcachedirectory
 
 
 PYTHON_BINARY = sys.executable
@@ -188,8 +189,8 @@ class TestCompileRuns(unittest.TestCase):
                 proc = subprocess.Popen(command['cmd'], env=testEnvironment,
                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                 stdoutBinary, stderrBinary = proc.communicate()
-                stdout = stdoutBinary.decode(clcache.CL_DEFAULT_CODEC)
-                stderr = stderrBinary.decode(clcache.CL_DEFAULT_CODEC)
+                stdout = stdoutBinary.decode(clcacheutil.CL_DEFAULT_CODEC)
+                stderr = stderrBinary.decode(clcacheutil.CL_DEFAULT_CODEC)
 
                 if not command['compileFails'] and proc.returncode != 0:
                     self.fail(
@@ -225,7 +226,7 @@ class TestHits(unittest.TestCase):
             cmd = CLCACHE_CMD + ["/nologo", "/EHsc", "/c", 'hit.cpp']
             subprocess.check_call(cmd) # Ensure it has been compiled before
 
-            cache = clcache.Cache()
+            cache = clcachedirectory.Cache()
             with cache.statistics as stats:
                 oldHits = stats.numCacheHits()
             subprocess.check_call(cmd) # This must hit now
@@ -331,7 +332,7 @@ class TestHeaderMiss(unittest.TestCase):
             process = subprocess.Popen(compileCmd, stdout=subprocess.PIPE)
             stdout, _ = process.communicate()
             self.assertEqual(process.returncode, 2)
-            self.assertTrue("C1083" in stdout.decode(clcache.CL_DEFAULT_CODEC))
+            self.assertTrue("C1083" in stdout.decode(clcacheutil.CL_DEFAULT_CODEC))
 
     # When a header included by another header becomes obsolete and disappers,
     # we must fall back to real compiler.
@@ -339,7 +340,7 @@ class TestHeaderMiss(unittest.TestCase):
         # A includes B
         with cd(os.path.join(ASSETS_DIR, "header-miss-obsolete")):
             compileCmd = CLCACHE_CMD + ["/I.", "/nologo", "/EHsc", "/c", "main.cpp"]
-            cache = clcache.Cache()
+            cache = clcachedirectory.Cache()
 
             with open("A.h", "w") as header:
                 header.write('#define INFO 1337\n')
@@ -408,7 +409,7 @@ class TestRunParallel(unittest.TestCase):
             # Compile first time
             self._buildAll()
 
-            cache = clcache.Cache()
+            cache = clcachedirectory.Cache()
             with cache.statistics as stats:
                 hits = stats.numCacheHits()
                 misses = stats.numCacheMisses()
@@ -417,7 +418,7 @@ class TestRunParallel(unittest.TestCase):
             # Compile second time
             self._buildAll()
 
-            cache = clcache.Cache()
+            cache = clcachedirectory.Cache()
             with cache.statistics as stats:
                 hits = stats.numCacheHits()
                 misses = stats.numCacheMisses()
@@ -425,7 +426,7 @@ class TestRunParallel(unittest.TestCase):
 
     def testHitViaMpSequential(self):
         with cd(os.path.join(ASSETS_DIR, "parallel")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir)
 
@@ -454,7 +455,7 @@ class TestRunParallel(unittest.TestCase):
 
     def testHitsViaMpConcurrent(self):
         with cd(os.path.join(ASSETS_DIR, "parallel")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir)
 
@@ -488,7 +489,7 @@ class TestRunParallel(unittest.TestCase):
 class TestMultipleSources(unittest.TestCase):
     def testTwo(self):
         with cd(os.path.join(ASSETS_DIR, "mutiple-sources")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir)
             baseCmd = CLCACHE_CMD + ["/nologo", "/EHsc", "/c"]
 
@@ -513,7 +514,7 @@ class TestMultipleSources(unittest.TestCase):
 
     def testFive(self):
         with cd(os.path.join(ASSETS_DIR, "mutiple-sources")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir)
             baseCmd = CLCACHE_CMD + ["/nologo", "/EHsc", "/c"]
 
@@ -561,7 +562,7 @@ class TestClearing(unittest.TestCase):
         subprocess.check_call(CLCACHE_CMD + ["-C"])
 
     def testClearIdempotency(self):
-        cache = clcache.Cache()
+        cache = clcachedirectory.Cache()
 
         self._clearCache()
         with cache.statistics as stats:
@@ -575,7 +576,7 @@ class TestClearing(unittest.TestCase):
             self.assertEqual(stats.numCacheEntries(), 0)
 
     def testClearPostcondition(self):
-        cache = clcache.Cache()
+        cache = clcachedirectory.Cache()
 
         # Compile a random file to populate cache
         cmd = CLCACHE_CMD + ["/nologo", "/EHsc", "/c", os.path.join(ASSETS_DIR, "fibonacci.cpp")]
@@ -619,7 +620,7 @@ class TestAnalysisErrorsCalls(unittest.TestCase):
             process = subprocess.Popen(baseCmd + [], stderr=subprocess.PIPE)
             _, stderr = process.communicate()
             self.assertEqual(process.returncode, 2)
-            self.assertTrue("D8003" in stderr.decode(clcache.CL_DEFAULT_CODEC))
+            self.assertTrue("D8003" in stderr.decode(clcacheutil.CL_DEFAULT_CODEC))
 
             # InvalidArgumentError
             # This must fail because cl.exe: "cl : Command line error D8004 : '/Zm' requires an argument"
@@ -627,7 +628,7 @@ class TestAnalysisErrorsCalls(unittest.TestCase):
             process = subprocess.Popen(baseCmd + ['/c', '/Zm', 'bar', "minimal.cpp"], stderr=subprocess.PIPE)
             _, stderr = process.communicate()
             self.assertEqual(process.returncode, 2)
-            self.assertTrue("D8004" in stderr.decode(clcache.CL_DEFAULT_CODEC))
+            self.assertTrue("D8004" in stderr.decode(clcacheutil.CL_DEFAULT_CODEC))
 
             # MultipleSourceFilesComplexError
             subprocess.check_call(baseCmd + ['/c', '/Tcfibonacci.c', "minimal.cpp"])
@@ -650,7 +651,7 @@ class TestPreprocessorCalls(unittest.TestCase):
             ["/nologo", "/E", "/EP"],
         ]
 
-        cache = clcache.Cache()
+        cache = clcachedirectory.Cache()
         with cache.statistics as stats:
             oldPreprocessorCalls = stats.numCallsForPreprocessing()
 
@@ -664,7 +665,7 @@ class TestPreprocessorCalls(unittest.TestCase):
 
 class TestNoDirectCalls(unittest.TestCase):
     def testPreprocessorFailure(self):
-        cache = clcache.Cache()
+        cache = clcachedirectory.Cache()
 
         oldStats = copy.copy(cache.statistics)
 
@@ -682,7 +683,7 @@ class TestNoDirectCalls(unittest.TestCase):
 
             self.assertEqual(subprocess.call(cmd, env=env), 0)
 
-            cache = clcache.Cache()
+            cache = clcachedirectory.Cache()
             with cache.statistics as stats:
                 oldHits = stats.numCacheHits()
 
@@ -692,7 +693,7 @@ class TestNoDirectCalls(unittest.TestCase):
 
     def testHitViaMpSequential(self):
         with cd(os.path.join(ASSETS_DIR, "parallel")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir, CLCACHE_NODIRECT="1")
 
@@ -721,7 +722,7 @@ class TestNoDirectCalls(unittest.TestCase):
 
     def testHitsViaMpConcurrent(self):
         with cd(os.path.join(ASSETS_DIR, "parallel")), tempfile.TemporaryDirectory() as tempDir:
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir, CLCACHE_NODIRECT="1")
 
@@ -761,7 +762,7 @@ class TestBasedir(unittest.TestCase):
                 shutil.copy("main.cpp", buildDir)
                 shutil.copy("constants.h", buildDir)
 
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             cmd = CLCACHE_CMD + ["/nologo", "/EHsc", "/c", "main.cpp"]
 
@@ -10,15 +10,20 @@
 # pylint: disable=no-self-use
 #
 from multiprocessing import cpu_count
+import functools
 import os
 import shutil
 import subprocess
 import sys
+import sysconfig
 import tempfile
 import timeit
 import unittest
 
 import clcache
+import clcacheutil
+import clcachestorage
+import clcachedirectory
 
 PYTHON_BINARY = sys.executable
 CLCACHE_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "clcache.py")
@@ -53,7 +58,7 @@ class TestConcurrency(unittest.TestCase):
         with tempfile.TemporaryDirectory() as tempDir:
             customEnv = dict(os.environ, CLCACHE_DIR=tempDir)
 
-            cache = clcache.Cache(tempDir)
+            cache = clcachedirectory.Cache(tempDir)
 
             with cache.statistics as stats:
                 self.assertEqual(stats.numCacheHits(), 0)
@@ -95,6 +100,142 @@ class TestConcurrency(unittest.TestCase):
                   .format(len(TestConcurrency.sources), cpu_count(), hotCacheConcurrent))
 
 
+class TestHashing(unittest.TestCase):
+    @staticmethod
+    def _headerFiles():
+        # Use the headers of the Windows SDK and the compiler if available,
+        # the headers of Python otherwise.
+        includeDirectories = [d for d in os.environ.get('INCLUDE', '').split(os.pathsep) if d]
+        if not includeDirectories:
+            includeDirectories = [sysconfig.get_paths()['include']]
+
+        headers = []
+        for includeDirectory in includeDirectories:
+            for path in clcacheutil.filesBeneath(includeDirectory):
+                if os.path.splitext(path)[1].lower() in ('', '.h', '.hpp', '.inl'):
+                    headers.append(path)
+        return headers
+
+    @staticmethod
+    def _readWholeFile(hashAlgorithm, path):
+        with open(path, 'rb') as inFile:
+            return hashAlgorithm(inFile.read()).hexdigest()
+
+    @staticmethod
+    def _readInChunks(hashAlgorithm, path):
+        hasher = hashAlgorithm()
+        clcacheutil.updateHashWithFile(hasher, path)
+        return hasher.hexdigest()
+
+    def testHashAlgorithms(self):
+        headers = self._headerFiles()
+        self.assertTrue(headers)
+        totalSize = sum(os.path.getsize(path) for path in headers)
+
+        for name, hashAlgorithm in sorted(clcacheutil.HASH_ALGORITHMS.items()):
+            for method in [self._readWholeFile, self._readInChunks]:
+                # Best of three runs; the first run also warms up the file system cache
+                duration = min(takeTime(lambda method=method, hashAlgorithm=hashAlgorithm:
+                                        [method(hashAlgorithm, path) for path in headers])
+                               for _ in range(3))
+                print("Hashing {} headers ({} KiB) using {} ({}): {:.3f} seconds, {:.0f} MiB/s"
+                      .format(len(headers), totalSize // 1024, name, method.__name__.lstrip('_'),
+                              duration, totalSize / 2**20 / duration))
+
+            self.assertEqual(self._readWholeFile(hashAlgorithm, headers[0]),
+                             self._readInChunks(hashAlgorithm, headers[0]))
+
+
+class TestCompression(unittest.TestCase):
+    @staticmethod
+    def _objectFiles():
+        # Use real object files if available, the Python binaries otherwise.
+        objectFiles = [path for path in clcacheutil.filesBeneath(ASSETS_DIR) if path.endswith('.obj')]
+        if not objectFiles:
+            for directory in sorted({os.path.dirname(sys.executable), sysconfig.get_paths()['platstdlib']}):
+                objectFiles.extend(path for path in clcacheutil.filesBeneath(directory)
+                                   if os.path.splitext(path)[1].lower() in ('.dll', '.pyd', '.exe', '.so'))
+        return sorted(objectFiles)[:200]
+
+    @staticmethod
+    def _storeAll(car, keys, objectFiles, compression, level):
+        for key, path in zip(keys, objectFiles):
+            car.section(key).setEntry(key, clcachestorage.CompilerArtifacts(path, '', ''), compression, level)
+
+    @staticmethod
+    def _restoreAll(car, keys, restoredFile):
+        for key in keys:
+            car.section(key).restoreEntry(key, restoredFile)
+            os.remove(restoredFile)
+
+    def testCompressionTradeOffs(self):
+        objectFiles = self._objectFiles()
+        self.assertTrue(objectFiles)
+        totalSize = sum(os.path.getsize(path) for path in objectFiles)
+
+        settings = [(None, None), ('zlib', 1), ('zlib', 6), ('zlib', 9)]
+        if 'lzma' in clcachestorage.OBJECT_COMPRESSIONS:
+            settings += [('lzma', 0), ('lzma', 6)]
+        for compression, level in settings:
+            with tempfile.TemporaryDirectory() as tempDir:
+                car = clcachestorage.CompilerArtifactsRepository(tempDir)
+                keys = ['{:032x}'.format(i) for i in range(len(objectFiles))]
+                storeDuration = takeTime(functools.partial(
+                    self._storeAll, car, keys, objectFiles, compression, level))
+                storedSize = sum(size for section in car.sections()
+                                 for size, _, _, _ in section.index.entries().values())
+
+                restoreAll = functools.partial(self._restoreAll, car, keys, os.path.join(tempDir, 'restored.obj'))
+                # Best of three runs, like a hit on a warm file system cache
+                hitDuration = min(takeTime(restoreAll) for _ in range(3))
+
+                print("Compression {}:{}: {} objects ({} KiB) stored as {} KiB ({:.1f}x entries per cache size), "
+                      "storing {:.3f} seconds, restoring {:.2f} ms per object"
+                      .format(compression or 'none', level if level is not None else '-', len(objectFiles),
+                              totalSize // 1024, storedSize // 1024, totalSize / storedSize,
+                              storeDuration, hitDuration * 1000 / len(objectFiles)))
+
+
+class TestCommandLineAnalysis(unittest.TestCase):
+    @staticmethod
+    def _cmakeCommandLine(numIncludeDirectories, numDefines):
+        # Resembles the command lines CMake generates for larger projects
+        cmdLine = ['/nologo', '/TP', '/DWIN32', '/D_WINDOWS', '/W3', '/GR', '/EHsc', '/MD', '/O2', '/Ob2']
+        cmdLine += [r'/IC:\projects\product\build\src\module{:03d}\include'.format(i)
+                    for i in range(numIncludeDirectories)]
+        cmdLine += ['/DPRODUCT_FEATURE_{:03d}=1'.format(i) for i in range(numDefines)]
+        cmdLine += ['/wd4251', '/wd4275', '/FS', r'/Fdsrc\module\CMakeFiles\module.dir\module.pdb',
+                    r'/FoCMakeFiles\module.dir\main.cpp.obj', '/c', r'C:\projects\product\src\module\main.cpp']
+        return cmdLine
+
+    def testAnalyzeLongCommandLines(self):
+        repetitions = 200
+        for numIncludeDirectories, numDefines in [(10, 10), (80, 80), (300, 200)]:
+            cmdLine = self._cmakeCommandLine(numIncludeDirectories, numDefines)
+            # Best of three runs
+            duration = min(takeTime(lambda cmdLine=cmdLine: [clcache.CommandLineAnalyzer.analyze(cmdLine)
+                                                             for _ in range(repetitions)])
+                           for _ in range(3))
+            print("Analyzing a command line with {} arguments: {:.3f} ms ({:.2f} us per argument)"
+                  .format(len(cmdLine), duration * 1000 / repetitions,
+                          duration * 10**6 / repetitions / len(cmdLine)))
+
+            options, _ = clcache.CommandLineAnalyzer.parseArgumentsAndInputFiles(cmdLine)
+            self.assertEqual(len(options['I']), numIncludeDirectories)
+            self.assertEqual(len(options['D']), numDefines + 2)
+
+    def testSplitResponseFile(self):
+        # As written by MSBuild: every argument quoted, one per line
+        cmdLine = self._cmakeCommandLine(300, 200)
+        content = '\r\n'.join('"{}"'.format(arg) for arg in cmdLine)
+        repetitions = 20
+        duration = min(takeTime(lambda: [clcache.splitCommandsFile(content) for _ in range(repetitions)])
+                       for _ in range(3))
+        print("Splitting a response file of {} KiB: {:.3f} ms"
+              .format(len(content) // 1024, duration * 1000 / repetitions))
+        self.assertEqual(clcache.splitCommandsFile(content), cmdLine)
+
+
 if __name__ == '__main__':
     unittest.TestCase.longMessage = True
     unittest.main()
@@ -0,0 +1,1572 @@
+#!/usr/bin/env python
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# In Python unittests are always members, not functions. Silence lint in this file.
+# pylint: disable=no-self-use
+#
+import http.server
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import clcache
+import clcacheutil
+import clcachestorage
+import clcachedirectory
+from clcachestorage import (
+    CompilerArtifacts,
+    CompilerArtifactsRepository,
+    Manifest,
+    ManifestEntry,
+    ManifestRepository,
+    SectionIndex,
+)
+from clcachedirectory import (
+    Configuration,
+    FileHashIndex,
+    Statistics,
+)
+from unittests import (
+    ASSETS_DIR,
+    cd,
+    createFakeCompiler,
+    modifiedEnvironment,
+)
+
+
+def addCacheEntry(repository, key, size, accessTime, content=None, compileDuration=None):
+    # Creates an entry file of the given size, last used at accessTime
+    objectSize = size - clcachestorage.CacheEntrySerializer.headerSize()
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(((content or key.encode()) * objectSize)[:objectSize])
+    try:
+        storedSize = repository.section(key).setEntry(key, CompilerArtifacts(f.name, '', '', compileDuration))
+    finally:
+        os.remove(f.name)
+    entries = repository.section(key).index.entries()
+    entries[key][1] = accessTime
+    repository.section(key).index.rewrite(entries)
+    return storedSize
+
+
+def fillCache(cache, count, size, compileDuration=None):
+    # Adds count entries, the first one being the least recently used
+    for i in range(count):
+        key = "{:02x}{:030x}".format(i % 4, i)
+        storedSize = addCacheEntry(
+            cache.compilerArtifactsRepository, key, size, 1000 + i, compileDuration=compileDuration)
+        with cache.statistics as stats:
+            stats.registerCacheEntry(storedSize)
+
+
+def remainingKeys(cache):
+    return sorted(key
+                  for section in cache.compilerArtifactsRepository.sections()
+                  for key in section.cacheEntries())
+
+
+class RemoteCacheStandIn(object):
+    """ A remote cache server keeping all entries in memory """
+    def __init__(self):
+        entries = self.entries = {}
+        connections = self.connections = []
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            # Keeps connections open
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                http.server.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self): # pylint: disable=invalid-name
+                data = entries.get(self.path)
+                self.send_response(200 if data is not None else 404)
+                self.send_header('Content-Length', str(len(data or b'')))
+                self.end_headers()
+                self.wfile.write(data or b'')
+
+            def do_PUT(self): # pylint: disable=invalid-name
+                entries[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(201)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), RequestHandler)
+        self.url = 'http://127.0.0.1:{}/cache'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class TestConfiguration(unittest.TestCase):
+    def testOpenClose(self):
+        configuration = Configuration(os.path.join(ASSETS_DIR, "configuration", "testOpenClose.json"))
+        with configuration:
+            pass
+
+    def testDefaults(self):
+        configuration = Configuration(os.path.join(ASSETS_DIR, "configuration", "testDefaults.json"))
+        with configuration as cfg:
+            self.assertGreaterEqual(cfg.maximumCacheSize(), 1024) # 1KiB
+            self.assertIsNone(cfg.compression())
+            self.assertEqual(cfg.evictionPolicy(), 'lru')
+
+
+class TestStatistics(unittest.TestCase):
+    def testOpenClose(self):
+        stats = Statistics(os.path.join(ASSETS_DIR, "statistics", "testOpenClose.json"))
+        with stats:
+            pass
+
+    def testHitCounts(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            stats = Statistics(os.path.join(tempDir, "stats.txt"))
+            with stats as s:
+                self.assertEqual(s.numCallsWithInvalidArgument(), 0)
+                self.assertEqual(s.numCallsWithoutSourceFile(), 0)
+                self.assertEqual(s.numCallsWithMultipleSourceFiles(), 0)
+                self.assertEqual(s.numCallsWithPch(), 0)
+                self.assertEqual(s.numCallsForLinking(), 0)
+                self.assertEqual(s.numCallsForExternalDebugInfo(), 0)
+                self.assertEqual(s.numEvictedMisses(), 0)
+                self.assertEqual(s.numHeaderChangedMisses(), 0)
+                self.assertEqual(s.numSourceChangedMisses(), 0)
+                self.assertEqual(s.numCacheHits(), 0)
+                self.assertEqual(s.numCacheMisses(), 0)
+                self.assertEqual(s.numCallsForPreprocessing(), 0)
+                self.assertEqual(s.numHeaderHashIndexHits(), 0)
+                self.assertEqual(s.numHeaderRehashes(), 0)
+                self.assertEqual(s.addedObjectsSize(), 0)
+                self.assertEqual(s.addedObjectsStoredSize(), 0)
+
+                # Bump all by 1
+                s.registerCallWithInvalidArgument()
+                s.registerCallWithoutSourceFile()
+                s.registerCallWithMultipleSourceFiles()
+                s.registerCallWithPch()
+                s.registerCallForLinking()
+                s.registerCallForExternalDebugInfo()
+                s.registerEvictedMiss()
+                s.registerHeaderChangedMiss()
+                s.registerSourceChangedMiss()
+                s.registerCacheHit()
+                s.registerCacheMiss()
+                s.registerCallForPreprocessing()
+                s.registerHeaderHashIndexHits(1)
+                s.registerHeaderRehashes(1)
+                s.registerAddedObject(1, 1)
+                s.registerCompileTimeSaved(1.5)
+
+                self.assertEqual(s.numCallsWithInvalidArgument(), 1)
+                self.assertEqual(s.numCallsWithoutSourceFile(), 1)
+                self.assertEqual(s.numCallsWithMultipleSourceFiles(), 1)
+                self.assertEqual(s.numCallsWithPch(), 1)
+                self.assertEqual(s.numCallsForLinking(), 1)
+                self.assertEqual(s.numCallsForExternalDebugInfo(), 1)
+                self.assertEqual(s.numEvictedMisses(), 1)
+                self.assertEqual(s.numHeaderChangedMisses(), 1)
+                self.assertEqual(s.numSourceChangedMisses(), 1)
+                self.assertEqual(s.numCacheHits(), 1)
+                self.assertEqual(s.numCallsForPreprocessing(), 1)
+                self.assertEqual(s.numHeaderHashIndexHits(), 1)
+                self.assertEqual(s.numHeaderRehashes(), 1)
+                self.assertEqual(s.addedObjectsSize(), 1)
+                self.assertEqual(s.addedObjectsStoredSize(), 1)
+                self.assertEqual(s.compileTimeSaved(), 1.5)
+
+                # accumulated: headerChanged, sourceChanged, eviced, miss
+                self.assertEqual(s.numCacheMisses(), 4)
+
+    def testShardsWithoutLock(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            for _ in range(3):
+                with Statistics(statsFile) as s:
+                    s.registerCacheHit()
+                    s.registerCacheEntry(10)
+
+            self.assertFalse(os.path.exists(statsFile))
+            self.assertEqual(len(os.listdir(os.path.join(tempDir, "stats-shards"))), 3)
+
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheHits(), 3)
+                self.assertEqual(s.numCacheEntries(), 3)
+                self.assertEqual(s.currentCacheSize(), 30)
+
+    def testFoldShards(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            for _ in range(3):
+                with Statistics(statsFile) as s:
+                    s.registerCacheMiss()
+
+            stats = Statistics(statsFile)
+            with stats.lock, stats as s:
+                s.registerCacheHit()
+                s.fold()
+                self.assertEqual(s.numCacheMisses(), 3)
+                self.assertEqual(s.numCacheHits(), 1)
+
+            self.assertEqual(os.listdir(os.path.join(tempDir, "stats-shards")), [])
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheMisses(), 3)
+                self.assertEqual(s.numCacheHits(), 1)
+
+            with stats.lock, stats as s:
+                s.resetCounters()
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheMisses(), 0)
+                self.assertEqual(s.numCacheEntries(), 0)
+
+    def testFoldWhenTooManyShards(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            for _ in range(clcachedirectory.MAX_STATISTICS_SHARDS + 1):
+                with Statistics(statsFile) as s:
+                    s.registerCacheHit()
+
+            self.assertTrue(os.path.exists(statsFile))
+            self.assertEqual(os.listdir(os.path.join(tempDir, "stats-shards")), [])
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheHits(), clcachedirectory.MAX_STATISTICS_SHARDS + 1)
+
+
+class TestCompileDurations(unittest.TestCase):
+    def testRecord(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            durations = clcachedirectory.CompileDurations(os.path.join(tempDir, "durations.txt"))
+            self.assertEqual(durations.durations(["a.cpp"]), {})
+
+            durations.record({"a.cpp": 1.5, "b.cpp": 2.0})
+            durations.record({"b.cpp": 0.5})
+            self.assertEqual(durations.durations(["a.cpp", "b.cpp", "c.cpp"]), {"a.cpp": 1.5, "b.cpp": 0.5})
+
+    def testRecordedWhenCompiling(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(os.path.join(tempDir, "cache"))
+            compiler = createFakeCompiler(tempDir)
+            with cd(tempDir):
+                with open("main.cpp", 'w') as f:
+                    f.write("int main() { return 0; }\n")
+                clcache.processCompileRequest(cache, compiler, ["clcache.py", "/nologo", "/c", "main.cpp"])
+                self.assertEqual(list(cache.compileDurations.durations(["main.cpp"])), ["main.cpp"])
+
+
+class TestFileHashIndex(unittest.TestCase):
+    @staticmethod
+    def _writeFile(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        # Make sure the file is not considered to be modified just now
+        oldTime = time.time() - 60
+        os.utime(path, (oldTime, oldTime))
+
+    def testHitAfterRehash(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPath = os.path.join(tempDir, "header.h")
+            self._writeFile(headerPath, "int i;")
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                self.assertEqual(index.getFileHash(headerPath), clcacheutil.getFileHash(headerPath))
+                self.assertEqual(index.getFileHash(headerPath), clcacheutil.getFileHash(headerPath))
+                self.assertEqual(index.rehashes, 1)
+                self.assertEqual(index.hits, 1)
+
+    def testPersistence(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPath = os.path.join(tempDir, "header.h")
+            self._writeFile(headerPath, "int i;")
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                index.getFileHash(headerPath)
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                self.assertEqual(index.getFileHash(headerPath), clcacheutil.getFileHash(headerPath))
+                self.assertEqual(index.rehashes, 0)
+                self.assertEqual(index.hits, 1)
+
+    def testInvalidation(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPath = os.path.join(tempDir, "header.h")
+            self._writeFile(headerPath, "int i;")
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                index.getFileHash(headerPath)
+
+            self._writeFile(headerPath, "int i, j;")
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                self.assertEqual(index.getFileHash(headerPath), clcacheutil.getFileHash(headerPath))
+                self.assertEqual(index.rehashes, 1)
+                self.assertEqual(index.hits, 0)
+
+    def testConcurrentUsers(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPath = os.path.join(tempDir, "header.h")
+            self._writeFile(headerPath, "int i;")
+            indexFile = os.path.join(tempDir, "hashindex.txt")
+
+            index = FileHashIndex(indexFile)
+            with index:
+                with index:
+                    index.getFileHash(headerPath)
+                self.assertFalse(os.path.exists(indexFile))
+                index.getFileHash(headerPath)
+                self.assertEqual(index.takeCounts(), (1, 1))
+                self.assertEqual(index.takeCounts(), (0, 0))
+            self.assertTrue(os.path.exists(indexFile))
+
+    def testSkipsRecentlyModifiedFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPath = os.path.join(tempDir, "header.h")
+            with open(headerPath, 'w') as f:
+                f.write("int i;")
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                index.getFileHash(headerPath)
+                index.getFileHash(headerPath)
+                self.assertEqual(index.rehashes, 2)
+                self.assertEqual(len(index), 0)
+
+    def testEviction(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headerPaths = [os.path.join(tempDir, "header{}.h".format(i)) for i in range(20)]
+            for headerPath in headerPaths:
+                self._writeFile(headerPath, headerPath)
+
+            oldMaximum = clcachedirectory.MAX_HASH_INDEX_ENTRIES
+            clcachedirectory.MAX_HASH_INDEX_ENTRIES = 10
+            try:
+                with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                    for headerPath in headerPaths:
+                        index.getFileHash(headerPath)
+                    self.assertEqual(len(index), 20)
+            finally:
+                clcachedirectory.MAX_HASH_INDEX_ENTRIES = oldMaximum
+
+            with FileHashIndex(os.path.join(tempDir, "hashindex.txt")) as index:
+                self.assertEqual(len(index), 9)
+
+
+class TestManifest(unittest.TestCase):
+    @staticmethod
+    def _entry(objectHash):
+        return ManifestEntry({}, {}, "includes" + objectHash, objectHash)
+
+    def testAddEntry(self):
+        manifest = Manifest()
+        manifest.addEntry(self._entry("1"))
+        manifest.addEntry(self._entry("2"))
+        self.assertEqual([e.objectHash for e in manifest.entries()], ["2", "1"])
+
+        # Adding an entry for an existing object replaces the old entry
+        manifest.addEntry(self._entry("1"))
+        self.assertEqual([e.objectHash for e in manifest.entries()], ["1", "2"])
+
+    def testMaximumNumberOfEntries(self):
+        manifest = Manifest()
+        for i in range(clcachestorage.MAX_MANIFEST_HASHES + 2):
+            manifest.addEntry(self._entry(str(i)))
+        self.assertEqual(len(manifest.entries()), clcachestorage.MAX_MANIFEST_HASHES)
+        # The least recently added entries are dropped
+        self.assertEqual(manifest.entries()[0].objectHash, str(clcachestorage.MAX_MANIFEST_HASHES + 1))
+        self.assertEqual(manifest.entries()[-1].objectHash, "2")
+
+    def testTouchEntry(self):
+        manifest = Manifest([self._entry("1"), self._entry("2"), self._entry("3")])
+        manifest.touchEntry("3")
+        self.assertEqual([e.objectHash for e in manifest.entries()], ["3", "1", "2"])
+        manifest.touchEntry("unknown")
+        self.assertEqual([e.objectHash for e in manifest.entries()], ["3", "1", "2"])
+
+    def testSerialization(self):
+        entry1 = ManifestEntry(
+            {r'c:\include\a.h': "0123456789abcdef0123456789abcdef",
+             r'c:\include\b.h': "fedcba9876543210fedcba9876543210"},
+            {r'c:\include\a.h': [123, 1473420000123456789]},
+            "00112233445566778899aabbccddeeff", "ffeeddccbbaa99887766554433221100")
+        entry2 = ManifestEntry(
+            {r'c:\include\a.h': "0123456789abcdef0123456789abcdef", 'relative \u00e4.h': "abcd"},
+            {},
+            "0000", "1111")
+        with tempfile.TemporaryDirectory() as tempDir:
+            pathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            data = clcachestorage.ManifestSerializer.serialize(Manifest([entry1, entry2]), pathTable)
+
+            manifest = clcachestorage.ManifestSerializer.deserialize(data, pathTable)
+            self.assertEqual(manifest.entries(), [entry1, entry2])
+
+            # Another process reading the same path table
+            otherPathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            manifest = clcachestorage.ManifestSerializer.deserialize(data, otherPathTable)
+            self.assertEqual(manifest.entries(), [entry1, entry2])
+
+        # The JSON manifests written by older versions are much larger
+        jsonData = json.dumps({'entries': [entry1._asdict(), entry2._asdict()]}, sort_keys=True, indent=2)
+        self.assertLess(len(data), len(jsonData) / 2)
+
+    def testLazyDecoding(self):
+        entries = [ManifestEntry({'a.h': "{:032x}".format(i)}, {}, "{:032x}".format(i), "{:032x}".format(i))
+                   for i in range(3)]
+        with tempfile.TemporaryDirectory() as tempDir:
+            pathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            data = clcachestorage.ManifestSerializer.serialize(Manifest(entries), pathTable)
+            resolvedPaths = []
+            resolve = pathTable.resolve
+            pathTable.resolve = lambda tableId, pathIds: resolvedPaths.extend(pathIds) or resolve(tableId, pathIds)
+            manifest = clcachestorage.ManifestSerializer.deserialize(data, pathTable)
+            self.assertEqual(next(manifest.iterEntries()), entries[0])
+            # Only the first entry was decoded
+            self.assertEqual(len(resolvedPaths), 1)
+            self.assertEqual(list(manifest.iterEntries()), entries)
+            self.assertEqual(len(resolvedPaths), 3)
+
+            # Copies share the undecoded entries, but are modified independently
+            manifest = clcachestorage.ManifestSerializer.deserialize(
+                clcachestorage.ManifestSerializer.serialize(Manifest(entries), pathTable), pathTable)
+            touchedManifest = manifest.copy()
+            touchedManifest.touchEntry(entries[2].objectHash)
+            self.assertEqual(touchedManifest.entries(), [entries[2], entries[0], entries[1]])
+            self.assertEqual(manifest.entries(), entries)
+
+    def testInvalidData(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            pathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            data = clcachestorage.ManifestSerializer.serialize(
+                Manifest([ManifestEntry({'a.h': "12"}, {}, "34", "56")]), pathTable)
+            for invalidData in [b'', b'XXXX' + data[4:], data[:-3]]:
+                with self.assertRaises(ValueError):
+                    clcachestorage.ManifestSerializer.deserialize(invalidData, pathTable)
+
+            # Refers to a path table which does not exist anymore
+            with pathTable.lock:
+                pathTable.reset()
+            with self.assertRaises(ValueError):
+                clcachestorage.ManifestSerializer.deserialize(
+                    data, clcachestorage.PathTable(os.path.join(tempDir, "paths")))
+
+
+class TestPathTable(unittest.TestCase):
+    def testIds(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            pathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            tableId, ids = pathTable.ids(["a.h", "b.h"])
+            self.assertNotEqual(ids["a.h"], ids["b.h"])
+
+            # Ids are stable, also for other processes
+            self.assertEqual(pathTable.ids(["b.h", "c.h"])[1]["b.h"], ids["b.h"])
+            otherPathTable = clcachestorage.PathTable(os.path.join(tempDir, "paths"))
+            self.assertEqual(otherPathTable.ids(["a.h"]), (tableId, {"a.h": ids["a.h"]}))
+
+            self.assertEqual(pathTable.resolve(tableId, [ids["a.h"], ids["b.h"]]), ["a.h", "b.h"])
+            with self.assertRaises(ValueError):
+                pathTable.resolve(tableId, [12345])
+
+    def testResolveOnDemand(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tableFile = os.path.join(tempDir, "paths")
+            tableId, ids = clcachestorage.PathTable(tableFile).ids(["a.h", "b.h", "c.h"])
+            with open(tableFile, 'r+b') as f:
+                f.seek(ids["a.h"] + 2)
+                f.write(b'\xff')
+
+            # Only the records of the resolved paths are read
+            pathTable = clcachestorage.PathTable(tableFile)
+            pathTable.checkTableId(tableId)
+            self.assertEqual(pathTable.resolve(tableId, [ids["b.h"]]), ["b.h"])
+            with self.assertRaises(ValueError):
+                pathTable.resolve(tableId, [ids["a.h"]])
+            with open(tableFile, 'r+b') as f:
+                f.seek(ids["a.h"] + 2)
+                f.write(b'a')
+
+            # Paths read before the table was compacted can still be resolved
+            otherPathTable = clcachestorage.PathTable(tableFile)
+            with otherPathTable.lock:
+                otherPathTable.reset()
+            otherPathTable.ids(["c.h"])
+            self.assertEqual(pathTable.resolve(tableId, [ids["b.h"]]), ["b.h"])
+            with self.assertRaises(ValueError):
+                pathTable.resolve(tableId, [ids["c.h"]])
+
+    def testIncompleteRecord(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tableFile = os.path.join(tempDir, "paths")
+            pathTable = clcachestorage.PathTable(tableFile)
+            tableId, ids = pathTable.ids(["a.h"])
+            with open(tableFile, 'ab') as f:
+                f.write(b'\x10\x00abc')
+
+            otherPathTable = clcachestorage.PathTable(tableFile)
+            otherTableId, otherIds = otherPathTable.ids(["a.h", "b.h"])
+            self.assertEqual(otherTableId, tableId)
+            self.assertEqual(otherIds["a.h"], ids["a.h"])
+            self.assertEqual(pathTable.ids(["b.h"])[1]["b.h"], otherIds["b.h"])
+
+    def testCompaction(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            manifestsRootDir = os.path.join(tempDir, "manifests")
+            mm = ManifestRepository(manifestsRootDir)
+            for manifestHash, path in [("aa01", "a.h"), ("bb01", "b.h")]:
+                mm.section(manifestHash).setManifest(
+                    manifestHash, Manifest([ManifestEntry({path: "12"}, {}, "34", "56")]))
+            mm.section("aa01").removeEntry("aa01")
+            sizeBefore = mm.pathTable.size()
+
+            with mm.pathTable.lock:
+                mm.compactPathTable()
+            self.assertLess(mm.pathTable.size(), sizeBefore)
+            self.assertEqual(mm.section("bb01").getManifest("bb01").entries()[0].includeFiles, {"b.h": "12"})
+
+            otherRepository = ManifestRepository(manifestsRootDir)
+            self.assertEqual(
+                otherRepository.section("bb01").getManifest("bb01").entries()[0].includeFiles, {"b.h": "12"})
+
+
+    def testBranchSwitchIsCacheHit(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(os.path.join(tempDir, "cache"))
+            with open(os.path.join(tempDir, "main.cpp"), 'w') as f:
+                f.write('#include "header.h"\nint main() { return VALUE; }\n')
+            environment = dict(os.environ,
+                               CLCACHE_DIR=cache.cacheDirectory(),
+                               CLCACHE_CL=createFakeCompiler(tempDir))
+            environment.pop('CLCACHE_SERVER', None)
+            environment.pop('CLCACHE_NODIRECT', None)
+
+            for value in ["1", "2", "1", "2"]:
+                with open(os.path.join(tempDir, "header.h"), 'w') as f:
+                    f.write("#define VALUE {}\n".format(value))
+                subprocess.check_call(
+                    [sys.executable, os.path.abspath("clcache.py"), "/nologo", "/c", "main.cpp", "/Fomain.obj"],
+                    cwd=tempDir, env=environment)
+
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheMisses(), 2)
+                self.assertEqual(stats.numCacheHits(), 2)
+
+
+class TestManifestRepository(unittest.TestCase):
+    def _getDirectorySize(self, dirPath):
+        def filesize(path, filename):
+            return os.stat(os.path.join(path, filename)).st_size
+
+        size = 0
+        for path, _, filenames in clcacheutil.WALK(dirPath):
+            # Section indices are not part of the cache size
+            size += sum(filesize(path, f) for f in filenames if not f.endswith('.index'))
+
+        return size
+
+    def testCompactedWhileMatching(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            cache.manifestRepository.section("aa01").setManifest(
+                "aa01", Manifest([ManifestEntry({"a.h": "12"}, {}, "34", "56")]))
+            manifest = ManifestRepository(os.path.join(tempDir, "manifests")).section("aa01").getManifest("aa01")
+
+            # Entries are decoded after the path table was compacted
+            with cache.manifestRepository.pathTable.lock:
+                cache.manifestRepository.compactPathTable()
+            self.assertEqual(clcache.matchManifestEntry(cache, manifest), (0, None))
+
+    def testPaths(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        mm = ManifestRepository(manifestsRootDir)
+        ms = mm.section("fdde59862785f9f0ad6e661b9b5746b7")
+
+        self.assertEqual(ms.manifestSectionDir, os.path.join(manifestsRootDir, "fd"))
+        self.assertEqual(ms.manifestPath("fdde59862785f9f0ad6e661b9b5746b7"),
+                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.manifest"))
+
+    def testIncludesContentHash(self):
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes([]),
+            ManifestRepository.getIncludesContentHashForHashes([])
+        )
+
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
+        )
+
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"])
+        )
+
+        # Wrong number of elements
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes([]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
+        )
+
+        # Wrong order
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
+            ManifestRepository.getIncludesContentHashForHashes(["f6c8bd5733", "d88be7edbf"])
+        )
+
+        # Content in different elements
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["", "d88be7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", ""])
+        )
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be", "7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88b", "e7edbf"])
+        )
+
+    def testIncludesContentHashForFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            # Few includes are hashed sequentially, many concurrently
+            for count in [3, 50]:
+                includes = {}
+                for i in range(count):
+                    path = os.path.join(tempDir, "header{}-{}.h".format(count, i))
+                    with open(path, 'w') as f:
+                        f.write("int i{};".format(i))
+                    includes[path] = clcacheutil.getFileHash(path)
+                paths = sorted(includes.keys())
+
+                self.assertEqual(
+                    ManifestRepository.getIncludesContentHashForFiles(includes),
+                    ManifestRepository.getIncludesContentHashForHashes([includes[p] for p in paths]))
+
+                missingIncludes = dict(includes)
+                missingIncludes[os.path.join(tempDir, "missing.h")] = includes[paths[0]]
+                with self.assertRaises(clcacheutil.IncludeNotFoundException):
+                    ManifestRepository.getIncludesContentHashForFiles(missingIncludes)
+
+                changedIncludes = dict(missingIncludes)
+                changedIncludes[paths[-1]] = includes[paths[0]]
+                with self.assertRaises(clcacheutil.IncludeChangedException):
+                    ManifestRepository.getIncludesContentHashForFiles(changedIncludes)
+
+    def testIncludesContentHashWithFingerprints(self):
+        class CountingHashIndex(object):
+            def __init__(self):
+                self.calls = 0
+
+            def getFileHash(self, path):
+                self.calls += 1
+                return clcacheutil.getFileHash(path)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            includes = {}
+            for i in range(3):
+                path = os.path.join(tempDir, "header{}.h".format(i))
+                with open(path, 'w') as f:
+                    f.write("int i{};".format(i))
+                os.utime(path, (time.time() - 60, time.time() - 60))
+                includes[path] = clcacheutil.getFileHash(path)
+            paths = sorted(includes.keys())
+            expectedHash = ManifestRepository.getIncludesContentHashForHashes([includes[p] for p in paths])
+
+            recentPath = os.path.join(tempDir, "recent.h")
+            with open(recentPath, 'w') as f:
+                f.write("int recent;")
+            fingerprints = ManifestRepository.getIncludeFingerprints(paths + [recentPath])
+            self.assertEqual(sorted(fingerprints.keys()), paths)
+
+            # Unchanged fingerprints: no hashing required
+            hashIndex = CountingHashIndex()
+            self.assertEqual(
+                ManifestRepository.getIncludesContentHashForFiles(includes, hashIndex, fingerprints),
+                expectedHash)
+            self.assertEqual(hashIndex.calls, 0)
+
+            # Opt-out: everything is hashed, bypassing the hash index
+            with modifiedEnvironment({'CLCACHE_IGNORE_MTIME': '1'}):
+                hashIndex = CountingHashIndex()
+                self.assertEqual(
+                    ManifestRepository.getIncludesContentHashForFiles(includes, hashIndex, fingerprints),
+                    expectedHash)
+                self.assertEqual(hashIndex.calls, 0)
+
+            # Same size, new mtime: the include is hashed
+            with open(paths[1], 'w') as f:
+                f.write("int j1;")
+            hashIndex = CountingHashIndex()
+            with self.assertRaises(clcacheutil.IncludeChangedException):
+                ManifestRepository.getIncludesContentHashForFiles(includes, hashIndex, fingerprints)
+            self.assertEqual(hashIndex.calls, 1)
+
+            # Changed size: detected without hashing
+            with open(paths[2], 'w') as f:
+                f.write("int longer2;")
+            hashIndex = CountingHashIndex()
+            with self.assertRaises(clcacheutil.IncludeChangedException):
+                ManifestRepository.getIncludesContentHashForFiles(includes, hashIndex, fingerprints)
+            self.assertEqual(hashIndex.calls, 0)
+
+    def testIncludesContentHashEarlyCancellation(self):
+        class SlowHashIndex(object):
+            def __init__(self):
+                self.calls = 0
+
+            def getFileHash(self, path):
+                self.calls += 1
+                time.sleep(0.005)
+                return path
+
+        includes = {"header{:03}.h".format(i): "header{:03}.h".format(i) for i in range(500)}
+        includes["header000.h"] = "changed"
+        hashIndex = SlowHashIndex()
+        with self.assertRaises(clcacheutil.IncludeChangedException):
+            ManifestRepository.getIncludesContentHashForFiles(includes, hashIndex)
+        self.assertLess(hashIndex.calls, 100)
+
+    def testStoreAndGetManifest(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            manifestsRootDir = os.path.join(tempDir, "manifests")
+            mm = ManifestRepository(manifestsRootDir)
+
+            manifest1 = Manifest([
+                ManifestEntry({r'somepath\myinclude.h': "1234"}, {},
+                              "fdde59862785f9f0ad6e661b9b5746b7", "a649723940dc975ebd17167d29a532f8")
+            ])
+            manifest2 = Manifest([
+                ManifestEntry({r'somepath\myinclude.h': "1234", 'moreincludes.h': "5678"}, {},
+                              "474e7fc26a592d84dfa7416c10f036c6", "8771d7ebcf6c8bd57a3d6485f63e3a89")
+            ])
+
+            ms1 = mm.section("8a33738d88be7edbacef48e262bbb5bc")
+            ms2 = mm.section("0623305942d216c165970948424ae7d1")
+
+            ms1.setManifest("8a33738d88be7edbacef48e262bbb5bc", manifest1)
+            ms2.setManifest("0623305942d216c165970948424ae7d1", manifest2)
+
+            retrieved1 = ms1.getManifest("8a33738d88be7edbacef48e262bbb5bc")
+            self.assertIsNotNone(retrieved1)
+            retrievedEntry1 = retrieved1.entries()[0]
+            self.assertEqual(retrievedEntry1.includesContentHash, "fdde59862785f9f0ad6e661b9b5746b7")
+            self.assertEqual(retrievedEntry1.objectHash, "a649723940dc975ebd17167d29a532f8")
+            self.assertEqual(retrievedEntry1.includeFiles, {r'somepath\myinclude.h': "1234"})
+
+            retrieved2 = ms2.getManifest("0623305942d216c165970948424ae7d1")
+            self.assertIsNotNone(retrieved2)
+            retrievedEntry2 = retrieved2.entries()[0]
+            self.assertEqual(retrievedEntry2.includesContentHash, "474e7fc26a592d84dfa7416c10f036c6")
+            self.assertEqual(retrievedEntry2.objectHash, "8771d7ebcf6c8bd57a3d6485f63e3a89")
+
+    def testRemoveJsonManifest(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            mm = ManifestRepository(os.path.join(tempDir, "manifests"))
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = mm.section(manifestHash)
+            os.makedirs(ms.manifestSectionDir)
+            # As written by older clcache versions
+            with open(ms.jsonManifestPath(manifestHash), 'w') as f:
+                f.write('{"includeFiles": [], "includesContentToObjectMap": {}}')
+
+            self.assertIsNone(ms.getManifest(manifestHash))
+            self.assertEqual(list(ms.indexedEntries()), [manifestHash])
+            mm.clean(0)
+            self.assertFalse(os.path.exists(ms.jsonManifestPath(manifestHash)))
+
+    def testNonExistingManifest(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        mm = ManifestRepository(manifestsRootDir)
+
+        retrieved = mm.section("ffffffffffffffffffffffffffffffff").getManifest("ffffffffffffffffffffffffffffffff")
+        self.assertIsNone(retrieved)
+
+    def testClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            manifestsRootDir = os.path.join(tempDir, "manifests")
+            mm = ManifestRepository(manifestsRootDir)
+
+            # Size in (70, 140] bytes
+            manifest1 = Manifest([
+                ManifestEntry({r'somepath\myinclude.h': "12"}, {},
+                              "fdde59862785f9f0ad6e661b9b5746b7", "a649723940dc975ebd17167d29a532f8")
+            ])
+            # Size in (70, 140] bytes
+            manifest2 = Manifest([
+                ManifestEntry({r'somepath\myinclude.h': "12", 'moreincludes.h': "34"}, {},
+                              "474e7fc26a592d84dfa7416c10f036c6", "8771d7ebcf6c8bd57a3d6485f63e3a89")
+            ])
+            mm.section("8a33738d88be7edbacef48e262bbb5bc").setManifest("8a33738d88be7edbacef48e262bbb5bc", manifest1)
+            mm.section("0623305942d216c165970948424ae7d1").setManifest("0623305942d216c165970948424ae7d1", manifest2)
+
+            cleaningResultSize = mm.clean(140)
+            # Only one of those manifests can be left
+            self.assertLessEqual(cleaningResultSize, 140)
+            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 140)
+
+            cleaningResultSize = mm.clean(140)
+            # The one remaining is remains alive
+            self.assertLessEqual(cleaningResultSize, 140)
+            self.assertGreaterEqual(cleaningResultSize, 70)
+            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 140)
+            self.assertGreaterEqual(self._getDirectorySize(manifestsRootDir), 70)
+
+            cleaningResultSize = mm.clean(0)
+            # All manifest are gone
+            self.assertEqual(cleaningResultSize, 0)
+            self.assertEqual(self._getDirectorySize(manifestsRootDir), 0)
+
+
+class TestSectionIndex(unittest.TestCase):
+    def testJournal(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            index = SectionIndex(os.path.join(tempDir, "ab.index"))
+            self.assertFalse(index.exists())
+            self.assertEqual(index.entries(), {})
+
+            index.addEntry("ab01", 100)
+            index.addEntry("ab02", 200)
+            index.removeEntry("ab01")
+            index.addEntry("ab03", 300)
+            self.assertTrue(index.exists())
+            self.assertEqual(sorted(index.entries().keys()), ["ab02", "ab03"])
+            self.assertEqual(index.entries()["ab03"][0], 300)
+
+            # Touching an unknown entry has no effect
+            index.touchEntry("ab04")
+            self.assertNotIn("ab04", index.entries())
+
+    def testIncompleteLine(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            indexFile = os.path.join(tempDir, "ab.index")
+            index = SectionIndex(indexFile)
+            index.addEntry("ab01", 100)
+            with open(indexFile, 'a') as f:
+                f.write("+ ab02 2")
+            self.assertEqual(list(index.entries().keys()), ["ab01"])
+
+    def testRewrite(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            indexFile = os.path.join(tempDir, "ab.index")
+            index = SectionIndex(indexFile)
+            for i in range(10):
+                index.addEntry("ab01", i)
+                index.touchEntry("ab01")
+            entries = index.entries()
+            index.rewrite(entries)
+            self.assertEqual(index.entries(), entries)
+            with open(indexFile, 'r') as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+    def testCompileDuration(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            indexFile = os.path.join(tempDir, "ab.index")
+            index = SectionIndex(indexFile)
+            index.addEntry("ab01", 100, 2.5)
+            index.addEntry("ab02", 100)
+            # As written by older clcache versions
+            with open(indexFile, 'a') as f:
+                f.write("+ ab03 100 1000\n")
+            entries = index.entries()
+            self.assertEqual(entries["ab01"][2], 2500)
+            self.assertEqual(entries["ab02"][2], 0)
+            self.assertEqual(entries["ab03"], [100, 1000, 0, None])
+
+
+class TestCompilerArtifactsRepository(unittest.TestCase):
+    def testCleanEvictsLeastRecentlyUsed(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            addCacheEntry(car, "aa01", 100, 1000, b'x')
+            addCacheEntry(car, "bb01", 100, 3000, b'x')
+            addCacheEntry(car, "aa02", 100, 2000, b'x')
+            addCacheEntry(car, "cc01", 100, 4000, b'x')
+
+            self.assertEqual(car.clean(250), (2, 200))
+            self.assertFalse(car.section("aa01").hasEntry("aa01"))
+            self.assertFalse(car.section("aa02").hasEntry("aa02"))
+            self.assertTrue(car.section("bb01").hasEntry("bb01"))
+            self.assertTrue(car.section("cc01").hasEntry("cc01"))
+
+            self.assertEqual(car.clean(0), (0, 0))
+            self.assertFalse(car.section("cc01").hasEntry("cc01"))
+
+    def testCleanCostPolicy(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            addCacheEntry(car, "aa01", 100, 1000, b'x', compileDuration=10.0)
+            addCacheEntry(car, "bb01", 100, 2000, b'x', compileDuration=0.1)
+            addCacheEntry(car, "cc01", 100, 3000, b'x')
+
+            # Least recently used, but most expensive to compile again
+            self.assertEqual(car.clean(250, 'cost'), (2, 200))
+            self.assertTrue(car.section("aa01").hasEntry("aa01"))
+            self.assertTrue(car.section("bb01").hasEntry("bb01"))
+            self.assertFalse(car.section("cc01").hasEntry("cc01"))
+
+            self.assertEqual(car.clean(150, 'lru'), (1, 100))
+            self.assertFalse(car.section("aa01").hasEntry("aa01"))
+
+    def testCompileDuration(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            section = car.section("aa01")
+            section.setEntry("aa01", CompilerArtifacts(objectFile, 'out', '', 1.25))
+            self.assertEqual(section.index.entries()["aa01"][2], 1250)
+            artifacts = section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+            self.assertEqual(artifacts.compileDuration, 1.25)
+
+            # The duration is taken from the entries when rebuilding the index
+            os.remove(section.compilerArtifactsSectionDir + '.index')
+            car.rebuildIndex()
+            self.assertEqual(section.index.entries()["aa01"][2], 1250)
+
+            # Version 1 entries have no compile duration, the last field of
+            # the header following the version byte
+            with open(section.cacheEntryPath("aa01"), 'rb') as f:
+                entry = f.read()
+            headerSize = clcachestorage.CacheEntrySerializer.headerSize()
+            with open(section.cacheEntryPath("aa01"), 'wb') as f:
+                f.write(entry[:4] + bytes([1]) + entry[5:headerSize - 4] + entry[headerSize:])
+            artifacts = section.restoreEntry("aa01", os.path.join(tempDir, "c.obj"))
+            self.assertEqual(artifacts, CompilerArtifacts(os.path.join(tempDir, "c.obj"), 'out', ''))
+            with open(os.path.join(tempDir, "c.obj"), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 1000)
+
+    def testRebuildIndex(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            addCacheEntry(car, "aa01", 100, 1000, b'x')
+            addCacheEntry(car, "bb01", 50, 1000, b'x')
+            for section in car.sections():
+                os.remove(section.compilerArtifactsSectionDir + '.index')
+
+            # Missing indices are rebuilt when cleaning
+            self.assertEqual(car.clean(1000), (2, 150))
+
+            for section in car.sections():
+                os.remove(section.compilerArtifactsSectionDir + '.index')
+            car.rebuildIndex()
+            self.assertEqual(car.section("aa01").index.entries()["aa01"][0], 100)
+            self.assertEqual(car.section("bb01").index.entries()["bb01"][0], 50)
+
+    def testDeduplication(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(
+                os.path.join(tempDir, "objects"), clcachestorage.BlobStore(os.path.join(tempDir, "blobs")))
+            self.assertEqual(addCacheEntry(car, "aa01", 100, 1000, b'x', compileDuration=1.234), 100)
+            # Compile durations don't prevent deduplication
+            self.assertEqual(addCacheEntry(car, "bb01", 100, 2000, b'x', compileDuration=1.301), 0)
+            self.assertEqual(addCacheEntry(car, "cc01", 50, 3000, b'y'), 50)
+            self.assertTrue(os.path.samefile(car.section("aa01").cacheEntryPath("aa01"),
+                                             car.section("bb01").cacheEntryPath("bb01")))
+            self.assertEqual(car.section("bb01").index.entries()["bb01"][2], 1301)
+
+            # Shared objects are only counted once
+            self.assertEqual(car.clean(1000), (3, 150))
+
+            # The object is still used by bb01
+            self.assertEqual(car.clean(150), (2, 150))
+            self.assertEqual(len(list(clcacheutil.filesBeneath(os.path.join(tempDir, "blobs")))), 2)
+            self.assertEqual(car.clean(50), (1, 50))
+            self.assertEqual(len(list(clcacheutil.filesBeneath(os.path.join(tempDir, "blobs")))), 1)
+
+            # Unused blobs are accounted for again when reused
+            car.section("cc01").removeEntry("cc01")
+            self.assertEqual(addCacheEntry(car, "dd01", 50, 4000, b'y'), 50)
+            blobHash = car.section("dd01").index.entries()["dd01"][3]
+            self.assertTrue(os.path.exists(car.blobStore.blobPath(blobHash)))
+            os.remove(car.section("dd01").compilerArtifactsSectionDir + '.index')
+            car.rebuildIndex()
+            self.assertEqual(car.section("dd01").index.entries()["dd01"][3], blobHash)
+
+            # Cleaning only checks the blobs of the entries it removes
+            car.section("dd01").removeEntry("dd01")
+            self.assertEqual(car.clean(1000), (0, 0))
+            self.assertEqual(len(list(clcacheutil.filesBeneath(os.path.join(tempDir, "blobs")))), 1)
+            car.collectGarbage()
+            self.assertEqual(list(clcacheutil.filesBeneath(os.path.join(tempDir, "blobs"))), [])
+
+    @unittest.skipIf(clcacheutil.windll is None, "CLCACHE_HARDLINK is only supported on Windows")
+    def testHardLinkedEntries(self):
+        with tempfile.TemporaryDirectory() as tempDir, modifiedEnvironment({'CLCACHE_HARDLINK': '1'}):
+            car = CompilerArtifactsRepository(
+                os.path.join(tempDir, "objects"), clcachestorage.BlobStore(os.path.join(tempDir, "blobs")))
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            section = car.section("aa01")
+            self.assertEqual(section.setEntry("aa01", CompilerArtifacts(objectFile, '', '')), 1000)
+            os.remove(objectFile)
+            # Build outputs are hard links to the cached object
+            section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+            section.restoreEntry("aa01", os.path.join(tempDir, "c.obj"))
+
+            self.assertEqual(section.removeEntry("aa01"), 1000)
+            car.collectGarbage()
+            self.assertEqual(list(clcacheutil.filesBeneath(os.path.join(tempDir, "blobs"))), [])
+
+    def testCompression(self):
+        content = b''.join(struct.pack('<I', i) for i in range(10000))
+        for compression in sorted(clcachestorage.OBJECT_COMPRESSIONS):
+            for blobStore in [None, "blobs"]:
+                with tempfile.TemporaryDirectory() as tempDir:
+                    car = CompilerArtifactsRepository(
+                        os.path.join(tempDir, "objects"),
+                        clcachestorage.BlobStore(os.path.join(tempDir, blobStore)) if blobStore else None)
+                    objectFile = os.path.join(tempDir, "a.obj")
+                    with open(objectFile, 'wb') as f:
+                        f.write(content)
+
+                    storedSize = car.section("aa01").setEntry(
+                        "aa01", CompilerArtifacts(objectFile, 'out', ''), compression, 6)
+                    self.assertLess(storedSize, len(content) / 2)
+                    os.remove(objectFile)
+
+                    artifacts = car.section("aa01").restoreEntry("aa01", objectFile)
+                    self.assertEqual(artifacts, CompilerArtifacts(objectFile, 'out', ''))
+                    with open(objectFile, 'rb') as f:
+                        self.assertEqual(f.read(), content)
+
+                    # Replacing the entry with an uncompressed one
+                    car.section("aa01").setEntry("aa01", CompilerArtifacts(objectFile, '', ''))
+                    self.assertEqual(car.section("aa01").index.entries()["aa01"][0],
+                                     len(content) + clcachestorage.CacheEntrySerializer.headerSize())
+
+    def testPackFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            objectFile = os.path.join(tempDir, "a.obj")
+            contents = {}
+            for key, compression in [("aa01", None), ("aa02", "zlib"), ("aa03", None)]:
+                contents[key] = key.encode() * 1000
+                with open(objectFile, 'wb') as f:
+                    f.write(contents[key])
+                storedSize = car.section(key).setEntry(
+                    key, CompilerArtifacts(objectFile, 'out ' + key, 'err \u00e4'), compression, 1, packed=True)
+                self.assertEqual(car.section(key).index.entries()[key][0], storedSize)
+            section = car.section("aa01")
+            self.assertEqual(section.packFiles(), [0])
+            self.assertEqual(list(clcacheutil.childDirectories(section.compilerArtifactsSectionDir)), [])
+
+            # Entries are visible for other processes
+            otherSection = CompilerArtifactsRepository(tempDir).section("aa02")
+            self.assertEqual(otherSection.cacheEntries(), ["aa01", "aa02", "aa03"])
+            self.assertTrue(otherSection.hasEntry("aa02"))
+            artifacts = otherSection.restoreEntry("aa02", os.path.join(tempDir, "b.obj"))
+            self.assertEqual(artifacts, CompilerArtifacts(os.path.join(tempDir, "b.obj"), 'out aa02', 'err \u00e4'))
+            with open(os.path.join(tempDir, "b.obj"), 'rb') as f:
+                self.assertEqual(f.read(), contents["aa02"])
+
+            # Removed records are dropped when compacting
+            recordLength = section.packIndex.entries()["aa01"][2]
+            self.assertEqual(section.removeEntry("aa01"), recordLength)
+            self.assertFalse(otherSection.hasEntry("aa01"))
+            self.assertEqual(car.clean(100000), (2, sum(
+                size for size, _, _, _ in section.index.entries().values())))
+            self.assertEqual(section.packFiles(), [1])
+            for key in ["aa02", "aa03"]:
+                otherSection.restoreEntry(key, os.path.join(tempDir, "b.obj"))
+                with open(os.path.join(tempDir, "b.obj"), 'rb') as f:
+                    self.assertEqual(f.read(), contents[key])
+
+            # Storing an entry as a directory replaces the packed one
+            with open(objectFile, 'wb') as f:
+                f.write(contents["aa03"])
+            section.setEntry("aa03", CompilerArtifacts(objectFile, '', ''))
+            self.assertEqual(sorted(section.packIndex.entries()), ["aa02"])
+            self.assertTrue(section.hasEntry("aa03"))
+
+            self.assertEqual(car.clean(0), (0, 0))
+            self.assertEqual(section.packFiles(), [])
+
+    def testCorruptPackFile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            section = car.section("aa01")
+            section.setEntry("aa01", CompilerArtifacts(objectFile, '', ''), packed=True)
+            with open(section.packFilePath(0), 'r+b') as f:
+                f.write(b'XXXX')
+            with self.assertRaises(clcachestorage.CorruptCacheEntryException):
+                section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+
+            # An empty pack file cannot be mapped into memory
+            open(section.packFilePath(0), 'wb').close()
+            with self.assertRaises(clcachestorage.CorruptCacheEntryException):
+                section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+
+    def testCorruptEntry(self):
+        for compression in [None, 'zlib']:
+            with tempfile.TemporaryDirectory() as tempDir:
+                car = CompilerArtifactsRepository(tempDir)
+                objectFile = os.path.join(tempDir, "a.obj")
+                with open(objectFile, 'wb') as f:
+                    f.write(b'x' * 1000)
+                section = car.section("aa01")
+                section.setEntry("aa01", CompilerArtifacts(objectFile, 'out', ''), compression, 1)
+                entryPath = section.cacheEntryPath("aa01")
+                with open(entryPath, 'rb') as f:
+                    entry = f.read()
+
+                # A flipped bit is detected by the checksum
+                with open(entryPath, 'wb') as f:
+                    f.write(entry[:-10] + bytes([entry[-10] ^ 1]) + entry[-9:])
+                with self.assertRaises(clcachestorage.CorruptCacheEntryException):
+                    section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+                self.assertFalse(os.path.exists(os.path.join(tempDir, "b.obj")))
+
+                with open(entryPath, 'wb') as f:
+                    f.write(entry[:-10])
+                with self.assertRaises(clcachestorage.CorruptCacheEntryException):
+                    section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+
+    def testDirectoryEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(tempDir)
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            # As written by older clcache versions
+            section = car.section("aa01")
+            os.makedirs(section.cacheEntryPath("aa01"))
+            for fileName, content in [("object", b'x' * 1000), ("output.txt", b'out'), ("stderr.txt", b'err')]:
+                with open(os.path.join(section.cacheEntryPath("aa01"), fileName), 'wb') as f:
+                    f.write(content)
+            self.assertEqual(section.indexedEntries()["aa01"][0], 1000)
+
+            artifacts = section.restoreEntry("aa01", os.path.join(tempDir, "b.obj"))
+            self.assertEqual(artifacts, CompilerArtifacts(os.path.join(tempDir, "b.obj"), 'out', 'err'))
+            with open(os.path.join(tempDir, "b.obj"), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 1000)
+
+            # Replaced by an entry file
+            section.setEntry("aa01", CompilerArtifacts(objectFile, '', ''))
+            self.assertTrue(os.path.isfile(section.cacheEntryPath("aa01")))
+            self.assertEqual(section.cacheEntries(), ["aa01"])
+            self.assertEqual(section.removeEntry("aa01"), os.path.getsize(objectFile) +
+                             clcachestorage.CacheEntrySerializer.headerSize())
+            self.assertEqual(section.cacheEntries(), [])
+
+    def testPaths(self):
+        compilerArtifactsRepositoryRootDir = os.path.join(ASSETS_DIR, "compiler-artifacts-repository")
+        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir)
+        cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
+
+        # section path
+        self.assertEqual(cas.compilerArtifactsSectionDir, os.path.join(compilerArtifactsRepositoryRootDir, "fd"))
+
+        # entry path
+        self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
+            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
+
+
+class TestIncrementalCleaning(unittest.TestCase):
+    def testCleanIncrementally(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            fillCache(cache, 10, 100)
+
+            cache.cleanIncrementally(1000)
+            # The eight most recently used objects fit into 90% of 90%
+            self.assertEqual(remainingKeys(cache), sorted("{:02x}{:030x}".format(i % 4, i) for i in range(2, 10)))
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 8)
+                self.assertEqual(stats.currentCacheSize(), 800)
+
+    def testCompactPathTable(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            manifestRepository = cache.manifestRepository
+            for manifestHash, path in [("aa01", "a.h"), ("bb01", "b.h")]:
+                with manifestRepository.section(manifestHash).lock:
+                    manifestRepository.section(manifestHash).setManifest(
+                        manifestHash, Manifest([ManifestEntry({path: "12"}, {}, "34", "56")]))
+            with manifestRepository.section("aa01").lock:
+                manifestRepository.section("aa01").removeEntry("aa01")
+            sizeBefore = manifestRepository.pathTable.size()
+
+            oldMaximum = clcachedirectory.MAX_PATH_TABLE_SIZE
+            try:
+                clcachedirectory.MAX_PATH_TABLE_SIZE = sizeBefore - 1
+                cache.cleanIncrementally(1000000)
+            finally:
+                clcachedirectory.MAX_PATH_TABLE_SIZE = oldMaximum
+            self.assertLess(manifestRepository.pathTable.size(), sizeBefore)
+            self.assertEqual(
+                manifestRepository.section("bb01").getManifest("bb01").entries()[0].includeFiles, {"b.h": "12"})
+
+    def testEvictSample(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            fillCache(cache, clcachedirectory.CLEANUP_BATCH_SIZE + 5, 1)
+
+            cache.evictSample()
+            self.assertEqual(len(remainingKeys(cache)), 5)
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 5)
+
+    def testEvictSampleCostPolicy(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            with cache.configuration as cfg:
+                cfg.setEvictionPolicy('cost')
+            fillCache(cache, 150, 100, compileDuration=1.0)
+            for i in range(150):
+                manifestHash = "{:02x}{:030x}".format(i % 4, i)
+                section = cache.manifestRepository.section(manifestHash)
+                section.setManifest(manifestHash, Manifest())
+                entries = section.index.entries()
+                entries[manifestHash][1] = 1000 + i
+                section.index.rewrite(entries)
+
+            # Objects are removed although their priorities are much higher
+            # than those of manifests used at the same time
+            cache.evictSample()
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 100)
+            self.assertEqual(sum(len(section.index.entries()) for section in cache.manifestRepository.sections()),
+                             100)
+
+    def testSkipEntriesUsedWhileCleaning(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            fillCache(cache, 2, 100)
+            victims, _, _ = clcachestorage.leastRecentlyUsedEntries(
+                cache.indexedSections(cache.compilerArtifactsRepository.sections()), 0)
+            victims[0][3].touchEntry(victims[0][1])
+
+            cache.evictBatch(victims)
+            self.assertEqual(remainingKeys(cache), [victims[0][1]])
+
+    def testBackgroundCleanup(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(tempDir)
+            fillCache(cache, 10, 100)
+            with cache.configuration as cfg:
+                cfg.setMaximumCacheSize(500)
+
+            clcachedirectory.requestBackgroundCleanup(cache)
+            requestPath = clcachedirectory.cleanupRequestPath(cache)
+            deadline = time.time() + 60
+            while os.path.exists(requestPath) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(requestPath))
+            self.assertLessEqual(len(remainingKeys(cache)), 5)
+
+
+def useSharedCache(cacheDirectory, worker, iterations):
+    # Looks up and stores entries like compiler invocations would; returns the
+    # number of entries restored.
+    cache = clcachedirectory.Cache(cacheDirectory)
+    assert cache.shared
+    objectFile = os.path.join(cacheDirectory, "worker{}.obj".format(worker))
+    restored = 0
+    for i in range(iterations):
+        key = "{:02x}{:030x}".format(i % 4, i % 8)
+        content = key.encode() * 1000
+        section = cache.compilerArtifactsRepository.section(key)
+        with section.readLock:
+            artifacts = None
+            if section.hasEntry(key):
+                try:
+                    artifacts = section.restoreEntry(key, objectFile)
+                except FileNotFoundError:
+                    # Removed by the cleaner in the meantime
+                    pass
+            if artifacts is not None:
+                with open(objectFile, 'rb') as f:
+                    assert f.read() == content
+                assert artifacts.stdout == key
+                section.touchEntry(key)
+                restored += 1
+                continue
+
+        with open(objectFile, 'wb') as f:
+            f.write(content)
+        with section.lock:
+            section.setEntry(key, CompilerArtifacts(objectFile, key, ''))
+    return restored
+
+
+def cleanSharedCacheRepeatedly(cacheDirectory, count):
+    cache = clcachedirectory.Cache(cacheDirectory)
+    for _ in range(count):
+        clcache.cleanSharedCache(cache)
+
+
+def holdCleanerLock(cacheDirectory, locked, release):
+    with clcacheutil.CacheFileLock(os.path.join(cacheDirectory, "cleaner.lock"), 1000):
+        locked.set()
+        release.wait(60)
+
+
+class TestSharedCache(unittest.TestCase):
+    @staticmethod
+    def _sharedCache(cacheDirectory):
+        with clcachedirectory.Configuration(os.path.join(cacheDirectory, "config.txt")) as cfg:
+            cfg.setShared(True)
+            cfg.setMaximumCacheSize(10000)
+        return clcachedirectory.Cache(cacheDirectory)
+
+    def testLocalState(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, "cache")
+            os.makedirs(cacheDir)
+            with modifiedEnvironment({"LOCALAPPDATA": os.path.join(tempDir, "local")}):
+                cache = self._sharedCache(cacheDir)
+                with cache.statistics as stats:
+                    stats.registerCacheHit()
+                self.assertTrue(cache.shared)
+                self.assertFalse(os.path.exists(os.path.join(cacheDir, "stats-shards")))
+                self.assertTrue(list(clcacheutil.filesBeneath(os.path.join(tempDir, "local"))))
+
+    def testConcurrentReadersAndWriters(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with modifiedEnvironment({"LOCALAPPDATA": os.path.join(tempDir, "local")}):
+                self._sharedCache(tempDir)
+                with multiprocessing.Pool(5) as pool:
+                    cleaning = pool.apply_async(cleanSharedCacheRepeatedly, (tempDir, 20))
+                    restored = pool.starmap(useSharedCache, [(tempDir, worker, 40) for worker in range(4)])
+                    cleaning.get()
+            self.assertGreater(sum(restored), 0)
+
+    def testCleanerSkipsEntriesInUse(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with modifiedEnvironment({"LOCALAPPDATA": os.path.join(tempDir, "local")}):
+                cache = self._sharedCache(tempDir)
+                fillCache(cache, 4, 5000)
+                keys = remainingKeys(cache)
+                for i, key in enumerate(sorted(keys, key=lambda key: int(key[2:], 16))):
+                    path = cache.compilerArtifactsRepository.section(key).cacheEntryPath(key)
+                    os.utime(path, (1000 + i, 1000 + i))
+                # Used by a reader of the shared cache, which does not update
+                # the index
+                oldestKey = "{:02x}{:030x}".format(0, 0)
+                cache.compilerArtifactsRepository.section(oldestKey).touchEntry(oldestKey)
+
+                # The entries to be removed are determined up front, so the
+                # used entry is kept in addition to the most recent one.
+                clcache.cleanSharedCache(cache)
+                self.assertEqual(remainingKeys(cache),
+                                 [oldestKey, "{:02x}{:030x}".format(3, 3)])
+
+    def testSingleCleaner(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with modifiedEnvironment({"LOCALAPPDATA": os.path.join(tempDir, "local")}):
+                cache = self._sharedCache(tempDir)
+                locked, release = multiprocessing.Event(), multiprocessing.Event()
+                cleaner = multiprocessing.Process(target=holdCleanerLock, args=(tempDir, locked, release))
+                cleaner.start()
+                try:
+                    self.assertTrue(locked.wait(60))
+                    with self.assertRaises(clcacheutil.CacheLockException):
+                        clcache.cleanSharedCache(cache)
+                finally:
+                    release.set()
+                    cleaner.join()
+                clcache.cleanSharedCache(cache)
+
+
+class TestRemoteCache(unittest.TestCase):
+    def testGetAndPut(self):
+        with RemoteCacheStandIn() as server:
+            remote = clcachestorage.RemoteCache(server.url)
+            self.assertIsNone(remote.get('objects', 'aa01'))
+            remote.put('objects', 'aa01', b'data')
+            remote.flush()
+            self.assertEqual(server.entries, {'/cache/objects/aa01': b'data'})
+            self.assertEqual(remote.get('objects', 'aa01'), b'data')
+            self.assertIsNone(remote.get('manifests', 'aa01'))
+
+            # One connection for looking up entries, one for uploading them
+            self.assertEqual(len(server.connections), 2)
+
+            readOnlyRemote = clcachestorage.RemoteCache(server.url, readOnly=True)
+            readOnlyRemote.put('objects', 'bb01', b'data')
+            readOnlyRemote.flush()
+            self.assertEqual(readOnlyRemote.get('objects', 'aa01'), b'data')
+            self.assertEqual(list(server.entries), ['/cache/objects/aa01'])
+
+    def testUnreachable(self):
+        # A port nobody listens on
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{}'.format(s.getsockname()[1])
+        remote = clcachestorage.RemoteCache(url, timeoutMs=1000)
+        self.assertIsNone(remote.get('objects', 'aa01'))
+        remote.put('objects', 'aa01', b'data')
+        remote.flush()
+
+    def testSharedEntries(self):
+        with RemoteCacheStandIn() as server, tempfile.TemporaryDirectory() as tempDir:
+            remote = clcachestorage.RemoteCache(server.url)
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects1"), remote=remote)
+            car.section("aa01").setEntry("aa01", CompilerArtifacts(objectFile, 'out', ''), 'zlib', 1)
+            manifestRepository = ManifestRepository(os.path.join(tempDir, "manifests1"), remote)
+            entry = ManifestEntry({'a.h': 'ab01'}, {'a.h': [10, 1000]}, 'cd01', 'aa01')
+            manifestRepository.section("ef01").uploadManifest("ef01", Manifest([entry]))
+            remote.flush()
+
+            os.makedirs(os.path.join(tempDir, "objects2"))
+            os.makedirs(os.path.join(tempDir, "manifests2"))
+            otherCar = CompilerArtifactsRepository(os.path.join(tempDir, "objects2"), remote=remote)
+            section = otherCar.section("aa01")
+            self.assertIsNone(section.fetchEntry("bb01"))
+            self.assertFalse(section.hasEntry("aa01"))
+            self.assertEqual(section.fetchEntry("aa01"), os.path.getsize(car.section("aa01").cacheEntryPath("aa01")))
+            self.assertEqual(section.restoreEntry("aa01", os.path.join(tempDir, "b.obj")),
+                             CompilerArtifacts(os.path.join(tempDir, "b.obj"), 'out', ''))
+            with open(os.path.join(tempDir, "b.obj"), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 1000)
+
+            otherManifestSection = ManifestRepository(os.path.join(tempDir, "manifests2"), remote).section("ef01")
+            self.assertIsNone(otherManifestSection.fetchManifest("ef02"))
+            # Fingerprints are not shared
+            expectedEntries = [ManifestEntry({'a.h': 'ab01'}, {}, 'cd01', 'aa01')]
+            self.assertEqual(otherManifestSection.fetchManifest("ef01").entries(), expectedEntries)
+            self.assertEqual(otherManifestSection.getManifest("ef01").entries(), expectedEntries)
+
+    def _compileWithRemoteCache(self, tempDir, remote):
+        # Compiles the same source file using two local caches
+        compiler = createFakeCompiler(tempDir)
+        with open(os.path.join(tempDir, "main.cpp"), 'w') as f:
+            f.write("int main() { return 0; }\n")
+
+        with cd(tempDir), modifiedEnvironment({"CLCACHE_REMOTE": remote}):
+            caches = [clcachedirectory.Cache(os.path.join(tempDir, name)) for name in ("cache1", "cache2")]
+            for cache in caches + caches:
+                exitCode, stdout, _ = clcache.processCompileRequest(
+                    cache, compiler, ["clcache.py", "/nologo", "/c", "main.cpp", "/Fomain.obj"])
+                cache.remote.flush()
+                self.assertEqual(exitCode, 0)
+                self.assertIn("main.cpp", stdout)
+                self.assertTrue(os.path.exists("main.obj"))
+                os.remove("main.obj")
+
+        with caches[0].statistics as stats:
+            self.assertEqual(stats.numCacheHits(), 1)
+            self.assertEqual(stats.numRemoteCacheHits(), 0)
+        with caches[1].statistics as stats:
+            self.assertEqual(stats.numCacheHits(), 2)
+            self.assertEqual(stats.numRemoteCacheHits(), 1)
+            self.assertEqual(stats.numCacheEntries(), 1)
+
+    def testCompileWithRemoteCache(self):
+        with RemoteCacheStandIn() as server, tempfile.TemporaryDirectory() as tempDir:
+            self._compileWithRemoteCache(tempDir, server.url)
+            self.assertEqual(len([path for path in server.entries if '/objects/' in path]), 1)
+
+    def testCompileWithRemoteCacheDirectory(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            remoteDir = os.path.join(tempDir, "remote")
+            self._compileWithRemoteCache(tempDir, remoteDir)
+
+            # The remote cache keeps its own statistics and size limit
+            remoteCache = clcachedirectory.Cache(remoteDir)
+            with remoteCache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 1)
+                self.assertEqual(stats.numCacheHits(), 0)
+            with remoteCache.configuration as cfg:
+                cfg.setMaximumCacheSize(1)
+            clcache.cleanCache(remoteCache)
+            self.assertEqual(list(remoteCache.compilerArtifactsRepository.sections())[0].cacheEntries(), [])
+
+    def testDirectoryEntryData(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            remote = clcachedirectory.DirectoryRemoteCache(os.path.join(tempDir, "remote"))
+            self.assertIsNone(remote.get('objects', 'aa01'))
+            self.assertIsNone(remote.get('manifests', 'aa01'))
+
+            # Entries stored in pack files are transferred as entry files
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+            remoteCache = clcachedirectory.Cache(os.path.join(tempDir, "remote"))
+            remoteCache.compilerArtifactsRepository.section("aa01").setEntry(
+                "aa01", CompilerArtifacts(objectFile, 'out', ''), packed=True)
+            data = remote.get('objects', 'aa01')
+            self.assertEqual(
+                data, clcachestorage.CacheEntrySerializer.serialize(CompilerArtifacts(objectFile, 'out', '')))
+
+            remote.put('manifests', 'bb01', clcachestorage.RemoteCache.serializeManifest(
+                Manifest([ManifestEntry({'a.h': 'ab01'}, {}, 'cd01', 'aa01')])))
+            remote.flush()
+            self.assertEqual(remoteCache.manifestRepository.section('bb01').getManifest('bb01').entries(),
+                             [ManifestEntry({'a.h': 'ab01'}, {}, 'cd01', 'aa01')])
+
+            # Entries uploaded by other machines are kept
+            remote.put('manifests', 'bb01', clcachestorage.RemoteCache.serializeManifest(
+                Manifest([ManifestEntry({'a.h': 'ab02'}, {}, 'cd02', 'aa02')])))
+            remote.flush()
+            self.assertEqual(remoteCache.manifestRepository.section('bb01').getManifest('bb01').entries(),
+                             [ManifestEntry({'a.h': 'ab02'}, {}, 'cd02', 'aa02'),
+                              ManifestEntry({'a.h': 'ab01'}, {}, 'cd01', 'aa01')])
+
+    def testDirectoryCleanedFromServer(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            remoteCache = clcachedirectory.Cache(os.path.join(tempDir, "remote"))
+            fillCache(remoteCache, 10, 100)
+            with remoteCache.configuration as cfg:
+                cfg.setMaximumCacheSize(1000)
+            objectFile = os.path.join(tempDir, "a.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 100)
+
+            # Both caches exceed their maximum size, but not the hard limit
+            clcachedirectory.ServerWorker.cache = clcachedirectory.Cache(os.path.join(tempDir, "local"))
+            try:
+                # The server cleans its own cache
+                localCache = clcachedirectory.ServerWorker.cache
+                fillCache(localCache, 10, 100)
+                with localCache.configuration as cfg:
+                    cfg.setMaximumCacheSize(1000)
+                clcachedirectory.scheduleCleanup(localCache)
+                self.assertFalse(os.path.exists(clcachedirectory.cleanupRequestPath(localCache)))
+
+                # ...but not the remote cache directory
+                remote = clcachedirectory.DirectoryRemoteCache(os.path.join(tempDir, "remote"))
+                remote.put('objects', 'ff01', clcachestorage.CacheEntrySerializer.serialize(
+                    CompilerArtifacts(objectFile, '', '')))
+                remote.flush()
+            finally:
+                clcachedirectory.ServerWorker.cache = None
+
+            requestPath = clcachedirectory.cleanupRequestPath(remoteCache)
+            deadline = time.time() + 60
+            while os.path.exists(requestPath) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(requestPath))
+            self.assertLess(len(remainingKeys(remoteCache)), 11)
+
+
+if __name__ == '__main__':
+    unittest.TestCase.longMessage = True
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# A minimal stand-in for cl.exe which allows running clcache on systems
+# without Visual Studio. It supports /c, /Fo, /EP, /showIncludes,
+# '#include "file"' directives relative to the including file and '#error'
+# directives (which fail compiling the source file, but not the others). If the
+# FAKECL_LOG environment variable is set, each invocation appends its
+# arguments to the file given by it.
+#
+import os
+import re
+import sys
+
+
+def includedFiles(sourceFile):
+    with open(sourceFile, 'r') as f:
+        for line in f:
+            match = re.match(r'\s*#include\s+"(.+)"', line)
+            if match:
+                includePath = os.path.join(os.path.dirname(os.path.abspath(sourceFile)), match.group(1))
+                yield includePath
+                for nestedPath in includedFiles(includePath):
+                    yield nestedPath
+
+
+def preprocess(sourceFile):
+    content = ''
+    with open(sourceFile, 'r') as f:
+        for line in f:
+            match = re.match(r'\s*#include\s+"(.+)"', line)
+            if match:
+                content += preprocess(os.path.join(os.path.dirname(os.path.abspath(sourceFile)), match.group(1)))
+            else:
+                content += line
+    return content
+
+
+def main():
+    args = sys.argv[1:]
+    if 'FAKECL_LOG' in os.environ:
+        with open(os.environ['FAKECL_LOG'], 'a') as f:
+            f.write(' '.join(args) + '\n')
+
+    sourceFiles = [arg for arg in args if not arg.startswith(('/', '-'))]
+    objectFile = None
+    for arg in args:
+        if arg.startswith(('/Fo', '-Fo')) and len(arg) > 3:
+            objectFile = arg[3:]
+
+    for sourceFile in sourceFiles:
+        if not os.path.exists(sourceFile):
+            print("{}: fatal error C1083: Cannot open source file".format(sourceFile))
+            return 2
+
+    exitCode = 0
+    for sourceFile in sourceFiles:
+        if '/EP' in args:
+            sys.stdout.write(preprocess(sourceFile))
+            continue
+
+        print(os.path.basename(sourceFile))
+        if '/showIncludes' in args:
+            for includePath in includedFiles(sourceFile):
+                print("Note: including file: {}".format(includePath))
+
+        if re.search(r'^\s*#error', preprocess(sourceFile), re.MULTILINE):
+            print("{}: fatal error C1189: #error".format(sourceFile))
+            exitCode = 2
+            continue
+
+        if '/c' in args:
+            target = objectFile
+            if target is None or len(sourceFiles) > 1 or os.path.isdir(target):
+                target = os.path.join(target or '', os.path.splitext(os.path.basename(sourceFile))[0] + '.obj')
+            with open(target, 'w') as f:
+                f.write("object code of\n")
+                f.write(preprocess(sourceFile))
+    return exitCode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,23 +10,24 @@
 # pylint: disable=no-self-use
 #
 from contextlib import contextmanager
+import codecs
 import multiprocessing
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import clcache
-from clcache import (
-    CommandLineAnalyzer,
-    CompilerArtifactsRepository,
-    Configuration,
-    Manifest,
-    ManifestRepository,
-    Statistics,
-)
+import clcacheutil
+import clcachedirectory
 from clcache import (
     AnalysisError,
     CalledForLinkError,
     CalledForPreprocessingError,
+    CommandLineAnalyzer,
     InvalidArgumentError,
     MultipleSourceFilesComplexError,
     NoSourceFileError,
@@ -46,6 +47,32 @@ def cd(targetDirectory):
         os.chdir(oldDirectory)
 
 
+@contextmanager
+def modifiedEnvironment(variables):
+    oldEnvironment = dict(os.environ)
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(oldEnvironment)
+
+
+def createFakeCompiler(targetDirectory):
+    # Wraps the fake compiler script into something which can be executed directly
+    script = os.path.abspath(os.path.join(ASSETS_DIR, "fake-compiler", "fakecl.py"))
+    if os.name == 'nt':
+        compilerPath = os.path.join(targetDirectory, "cl.bat")
+        with open(compilerPath, 'w') as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, script))
+    else:
+        compilerPath = os.path.join(targetDirectory, "cl")
+        with open(compilerPath, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, script))
+        os.chmod(compilerPath, 0o755)
+    return compilerPath
+
+
 class TestHelperFunctions(unittest.TestCase):
     def testBasenameWithoutExtension(self):
         self.assertEqual(clcache.basenameWithoutExtension(r"README.asciidoc"), "README")
@@ -61,37 +88,37 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(clcache.basenameWithoutExtension(r"C:\Project\README.asciidoc.tmp"), "README.asciidoc")
 
     def testNormalizeBaseDir(self):
-        self.assertIsNone(clcache.normalizeBaseDir(None))
-        self.assertIsNone(clcache.normalizeBaseDir(r""))
+        self.assertIsNone(clcacheutil.normalizeBaseDir(None))
+        self.assertIsNone(clcacheutil.normalizeBaseDir(r""))
 
         # Note: raw string literals cannot end in an odd number of backslashes
         # https://docs.python.org/3/faq/design.html#why-can-t-raw-strings-r-strings-end-with-a-backslash
         # So we consistenly use basic literals
-        self.assertEqual(clcache.normalizeBaseDir("c:"), "c:\\")
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects"), "c:\\projects\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("c:"), "c:\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("c:\\projects"), "c:\\projects\\")
 
-        self.assertEqual(clcache.normalizeBaseDir("C:\\"), "c:\\")
-        self.assertEqual(clcache.normalizeBaseDir("C:\\Projects\\"), "c:\\projects\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("C:\\"), "c:\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("C:\\Projects\\"), "c:\\projects\\")
 
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects with space"), "c:\\projects with space\\")
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects with ö"), "c:\\projects with ö\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("c:\\projects with space"), "c:\\projects with space\\")
+        self.assertEqual(clcacheutil.normalizeBaseDir("c:\\projects with ö"), "c:\\projects with ö\\")
 
     def testFilesBeneathSimple(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("a"))
+            files = list(clcacheutil.filesBeneath("a"))
             self.assertEqual(len(files), 2)
             self.assertIn(r"a\1.txt", files)
             self.assertIn(r"a\2.txt", files)
 
     def testFilesBeneathDeep(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("b"))
+            files = list(clcacheutil.filesBeneath("b"))
             self.assertEqual(len(files), 1)
             self.assertIn(r"b\c\3.txt", files)
 
     def testFilesBeneathRecursive(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("."))
+            files = list(clcacheutil.filesBeneath("."))
             self.assertEqual(len(files), 5)
             self.assertIn(r".\a\1.txt", files)
             self.assertIn(r".\a\2.txt", files)
@@ -100,6 +127,31 @@ class TestHelperFunctions(unittest.TestCase):
             self.assertIn(r".\d\e\5.txt", files)
 
 
+class TestHashing(unittest.TestCase):
+    def testFileHashInChunks(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePath = os.path.join(tempDir, "large.h")
+            content = bytes(range(256)) * (clcacheutil.HASH_BUFFER_SIZE // 256 * 3 + 1)
+            with open(filePath, 'wb') as f:
+                f.write(content)
+
+            for hashAlgorithm in clcacheutil.HASH_ALGORITHMS.values():
+                hasher = hashAlgorithm()
+                clcacheutil.updateHashWithFile(hasher, filePath)
+                self.assertEqual(hasher.hexdigest(), hashAlgorithm(content).hexdigest())
+
+            self.assertEqual(clcacheutil.getFileHash(filePath), clcacheutil.HashAlgorithm(content).hexdigest())
+
+    def testDigestSize(self):
+        for hashAlgorithm in clcacheutil.HASH_ALGORITHMS.values():
+            self.assertEqual(len(hashAlgorithm(b'').hexdigest()), 32)
+
+    def testSelectHashAlgorithm(self):
+        self.assertEqual(clcacheutil.selectHashAlgorithm('md5'), ('md5', clcacheutil.HASH_ALGORITHMS['md5']))
+        self.assertEqual(clcacheutil.selectHashAlgorithm('unknown')[0], clcacheutil.DEFAULT_HASH_ALGORITHM)
+        self.assertEqual(clcacheutil.selectHashAlgorithm(None)[0], clcacheutil.DEFAULT_HASH_ALGORITHM)
+
+
 class TestExtentCommandLineFromEnvironment(unittest.TestCase):
     def testEmpty(self):
         cmdLine, env = clcache.extentCommandLineFromEnvironment([], {})
@@ -143,207 +195,72 @@ class TestExtentCommandLineFromEnvironment(unittest.TestCase):
         self.assertEqual(env, {'USER': 'ab'})
 
 
-class TestConfiguration(unittest.TestCase):
-    def testOpenClose(self):
-        configuration = Configuration(os.path.join(ASSETS_DIR, "configuration", "testOpenClose.json"))
-        with configuration:
-            pass
-
-    def testDefaults(self):
-        configuration = Configuration(os.path.join(ASSETS_DIR, "configuration", "testDefaults.json"))
-        with configuration as cfg:
-            self.assertGreaterEqual(cfg.maximumCacheSize(), 1024) # 1KiB
-
-
-class TestStatistics(unittest.TestCase):
-    def testOpenClose(self):
-        stats = Statistics(os.path.join(ASSETS_DIR, "statistics", "testOpenClose.json"))
-        with stats:
-            pass
-
-    def testHitCounts(self):
-        stats = Statistics(os.path.join(ASSETS_DIR, "statistics", "testHitCounts.json"))
-        with stats as s:
-            self.assertEqual(s.numCallsWithInvalidArgument(), 0)
-            self.assertEqual(s.numCallsWithoutSourceFile(), 0)
-            self.assertEqual(s.numCallsWithMultipleSourceFiles(), 0)
-            self.assertEqual(s.numCallsWithPch(), 0)
-            self.assertEqual(s.numCallsForLinking(), 0)
-            self.assertEqual(s.numCallsForExternalDebugInfo(), 0)
-            self.assertEqual(s.numEvictedMisses(), 0)
-            self.assertEqual(s.numHeaderChangedMisses(), 0)
-            self.assertEqual(s.numSourceChangedMisses(), 0)
-            self.assertEqual(s.numCacheHits(), 0)
-            self.assertEqual(s.numCacheMisses(), 0)
-            self.assertEqual(s.numCallsForPreprocessing(), 0)
-
-            # Bump all by 1
-            s.registerCallWithInvalidArgument()
-            s.registerCallWithoutSourceFile()
-            s.registerCallWithMultipleSourceFiles()
-            s.registerCallWithPch()
-            s.registerCallForLinking()
-            s.registerCallForExternalDebugInfo()
-            s.registerEvictedMiss()
-            s.registerHeaderChangedMiss()
-            s.registerSourceChangedMiss()
-            s.registerCacheHit()
-            s.registerCacheMiss()
-            s.registerCallForPreprocessing()
-
-            self.assertEqual(s.numCallsWithInvalidArgument(), 1)
-            self.assertEqual(s.numCallsWithoutSourceFile(), 1)
-            self.assertEqual(s.numCallsWithMultipleSourceFiles(), 1)
-            self.assertEqual(s.numCallsWithPch(), 1)
-            self.assertEqual(s.numCallsForLinking(), 1)
-            self.assertEqual(s.numCallsForExternalDebugInfo(), 1)
-            self.assertEqual(s.numEvictedMisses(), 1)
-            self.assertEqual(s.numHeaderChangedMisses(), 1)
-            self.assertEqual(s.numSourceChangedMisses(), 1)
-            self.assertEqual(s.numCacheHits(), 1)
-            self.assertEqual(s.numCallsForPreprocessing(), 1)
-
-            # accumulated: headerChanged, sourceChanged, eviced, miss
-            self.assertEqual(s.numCacheMisses(), 4)
-
-
-class TestManifestRepository(unittest.TestCase):
-    def _getDirectorySize(self, dirPath):
-        def filesize(path, filename):
-            return os.stat(os.path.join(path, filename)).st_size
-
-        size = 0
-        for path, _, filenames in clcache.WALK(dirPath):
-            size += sum(filesize(path, f) for f in filenames)
-
-        return size
-
-    def testPaths(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-        ms = mm.section("fdde59862785f9f0ad6e661b9b5746b7")
-
-        self.assertEqual(ms.manifestSectionDir, os.path.join(manifestsRootDir, "fd"))
-        self.assertEqual(ms.manifestPath("fdde59862785f9f0ad6e661b9b5746b7"),
-                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.json"))
-
-    def testIncludesContentHash(self):
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes([]),
-            ManifestRepository.getIncludesContentHashForHashes([])
-        )
-
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
-        )
-
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"])
-        )
-
-        # Wrong number of elements
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes([]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
-        )
-
-        # Wrong order
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
-            ManifestRepository.getIncludesContentHashForHashes(["f6c8bd5733", "d88be7edbf"])
-        )
-
-        # Content in different elements
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["", "d88be7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", ""])
-        )
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be", "7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88b", "e7edbf"])
-        )
-
-    def testStoreAndGetManifest(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-
-        manifest1 = Manifest([r'somepath\myinclude.h'], {
-            "fdde59862785f9f0ad6e661b9b5746b7": "a649723940dc975ebd17167d29a532f8"
-        })
-        manifest2 = Manifest([r'somepath\myinclude.h', 'moreincludes.h'], {
-            "474e7fc26a592d84dfa7416c10f036c6": "8771d7ebcf6c8bd57a3d6485f63e3a89"
-        })
-
-        ms1 = mm.section("8a33738d88be7edbacef48e262bbb5bc")
-        ms2 = mm.section("0623305942d216c165970948424ae7d1")
-
-        ms1.setManifest("8a33738d88be7edbacef48e262bbb5bc", manifest1)
-        ms2.setManifest("0623305942d216c165970948424ae7d1", manifest2)
-
-        retrieved1 = ms1.getManifest("8a33738d88be7edbacef48e262bbb5bc")
-        self.assertIsNotNone(retrieved1)
-        self.assertEqual(retrieved1.includesContentToObjectMap["fdde59862785f9f0ad6e661b9b5746b7"],
-                         "a649723940dc975ebd17167d29a532f8")
-
-        retrieved2 = ms2.getManifest("0623305942d216c165970948424ae7d1")
-        self.assertIsNotNone(retrieved2)
-        self.assertEqual(retrieved2.includesContentToObjectMap["474e7fc26a592d84dfa7416c10f036c6"],
-                         "8771d7ebcf6c8bd57a3d6485f63e3a89")
-
-    def testNonExistingManifest(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-
-        retrieved = mm.section("ffffffffffffffffffffffffffffffff").getManifest("ffffffffffffffffffffffffffffffff")
-        self.assertIsNone(retrieved)
-
-    def testClean(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-
-        # Size in (120, 240] bytes
-        manifest1 = Manifest([r'somepath\myinclude.h'], {
-            "fdde59862785f9f0ad6e661b9b5746b7": "a649723940dc975ebd17167d29a532f8"
-        })
-        # Size in (120, 240] bytes
-        manifest2 = Manifest([r'somepath\myinclude.h', 'moreincludes.h'], {
-            "474e7fc26a592d84dfa7416c10f036c6": "8771d7ebcf6c8bd57a3d6485f63e3a89"
-        })
-        mm.section("8a33738d88be7edbacef48e262bbb5bc").setManifest("8a33738d88be7edbacef48e262bbb5bc", manifest1)
-        mm.section("0623305942d216c165970948424ae7d1").setManifest("0623305942d216c165970948424ae7d1", manifest2)
-
-        cleaningResultSize = mm.clean(240)
-        # Only one of those manifests can be left
-        self.assertLessEqual(cleaningResultSize, 240)
-        self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
-
-        cleaningResultSize = mm.clean(240)
-        # The one remaining is remains alive
-        self.assertLessEqual(cleaningResultSize, 240)
-        self.assertGreaterEqual(cleaningResultSize, 120)
-        self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
-        self.assertGreaterEqual(self._getDirectorySize(manifestsRootDir), 120)
-
-        cleaningResultSize = mm.clean(0)
-        # All manifest are gone
-        self.assertEqual(cleaningResultSize, 0)
-        self.assertEqual(self._getDirectorySize(manifestsRootDir), 0)
-
-
-class TestCompilerArtifactsRepository(unittest.TestCase):
-    def testPaths(self):
-        compilerArtifactsRepositoryRootDir = os.path.join(ASSETS_DIR, "compiler-artifacts-repository")
-        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir)
-        cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
-
-        # section path
-        self.assertEqual(cas.compilerArtifactsSectionDir, os.path.join(compilerArtifactsRepositoryRootDir, "fd"))
-
-        # entry path
-        self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
-            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
+class TestExpandCommandLine(unittest.TestCase):
+    def testResponseFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            responseFile = os.path.join(tempDir, "args.rsp")
+            nestedResponseFile = os.path.join(tempDir, "nested.rsp")
+            with open(responseFile, 'wb') as f:
+                f.write(codecs.BOM_UTF16_LE + '/c "/Ifoo bar" @{}\r\n'.format(nestedResponseFile).encode('utf-16-le'))
+            with open(nestedResponseFile, 'w') as f:
+                f.write('/DX=1')
+
+            self.assertEqual(clcache.expandCommandLine(['/nologo', '@' + responseFile, 'main.cpp']),
+                             ['/nologo', '/c', '/Ifoo bar', '/DX=1', 'main.cpp'])
+            self.assertIn(os.path.abspath(responseFile), clcache.responseFilesInMemory)
+
+            # Changed files are read again
+            with open(nestedResponseFile, 'w') as f:
+                f.write('/DX=2 /DY')
+            self.assertEqual(clcache.expandCommandLine(['@' + responseFile]),
+                             ['/c', '/Ifoo bar', '/DX=2', '/DY'])
+
+
+class TestCacheFileLock(unittest.TestCase):
+    def testRecursiveAcquisition(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            lock = clcacheutil.CacheFileLock(os.path.join(tempDir, "test.lock"), 1000)
+            with lock:
+                with clcacheutil.CacheFileLock(os.path.join(tempDir, "test.lock"), 1000):
+                    pass
+
+    def testExclusionBetweenThreads(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            lockFilePath = os.path.join(tempDir, "test.lock")
+            results = []
+
+            def tryLocking():
+                try:
+                    with clcacheutil.CacheFileLock(lockFilePath, 100):
+                        results.append(True)
+                except clcacheutil.CacheLockException:
+                    results.append(False)
+
+            with clcacheutil.CacheFileLock(lockFilePath, 1000):
+                thread = threading.Thread(target=tryLocking)
+                thread.start()
+                thread.join()
+            tryLocking()
+
+            self.assertEqual(results, [False, True])
+
+    def testExclusionBetweenProcesses(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            lockFilePath = os.path.join(tempDir, "test.lock")
+            code = "import clcacheutil, sys, time; l = clcacheutil.CacheFileLock(sys.argv[1], 1000); l.acquire(); " \
+                   "print('locked'); sys.stdout.flush(); time.sleep(2)"
+            lockingProcess = subprocess.Popen([sys.executable, "-c", code, lockFilePath], stdout=subprocess.PIPE)
+            try:
+                self.assertEqual(lockingProcess.stdout.readline().strip(), b"locked")
+                with self.assertRaises(clcacheutil.CacheLockException):
+                    with clcacheutil.CacheFileLock(lockFilePath, 100):
+                        pass
+            finally:
+                lockingProcess.wait()
+                lockingProcess.stdout.close()
+
+            with clcacheutil.CacheFileLock(lockFilePath, 1000):
+                pass
 
 
 class TestArgumentClasses(unittest.TestCase):
@@ -390,6 +307,15 @@ class TestSplitCommandsFile(unittest.TestCase):
         self._genericTest('/nologo /c', ['/nologo', '/c'])
         self._genericTest('/nologo /c -I.', ['/nologo', '/c', '-I.'])
 
+    def testEmptyArgument(self):
+        self._genericTest('"" -A', ['', '-A'])
+        self._genericTest('-A "" -B', ['-A', '', '-B'])
+        # Not at the end, though
+        self._genericTest('-A ""', ['-A'])
+
+    def testQuotedWhitespace(self):
+        self._genericTest('"-A\t -B\n-C" -D', ['-A\t -B\n-C', '-D'])
+
     def testWhitespace(self):
         self._genericTest('-A -B    -C', ['-A', '-B', '-C'])
         self._genericTest('   -A -B -C', ['-A', '-B', '-C'])
@@ -830,6 +756,156 @@ class TestMultipleSourceFiles(unittest.TestCase):
         actual = clcache.jobCount(["/MP2", "/c", "/MP44", "/nologo", "/MP", "mysource.cpp"])
         self.assertEqual(actual, self.CPU_CORES)
 
+    def testCommandLineForSourceFile(self):
+        self.assertEqual(
+            clcache.commandLineForSourceFile(["/c", "a.cpp", "/MP2", "b.cpp"], "b.cpp", ["a.cpp", "b.cpp"]),
+            ["/c", "/MP2", "b.cpp"])
+
+    def testSplitCompilerOutput(self):
+        subSourceFile = os.path.join("sub", "a.cpp")
+        output = "warning D9025\nb.cpp\nNote: including file: b.h\na.cpp\na.cpp(1): error\n"
+        self.assertEqual(clcache.splitCompilerOutput(output, [subSourceFile, "b.cpp"]), {
+            subSourceFile: "a.cpp\na.cpp(1): error\n",
+            "b.cpp": "warning D9025\nb.cpp\nNote: including file: b.h\n",
+        })
+        self.assertIsNone(clcache.splitCompilerOutput("fatal error\n", ["a.cpp", "b.cpp"]))
+
+    def _compileInProcess(self, cache, compiler, sourceFiles, logFile):
+        with modifiedEnvironment({"FAKECL_LOG": logFile}):
+            exitCode, stdout, _ = clcache.processCompileRequest(
+                cache, compiler, ["clcache.py", "/nologo", "/c", "/MP2"] + sourceFiles)
+        self.assertEqual(exitCode, 0)
+        # The output is in the order of the source files, without include notes
+        self.assertEqual(stdout.split(), sourceFiles)
+        for sourceFile in sourceFiles:
+            objectFile = os.path.splitext(sourceFile)[0] + ".obj"
+            with open(objectFile) as f:
+                self.assertIn(os.path.splitext(sourceFile)[0], f.read())
+            os.remove(objectFile)
+        with open(logFile) as f:
+            invocations = f.read().splitlines()
+        os.remove(logFile)
+        return invocations
+
+    def testProcessInProcess(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(os.path.join(tempDir, "cache"))
+            compiler = createFakeCompiler(tempDir)
+            logFile = os.path.join(tempDir, "invocations.txt")
+            sourceFiles = ["file{}.cpp".format(i) for i in range(5)]
+            for sourceFile in sourceFiles:
+                with open(os.path.join(tempDir, sourceFile), 'w') as f:
+                    f.write('#include "{}.h"\n'.format(os.path.splitext(sourceFile)[0]))
+                with open(os.path.join(tempDir, os.path.splitext(sourceFile)[0] + ".h"), 'w') as f:
+                    f.write("int {};\n".format(os.path.splitext(sourceFile)[0]))
+
+            with cd(tempDir):
+                # The misses are compiled using a single compiler invocation
+                invocations = self._compileInProcess(cache, compiler, sourceFiles, logFile)
+                self.assertEqual(invocations, ["/showIncludes /nologo /c /MP2 " + " ".join(sourceFiles)])
+                # Source files compiled for the first time are assumed to have
+                # taken their share of the time
+                self.assertEqual(sorted(cache.compileDurations.durations(sourceFiles)), sourceFiles)
+
+                for name in ("file3", "file4"):
+                    with open(name + ".h", 'w') as f:
+                        f.write("int {}, j;\n".format(name))
+                # The source file which took longest to compile comes first
+                cache.compileDurations.record({"file3.cpp": 1.0, "file4.cpp": 5.0})
+                invocations = self._compileInProcess(cache, compiler, sourceFiles, logFile)
+                self.assertEqual(invocations, ["/showIncludes /nologo /c /MP2 file4.cpp file3.cpp"])
+                # The estimates of the batch don't replace the known durations
+                self.assertEqual(cache.compileDurations.durations(["file3.cpp", "file4.cpp"]),
+                                 {"file3.cpp": 1.0, "file4.cpp": 5.0})
+
+                # The include notes were attributed to the right source files
+                self.assertFalse(os.path.exists(logFile))
+                with open(logFile, 'w'):
+                    pass
+                self.assertEqual(self._compileInProcess(cache, compiler, sourceFiles, logFile), [])
+
+            with cache.statistics as stats:
+                self.assertEqual(stats.numSourceChangedMisses(), 5)
+                self.assertEqual(stats.numHeaderChangedMisses(), 2)
+                self.assertEqual(stats.numCacheHits(), 8)
+                self.assertEqual(stats.numCacheEntries(), 7)
+                self.assertGreater(stats.compileTimeSaved(), 0)
+
+    def testProcessInProcessWithFailure(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(os.path.join(tempDir, "cache"))
+            compiler = createFakeCompiler(tempDir)
+            logFile = os.path.join(tempDir, "invocations.txt")
+            sourceFiles = ["file{}.cpp".format(i) for i in range(3)]
+            for sourceFile in sourceFiles:
+                with open(os.path.join(tempDir, sourceFile), 'w') as f:
+                    f.write("#error\n" if sourceFile == "file1.cpp" else "int i;\n")
+            # Left from an earlier build, with a modification time which may
+            # be ahead of the clock (e.g. on a network share)
+            staleObjectFile = os.path.join(tempDir, "file1.obj")
+            with open(staleObjectFile, 'w') as f:
+                f.write("file1")
+            os.utime(staleObjectFile, (time.time() + 3600, time.time() + 3600))
+
+            with cd(tempDir), modifiedEnvironment({"FAKECL_LOG": logFile}):
+                for _ in range(2):
+                    exitCode, stdout, _ = clcache.processCompileRequest(
+                        cache, compiler, ["clcache.py", "/nologo", "/c", "/MP2"] + sourceFiles)
+                    self.assertEqual(exitCode, 2)
+                    self.assertIn("file1.cpp: fatal error", stdout)
+                with open(logFile) as f:
+                    invocations = f.read().splitlines()
+
+            # Only the source file which failed to compile is compiled again
+            self.assertEqual(invocations[1:], ["/showIncludes /nologo /c /MP2 file1.cpp"])
+            self.assertFalse(os.path.exists(staleObjectFile))
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 2)
+                self.assertEqual(stats.numCacheHits(), 2)
+
+
+class TestServer(unittest.TestCase):
+    def testFallbackWithoutServer(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            self.assertIsNone(clcache.forwardToServer(tempDir, ["clcache.py", "/c", "main.cpp"], tempDir, {}))
+            self.assertFalse(clcache.stopServer(tempDir))
+
+    def testCompileViaServer(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcachedirectory.Cache(os.path.join(tempDir, "cache"))
+            sourceFile = os.path.join(tempDir, "main.cpp")
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(sourceFile, 'w') as f:
+                f.write("int main() { return 0; }\n")
+            environment = dict(os.environ, CLCACHE_DIR=cache.cacheDirectory(), CLCACHE_CL=createFakeCompiler(tempDir))
+
+            server = clcache.CompileServer(cache.cacheDirectory(), workers=1)
+            serverThread = threading.Thread(target=server.serveForever)
+            serverThread.start()
+            try:
+                for _ in range(100):
+                    if os.path.exists(clcache.serverKeyPath(cache.cacheDirectory())):
+                        break
+                    time.sleep(0.1)
+
+                for _ in range(2):
+                    exitCode, stdout, _ = clcache.forwardToServer(
+                        cache.cacheDirectory(),
+                        ["clcache.py", "/nologo", "/c", "main.cpp", "/Fomain.obj"],
+                        tempDir,
+                        environment)
+                    self.assertEqual(exitCode, 0)
+                    self.assertIn(b"main.cpp", stdout)
+                    self.assertTrue(os.path.exists(objectFile))
+                    os.remove(objectFile)
+            finally:
+                self.assertTrue(clcache.stopServer(cache.cacheDirectory()))
+                serverThread.join()
+
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheMisses(), 1)
+                self.assertEqual(stats.numCacheHits(), 1)
+
 
 class TestParseIncludes(unittest.TestCase):
     def _readSampleFileDefault(self, lang=None):